@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+'''Compare the size and throughput of compressed exports.
+
+Exports a day of generated 2ch topics with the topic and comment export
+pipelines, once per codec and level.
+
+Usage
+-----
+$ python benchmarks/bench_compression.py -t 100
+'''
+import argparse
+import json
+import os
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+repo_dir = Path(__file__).resolve().parents[1]
+for path in (str(repo_dir.parent), str(repo_dir)):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+os.environ.setdefault(
+    'SITE_PARAMS_PATH',
+    str(repo_dir / 'forum_scraper' / 'tests' / 'data' / 'site_params.json')
+)
+
+from scrapy.http import TextResponse  # noqa: E402
+from scrapy.settings import Settings  # noqa: E402
+
+from bench_dat_parser import DAT_URL, make_dat  # noqa: E402
+from corvid.utils.compression import zstandard  # noqa: E402
+from forum_scraper.items import ArchivedTopicItem, BaseTopicItem  # noqa
+from forum_scraper.pipelines import (  # noqa: E402
+    CommentItemExportPipeline,
+    DatetimePipeline,
+    TopicItemExportPipeline
+)
+from forum_scraper.spiders.a2ch import A2chSpider  # noqa: E402
+
+CODECS = [(None, None), ('gzip', 1), ('gzip', 6), ('gzip', 9)]
+if zstandard is not None:
+    CODECS += [('zstd', 1), ('zstd', 3), ('zstd', 10)]
+
+
+def make_items(n_topics, n_comments):
+    '''Parse `n_topics` generated topics into items, as exported.'''
+    spider = A2chSpider()
+    spider.settings = Settings({'COMMENT_ITEM_BUILDER': 'compiled'})
+    body = make_dat(n_comments).encode('cp932')
+    datetime_pipeline = DatetimePipeline()
+    items = []
+    for i in range(n_topics):
+        topic_num = str(1597213268 + i)
+        response = TextResponse(DAT_URL.replace('1597213268', topic_num),
+                                body=body, encoding='cp932')
+        items += [datetime_pipeline.process_item(item, spider)
+                  for item in spider.parse_topic(
+                      response, forum_id='2ch_mnewsplus',
+                      topic_num=topic_num, thd_item_cls=ArchivedTopicItem
+                  )]
+    return items
+
+
+def export(items, data_dir, compression, level):
+    kwargs = {'base_dir_path': str(data_dir),
+              'dirname_tmplt': '{forum_id}/{topic_id}',
+              'compression': compression, 'compression_level': level}
+    pipelines = [
+        TopicItemExportPipeline(filename_tmplt='{topic_id}_metadata.json',
+                                **kwargs),
+        CommentItemExportPipeline(filename_tmplt='{topic_id}_contents.csv',
+                                  **kwargs)
+    ]
+    start = time.perf_counter()
+    for item in items:
+        for pipeline in pipelines:
+            pipeline.process_item(item, None)
+    elapsed = time.perf_counter() - start
+    size = sum(path.stat().st_size for path in data_dir.glob('**/*.*'))
+    return elapsed, size
+
+
+def main(n_topics, n_comments):
+    items = make_items(n_topics, n_comments)
+    topics = [dict(item) for item in items if isinstance(item, BaseTopicItem)]
+    escaped = sum(len(json.dumps(topic)) for topic in topics)
+    unescaped = sum(len(json.dumps(topic, ensure_ascii=False).encode())
+                    for topic in topics)
+
+    print(f'topics:             {n_topics:>10,} ({n_comments:,} comments '
+          'each)')
+    if topics:
+        print(f'metadata JSON:      {unescaped / escaped:>10.0%} of the size'
+              ' with \\uXXXX escapes')
+    print(f'{"codec":<20}{"size":>10}{"ratio":>8}{"MB/s":>8}')
+    plain = None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for compression, level in CODECS:
+            name = f'{compression} {level}' if compression else 'plain'
+            elapsed, size = export(items, Path(tmp_dir) / name.replace(' ', ''),
+                                   compression, level)
+            plain = plain or size
+            print(f'{name:<20}{size / 2 ** 20:>8.1f}MB{size / plain:>8.1%}'
+                  f'{plain / 2 ** 20 / elapsed:>8.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-t', default=100, type=int, dest='n_topics',
+                        help='Number of topics')
+    parser.add_argument('-n', default=1000, type=int, dest='n_comments',
+                        help='Number of comments per topic')
+    args = parser.parse_args()
+    main(args.n_topics, args.n_comments)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+'''Benchmark parsing the comments of a 2ch.sc .dat file.
+
+Usage
+-----
+$ python benchmarks/bench_dat_parser.py -n 1000
+'''
+import argparse
+from collections import namedtuple
+import os
+from pathlib import Path
+import re
+import sys
+import time
+
+repo_dir = Path(__file__).resolve().parents[1]
+for path in (str(repo_dir.parent), str(repo_dir)):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+os.environ.setdefault(
+    'SITE_PARAMS_PATH',
+    str(repo_dir / 'forum_scraper' / 'tests' / 'data' / 'site_params.json')
+)
+
+from scrapy import Selector  # noqa: E402
+from scrapy.http import TextResponse  # noqa: E402
+from scrapy.settings import Settings  # noqa: E402
+
+from forum_scraper.items import ArchivedCommentItem, ArchivedTopicItem  # noqa
+from forum_scraper.loaders import CommentLoader  # noqa: E402
+from forum_scraper.spiders.a2ch import A2chSpider  # noqa: E402
+from forum_scraper.utils.dat import (  # noqa: E402
+    find_images,
+    find_replies,
+    parse_dat
+)
+from forum_scraper.utils.pipelines import DATETIME_PTTRN  # noqa: E402
+
+DAT_URL = 'http://hayabusa5.2ch.sc/mnewsplus/dat/1597213268.dat'
+TOPIC_URL = 'http://hayabusa5.2ch.sc/test/read.cgi/mnewsplus/1597213268/'
+Row = namedtuple('Row', ['uname', 'mail', 'body', 'title', 'date', 'uid'])
+
+
+def make_dat(n):
+    '''Build a .dat file of `n` comments, replying to and linking images.'''
+    rows = []
+    for i in range(1, n + 1):
+        body = (f' <a href="../test/read.cgi/mnewsplus/1597213268/{i // 2}" '
+                f'target="_blank">&gt;&gt;{i // 2}</a> <br> 本文{i} '
+                f'<br> http://i.imgur.com/{i:x}.jpg <br> ' + 'ああ' * 30)
+        title = '【テスト】スレタイ ★1' if i == 1 else ''
+        rows.append(f'名無しさん<>sage<>2020/08/12(水) '
+                    f'{i // 3600 % 24:02}:{i // 60 % 60:02}:{i % 60:02}.00 '
+                    f'ID:Ab{i:06}<>{body}<>{title}')
+    return '\n'.join(rows) + '\n'
+
+
+def legacy_decompose_row(row):
+    data = row.split('<>')
+    date_uid = data.pop(2)
+    m = re.match(DATETIME_PTTRN, date_uid)
+    date = m.group(0) if m is not None else None
+    m2 = re.search(r'([^: ]+)$', date_uid)
+    uid = m2.group(0) if m2 is not None else None
+    data = [seg.strip() if isinstance(seg, str) else ''
+            for seg in data + [date, uid]]
+    return Row(*data)
+
+
+def legacy_parse(response):
+    '''The comment path of `A2chSpider.parse_topic` before `parse_dat`.'''
+    body = [r for r in response.text.split('\n')
+            if r and not r.startswith('過去ログ')]
+    legacy_decompose_row(body[0])
+    [legacy_decompose_row(row).date for row in body[-20:]]
+    for i, row in enumerate(body, 1):
+        row = legacy_decompose_row(row)
+        cl = CommentLoader(ArchivedCommentItem(),
+                           selector=Selector(text=row.body))
+        cl.add_value('site', '2ch')
+        cl.add_value('comment_id', 'mnewsplus_1597213268')
+        cl.add_value('comment_id', str(i))
+        cl.add_value('comment_url', TOPIC_URL)
+        cl.add_value('comment_url', str(i))
+        cl.add_value('posted_on_raw', row.date)
+        cl.add_value('user_id', row.uid)
+        cl.add_value('user_name', row.uname)
+        cl.add_value('body', row.body)
+        p_res = r'(\.{2})?/test/read.cgi/\w+/\d+/\d+/?'
+        cl.add_value('reply_to', re.findall(p_res, row.body))
+        cl.add_value('is_aa', False)
+        p_img = r'\bhttps?://[\w/\.]+\.(?:png|gif|jpg)\b'
+        cl.add_value('image_urls', re.findall(p_img, row.body))
+        cl.add_value('topic_id', 'mnewsplus_1597213268')
+        yield cl.load_item()
+
+
+def legacy_tokenize(response):
+    '''The rows and HTML trees `legacy_parse` builds, without the loaders.'''
+    body = [r for r in response.text.split('\n')
+            if r and not r.startswith('過去ログ')]
+    legacy_decompose_row(body[0])
+    [legacy_decompose_row(row).date for row in body[-20:]]
+    for row in body:
+        row = legacy_decompose_row(row)
+        yield row, Selector(text=row.body)
+
+
+def tokenize(response):
+    for row in parse_dat(response.text):
+        yield row, find_replies(row.body), find_images(row.body)
+
+
+def make_parse(builder):
+    spider = A2chSpider()
+    spider.settings = Settings({'COMMENT_ITEM_BUILDER': builder})
+
+    def parse(response):
+        return spider.parse_topic(
+            response, forum_id='2ch_mnewsplus', topic_num='1597213268',
+            thd_item_cls=ArchivedTopicItem
+        )
+    return parse
+
+
+def timed(func, response, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for _ in func(response):
+            pass
+    return time.perf_counter() - start
+
+
+def main(n, repeat):
+    response = TextResponse(DAT_URL, body=make_dat(n).encode('cp932'),
+                            encoding='cp932')
+    t_legacy_tok = timed(legacy_tokenize, response, repeat)
+    t_tok = timed(tokenize, response, repeat)
+    t_legacy = timed(legacy_parse, response, repeat)
+    t_new = timed(make_parse('loader'), response, repeat)
+    t_compiled = timed(make_parse('compiled'), response, repeat)
+
+    total = n * repeat
+    print(f'comments:           {total:>12,} ({n:,}-post .dat x {repeat})')
+    print('tokenize')
+    print(f'  legacy:           {total / t_legacy_tok:>12,.0f} comments/s')
+    print(f'  parse_dat:        {total / t_tok:>12,.0f} comments/s'
+          f' (x{t_legacy_tok / t_tok:.1f})')
+    print('parse_topic')
+    print(f'  legacy:           {total / t_legacy:>12,.0f} comments/s')
+    print(f'  parse_dat:        {total / t_new:>12,.0f} comments/s'
+          f' (x{t_legacy / t_new:.1f})')
+    print(f'  compiled items:   {total / t_compiled:>12,.0f} comments/s'
+          f' (x{t_legacy / t_compiled:.1f})')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', default=1000, type=int, dest='n',
+                        help='Number of comments in the .dat file')
+    parser.add_argument('-r', default=5, type=int, dest='repeat',
+                        help='Number of times to parse it')
+    args = parser.parse_args()
+    main(args.n, args.repeat)
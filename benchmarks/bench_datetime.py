@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+'''Benchmark normalizing comment datetimes into ISO format.
+
+Usage
+-----
+$ python benchmarks/bench_datetime.py -n 100000
+'''
+import argparse
+from datetime import datetime
+from pathlib import Path
+import re
+import sys
+import time
+
+repo_dir = Path(__file__).resolve().parents[1]
+for path in (str(repo_dir.parent), str(repo_dir)):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from forum_scraper.utils.pipelines import (  # noqa: E402
+    DATETIME_PTTRN,
+    iso8601_str,
+    iso8601_strs
+)
+
+
+def legacy_iso8601_str(text):
+    m = re.search(DATETIME_PTTRN, text)
+    if m is None:
+        return None
+    date = m.group('date')
+    time = m.group('time')
+    frmt = '%Y/%m/%d%H:%M:%S'
+    if len(date) == 8:
+        frmt = frmt.replace('%Y', '%y')
+    if len(time) == 5:
+        frmt = frmt.replace(':%S', '')
+    dt = datetime.strptime(date+time, frmt)
+    return dt.strftime('%Y-%m-%dT%H:%M:%S+09:00')
+
+
+def make_texts(n):
+    '''Datetimes of `n` comments posted over a few days, as on 5ch.'''
+    weekdays = '月火水木金土日'
+    texts = []
+    for i in range(n):
+        seconds = i * 7
+        day = 10 + seconds // 86400
+        texts.append(f'2020/08/{day:02}({weekdays[day % 7]}) '
+                     f'{seconds // 3600 % 24:02}:{seconds // 60 % 60:02}:'
+                     f'{seconds % 60:02}.{i % 100:02}')
+    return texts
+
+
+def timed(func, texts):
+    start = time.perf_counter()
+    func(texts)
+    return time.perf_counter() - start
+
+
+def main(n):
+    texts = make_texts(n)
+    assert iso8601_strs(texts) == [legacy_iso8601_str(t) for t in texts]
+
+    t_legacy = timed(lambda ts: [legacy_iso8601_str(t) for t in ts], texts)
+    t_new = timed(lambda ts: [iso8601_str(t) for t in ts], texts)
+    t_batch = timed(iso8601_strs, texts)
+
+    print(f'datetimes:          {n:>12,}')
+    print(f'  legacy:           {n / t_legacy:>12,.0f} /s')
+    print(f'  iso8601_str:      {n / t_new:>12,.0f} /s'
+          f' (x{t_legacy / t_new:.1f})')
+    print(f'  iso8601_strs:     {n / t_batch:>12,.0f} /s'
+          f' (x{t_legacy / t_batch:.1f})')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', default=100000, type=int, dest='n',
+                        help='Number of datetimes')
+    args = parser.parse_args()
+    main(args.n)
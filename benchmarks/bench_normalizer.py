@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+'''Benchmark normalizing comment bodies, as loaded and as exported.
+
+Usage
+-----
+$ python benchmarks/bench_normalizer.py -n 100000
+'''
+import argparse
+from pathlib import Path
+import re
+import sys
+import time
+
+from itemadapter import ItemAdapter
+from w3lib import html
+
+repo_dir = Path(__file__).resolve().parents[1]
+for path in (str(repo_dir.parent), str(repo_dir)):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from forum_scraper.utils.pipelines import _fields_list  # noqa: E402
+from forum_scraper.utils.text import (  # noqa: E402
+    COMMENT_TEXT,
+    EXPORTED_COMMENT_TEXT
+)
+
+
+def legacy_comment_body(values):
+    text = ' '.join(values).strip('\t\n\x0b\x0c\r ')
+    return html.remove_tags(text, which_ones=('span', 'img'))
+
+
+def legacy_remove_excess_spaces(item, fields):
+    ESCAPE_CHARACTERS = r'\t\n\x0b\x0c\r '
+    adapter = ItemAdapter(item)
+    for src, dest in _fields_list(fields):
+        text = adapter.get(src)
+        if isinstance(text, str):
+            text = text.strip(ESCAPE_CHARACTERS)
+            text = re.sub(r'['+ESCAPE_CHARACTERS+r']+', ' ', text)
+            text = text.replace(' <br>', '<br>').replace('<br> ', '<br>')
+            adapter[dest] = text.replace(' >', '>')
+    return item
+
+
+def make_bodies(n):
+    '''Bodies of `n` comments as selected from read.cgi, a few hundred
+    characters with replies, links and <br>s, every tenth with a <span>.'''
+    bodies = []
+    for i in range(1, n + 1):
+        body = (f'\n <a href="../test/read.cgi/mnewsplus/1597213268/{i // 2}" '
+                f'rel="noopener" target="_blank">&gt;&gt;{i // 2}</a> <br> '
+                f'本文{i}  <br> <a href="http://i.imgur.com/{i:x}.jpg">'
+                f'http://i.imgur.com/{i:x}.jpg</a> <br> ' + 'ああ ' * 40)
+        if i % 10 == 0:
+            body += '<span class="AA">（´・ω・｀）</span><img src="x.png">'
+        bodies.append([body, ' \n'])
+    return bodies
+
+
+def timed(func, bodies):
+    start = time.perf_counter()
+    func(bodies)
+    return time.perf_counter() - start
+
+
+def main(n):
+    bodies = make_bodies(n)
+    normalize = COMMENT_TEXT['body']
+    loaded = [normalize(' '.join(values)) for values in bodies]
+    assert loaded == [legacy_comment_body(values) for values in bodies]
+    assert [EXPORTED_COMMENT_TEXT({'body': b}) for b in loaded] == \
+        [legacy_remove_excess_spaces({'body': b}, 'body') for b in loaded]
+
+    t_legacy = timed(lambda bs: [legacy_comment_body(v) for v in bs], bodies)
+    t_new = timed(lambda bs: [normalize(' '.join(v)) for v in bs], bodies)
+    print(f'loaded bodies:      {n:>12,}')
+    print(f'  legacy:           {n / t_legacy:>12,.0f} /s')
+    print(f'  COMMENT_TEXT:     {n / t_new:>12,.0f} /s'
+          f' (x{t_legacy / t_new:.1f})')
+
+    t_legacy = timed(lambda bs: [legacy_remove_excess_spaces({'body': b},
+                                                             'body')
+                                 for b in bs], loaded)
+    t_new = timed(lambda bs: [EXPORTED_COMMENT_TEXT({'body': b})
+                              for b in bs], loaded)
+    print(f'exported bodies:    {n:>12,}')
+    print(f'  legacy:           {n / t_legacy:>12,.0f} /s')
+    print(f'  EXPORTED_COMMENT_TEXT: {n / t_new:>7,.0f} /s'
+          f' (x{t_legacy / t_new:.1f})')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', default=100000, type=int, dest='n',
+                        help='Number of comment bodies')
+    args = parser.parse_args()
+    main(args.n)
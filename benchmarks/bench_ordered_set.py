@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+'''Benchmark pickling a URLOrderedSet.
+
+Usage
+-----
+$ python benchmarks/bench_ordered_set.py -n 1000000
+'''
+import argparse
+from pathlib import Path
+import pickle
+import sys
+import tempfile
+import time
+
+parent_dir = str(Path(__file__).resolve().parents[2])
+if parent_dir not in sys.path:
+    sys.path.insert(0, parent_dir)
+
+from corvid.utils.classes import URLOrderedSet  # noqa: E402
+
+
+def legacy_state(keys):
+    '''Build the state the linked-list implementation used to pickle.'''
+    end = []
+    end += [None, end, end]
+    map = {}
+    for key in keys:
+        curr = end[1]
+        curr[2] = end[1] = map[key] = [key, curr, end]
+    return {'end': end, 'map': map, 'pivot_url': None}
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main(n):
+    urls = [f'https://mao.5ch.net/test/read.cgi/bass/{1500000000 + i}/'
+            for i in range(n)]
+    uos = URLOrderedSet(urls)
+    uos.set_pivot_url()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / 'scraped_urls.pickle'
+
+        with path.open('wb') as wh:
+            _, t_save = timed(pickle.dump, uos, wh)
+        with path.open('rb') as rh:
+            loaded, t_load = timed(pickle.load, rh)
+        size = path.stat().st_size
+
+    assert list(loaded) == urls
+
+    migrated = URLOrderedSet.__new__(URLOrderedSet)
+    _, t_migrate = timed(migrated.__setstate__, legacy_state(urls))
+
+    print(f'entries:          {n:>12,}')
+    print(f'pickle size:      {size / 1024 / 1024:>12.1f} MB')
+    print(f'save:             {t_save:>12.3f} s')
+    print(f'load:             {t_load:>12.3f} s')
+    print(f'migrate (legacy): {t_migrate:>12.3f} s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', default=1_000_000, type=int, dest='n',
+                        help='Number of URLs in the set')
+    args = parser.parse_args()
+    main(args.n)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+'''Benchmark parsing .dat topics on the reactor thread and in a ParsePool.
+
+Reports how late a 10 ms timer fires on the reactor (the lag downloads
+would see) and the topics parsed per second.
+
+Usage
+-----
+$ python benchmarks/bench_parse_pool.py -n 40 -w 4
+'''
+import argparse
+import os
+from pathlib import Path
+import statistics
+import sys
+import time
+
+repo_dir = Path(__file__).resolve().parents[1]
+for path in (str(repo_dir.parent), str(repo_dir)):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+os.environ.setdefault(
+    'SITE_PARAMS_PATH',
+    str(repo_dir / 'forum_scraper' / 'tests' / 'data' / 'site_params.json')
+)
+
+from scrapy.http import TextResponse  # noqa: E402
+from scrapy.settings import Settings  # noqa: E402
+from twisted.internet import defer, reactor, task  # noqa: E402
+
+from bench_dat_parser import DAT_URL, make_dat  # noqa: E402
+from forum_scraper.items import ArchivedTopicItem  # noqa: E402
+from forum_scraper.spiders.a2ch import A2chSpider  # noqa: E402
+from forum_scraper.utils.parse_pool import ParsePool  # noqa: E402
+
+SETTINGS = {'SITE_PARAMS_PATH': os.environ['SITE_PARAMS_PATH'],
+            'COMMENT_ITEM_BUILDER': 'compiled'}
+KWARGS = {'forum_id': '2ch_mnewsplus', 'topic_num': '1597213268',
+          'thd_item_cls': ArchivedTopicItem}
+
+
+class LagMonitor:
+    '''Measure how late a LoopingCall of `interval` seconds fires.'''
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lags = []
+        self._last = None
+        self._task = task.LoopingCall(self._tick)
+
+    def start(self):
+        self._last = time.perf_counter()
+        self._task.start(self.interval, now=False)
+
+    def stop(self):
+        self._tick()
+        self._task.stop()
+
+    def _tick(self):
+        now = time.perf_counter()
+        self.lags.append(max(0, now - self._last - self.interval))
+        self._last = now
+
+
+async def parse_all(spider, responses, spacing=0.005):
+    '''Parse `responses` as Scrapy would, one downloaded every `spacing`
+    seconds.'''
+    async def parse(i, response):
+        await task.deferLater(reactor, i * spacing, lambda: None)
+        result = spider.parse_topic(response, **KWARGS)
+        if spider.parse_pool is not None:
+            return await result
+        return list(result)
+
+    ds = [defer.ensureDeferred(parse(i, response))
+          for i, response in enumerate(responses)]
+    return await defer.gatherResults(ds)
+
+
+def main(n, workers):
+    body = make_dat(1000).encode('cp932')
+    responses = [TextResponse(DAT_URL, body=body, encoding='cp932')
+                 for _ in range(n)]
+
+    spider = A2chSpider()
+    spider.settings = Settings(SETTINGS)
+
+    # The reactor can't restart, run both modes in one go.
+    pool = ParsePool(workers, 2 * workers, SETTINGS)
+    pooled_spider = A2chSpider()
+    pooled_spider.settings = Settings(SETTINGS)
+    pooled_spider.parse_pool = pool
+    results = {}
+
+    async def both():
+        # Start the workers and build their spiders.
+        await parse_all(pooled_spider, responses[:workers], spacing=0)
+
+        for name, sp in (('reactor thread', spider),
+                         (f'pool ({workers} workers)', pooled_spider)):
+            monitor = LagMonitor()
+            monitor.start()
+            start = time.perf_counter()
+            items = await parse_all(sp, responses)
+            elapsed = time.perf_counter() - start
+            monitor.stop()
+            lags = monitor.lags or [0]
+            results[name] = (elapsed, sum(map(len, items)),
+                             statistics.mean(lags), max(lags))
+
+    d = defer.ensureDeferred(both())
+    d.addErrback(lambda failure: failure.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    pool.close()
+
+    print(f'topics:             {n:>8,} (1000 comments each)')
+    for name, (elapsed, items, mean_lag, max_lag) in results.items():
+        print(name)
+        print(f'  items:            {items:>8,}')
+        print(f'  topics/s:         {n / elapsed:>8.1f}')
+        print(f'  reactor lag:      {mean_lag * 1000:>8.1f} ms mean, '
+              f'{max_lag * 1000:.1f} ms max')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', default=40, type=int, dest='n',
+                        help='Number of topics')
+    parser.add_argument('-w', default=4, type=int, dest='workers',
+                        help='Number of worker processes')
+    args = parser.parse_args()
+    main(args.n, args.workers)
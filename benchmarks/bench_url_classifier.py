@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+'''Benchmark getting forum IDs from URLs.
+
+Usage
+-----
+$ python benchmarks/bench_url_classifier.py -n 100000
+'''
+import argparse
+import os
+from pathlib import Path
+import random
+import re
+import sys
+import time
+from urllib.parse import urlparse
+
+repo_dir = Path(__file__).resolve().parents[1]
+for path in (str(repo_dir.parent), str(repo_dir)):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+os.environ.setdefault(
+    'SITE_PARAMS_PATH',
+    str(repo_dir / 'forum_scraper' / 'tests' / 'data' / 'site_params.json')
+)
+
+from corvid.utils.urlutil import get_sld_from_url  # noqa: E402
+from forum_scraper.utils.site_params import site_params  # noqa: E402
+from forum_scraper.utils.urlutil import URLClassifier  # noqa: E402
+
+SITE_PARAMS = site_params.sites
+
+
+def legacy_forum_id_from_url(url):
+    '''`forum_id_from_url` as it was before `URLClassifier`.'''
+    def parse_url(url, key):
+        parsed = urlparse(url)
+        for site_info in SITE_PARAMS:
+            m = re.match(site_info[key], parsed.path)
+            if site_info['domain'] in parsed.netloc and m:
+                return m
+        return None
+
+    def is_comment_url(url):
+        for site_info in SITE_PARAMS:
+            m = re.match(site_info['comment_pat'], url)
+            if m:
+                return m
+        return False
+
+    m = (parse_url(url, 'forum_pat') or parse_url(url, 'topic_pat')
+         or is_comment_url(url))
+    if not m:
+        return None
+    return '_'.join([get_sld_from_url(url), m.group('forum_id')])
+
+
+def timed(func, urls):
+    start = time.perf_counter()
+    for url in urls:
+        func(url)
+    return time.perf_counter() - start
+
+
+def main(n, distinct):
+    urls = [f'https://mao.5ch.net/test/read.cgi/bass/{1500000000 + i}/'
+            for i in range(distinct // 2)]
+    urls += [f'http://hayabusa5.2ch.sc/news{i % 100}/' for i in range(100)]
+    urls += [f'http://hayabusa5.2ch.sc/mnewsplus/dat/{1500000000 + i}.dat'
+             for i in range(distinct - len(urls))]
+    random.seed(0)
+    requests = random.choices(urls, k=n)
+
+    classifier = URLClassifier(SITE_PARAMS)
+
+    def forum_id_from_url(url):
+        parsed = classifier(url)
+        groups = parsed.forum or parsed.topic or parsed.comment
+        return groups and '_'.join([parsed.sld, groups['forum_id']])
+
+    assert all(forum_id_from_url(url) == legacy_forum_id_from_url(url)
+               for url in urls)
+    classifier._classify.cache_clear()
+
+    t_legacy = timed(legacy_forum_id_from_url, requests)
+    t_cold = timed(forum_id_from_url, urls)
+    t_cached = timed(forum_id_from_url, requests)
+
+    print(f'lookups:          {n:>12,} ({distinct:,} distinct URLs)')
+    print(f'legacy:           {t_legacy / n * 1e6:>12.2f} us/URL')
+    print(f'classifier, cold: {t_cold / len(urls) * 1e6:>12.2f} us/URL')
+    print(f'classifier:       {t_cached / n * 1e6:>12.2f} us/URL'
+          f' (x{t_legacy / t_cached:.1f})')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', default=100_000, type=int, dest='n',
+                        help='Number of lookups')
+    parser.add_argument('-d', default=2_000, type=int, dest='distinct',
+                        help='Number of distinct URLs')
+    args = parser.parse_args()
+    main(args.n, args.distinct)
@@ -16,11 +16,16 @@ from scrapy.exceptions import DropItem
 
 from corvid.forum_scraper.utils import urlutil as uu
 from corvid.utils.classes import ItemBuffer
+from corvid.utils.compression import compression_settings, open_text
+from corvid.utils.writer import WriteQueue, write
 from .items import ArticleItem
 
 
 class ArticleItemPipeline:
     logger = logging.getLogger('pipelines.ArticleItemPipeline')
+    write_queue = None
+    compression = None
+    compression_level = None
 
     def __init__(self, **kwargs):
         for k, v in kwargs.items():
@@ -32,7 +37,9 @@ class ArticleItemPipeline:
     def from_crawler(cls, crawler):
         kwargs = {
             'daily_dir_path': Path(crawler.settings.get('DAILY_DIR')),
-            'filename_tmplt': crawler.settings.get('BLOG_TEMPLATE')
+            'filename_tmplt': crawler.settings.get('BLOG_TEMPLATE'),
+            'write_queue': WriteQueue.from_crawler(crawler),
+            **compression_settings(crawler.settings)
         }
         return cls(**kwargs)
 
@@ -68,18 +75,23 @@ class ArticleItemPipeline:
     def close_spider(self, spider):
 
         for blog_name, buffer in self.art_buffer.items():
+            write(self.write_queue, None, self.export, blog_name, buffer)
 
-            file_name = self.filename_tmplt.format(blog=blog_name)
-            path = self.daily_dir_path / file_name
+        if self.write_queue is not None:
+            return self.write_queue.drain()
+        return None
 
-            with path.open('w') as wh:
-                writer = csv.writer(wh)
-                for row in buffer:
-                    writer.writerow(row)
+    def export(self, blog_name, buffer):
+        file_name = self.filename_tmplt.format(blog=blog_name)
+        path = self.daily_dir_path / file_name
 
-            # Log
-            self.logger.debug(
-                f'Exported {len(buffer)-1} items for {blog_name}'
-            )
+        with open_text(path, 'w', self.compression,
+                       self.compression_level) as wh:
+            writer = csv.writer(wh)
+            for row in buffer:
+                writer.writerow(row)
 
-        return None
+        # Log
+        self.logger.debug(
+            f'Exported {len(buffer)-1} items for {blog_name}'
+        )
@@ -26,6 +26,7 @@ def generate_settings(base_dir, base_settings, start_time):
     settings['IMAGES_STORE'] = str(base_dir/'images')
     settings['LATEST_DIR_POINTER'] = str(latest_dir/'latest.txt')
     settings['DAILY_DIR'] = str(daily_dir)
+    settings['HISTORY_DIR'] = str(blog_dir/'HISTORY')
     settings['BLOG_TEMPLATE'] = '{blog}.csv'
 
     settings['LOG_LEVEL'] = 'WARNING'
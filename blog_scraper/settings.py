@@ -41,3 +41,32 @@ DOWNLOADER_MIDDLEWARES = {
 ITEM_PIPELINES = {
     'blog_scraper.pipelines.ArticleItemPipeline': 300,
 }
+
+# Flush crawl history to disk every N seconds and every N new records, so that
+# an interrupted crawl is resumed from there (0 disables either trigger).
+HISTORY_CHECKPOINT_INTERVAL = 300
+HISTORY_CHECKPOINT_ITEMS = 1000
+
+# Memory for the history shards (one per forum/blog) loaded at once. The least
+# recently used shards are written back and unloaded beyond it.
+HISTORY_MEMORY_BUDGET = 256 * 1024 * 1024
+# Open history shards at once, each holding a couple of files. The least
+# recently used are closed beyond it, however little memory they take.
+HISTORY_MAX_OPEN_SHARDS = 256
+
+# Bloom filter in front of the crawl history, so that new URLs skip the exact
+# lookups. Sized for HISTORY_BLOOM_CAPACITY records (about 1.2 bytes each at
+# 1%), 0 disables it.
+HISTORY_BLOOM_ERROR_RATE = 0.01
+HISTORY_BLOOM_CAPACITY = 10_000_000
+
+# Write exported files in a background thread with at most EXPORT_QUEUE_SIZE
+# writes pending, beyond which the export pipelines wait (0 writes them in
+# the pipelines).
+EXPORT_QUEUE_SIZE = 100
+
+# Compress the exported files with 'gzip' or 'zstd' (needs `zstandard`) at
+# EXPORT_COMPRESSION_LEVEL, None for the codec's default. None writes plain
+# files. See corvid.utils.compression to read them back.
+EXPORT_COMPRESSION = None
+EXPORT_COMPRESSION_LEVEL = None
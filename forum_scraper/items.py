@@ -94,4 +94,47 @@ class ArchivedCommentItem(BaseCommentItem):
 
 
 class TopicCompletedItem(BaseCommentItem):
+    # (forum key, topic number, state) recorded in `TopicStates` once the
+    # comments of an active topic are written, see CommentItemExportPipeline
+    topic_state = scrapy.Field()
+
+
+class TopicResumedItem(BaseCommentItem):
+    '''Sent before the comments of a topic when they only are those added
+    since a previous crawl, to be appended to what was exported then.'''
     pass
+
+
+class TopicCommentsBatch(scrapy.Item):
+    '''Item object to carry all the comments of a topic at once, instead of
+    the comment items followed by a TopicCompletedItem.
+
+    `columns` maps every field of `comment_cls` to the list of its values,
+    one per comment (None where unset), so that the pipelines process a topic
+    in bulk. `resumed` is set when they only are the comments added since
+    a previous crawl, see `TopicResumedItem`. `topic_state` is as on
+    TopicCompletedItem.'''
+    topic_id = scrapy.Field()
+    comment_cls = scrapy.Field()
+    columns = scrapy.Field()
+    resumed = scrapy.Field()
+    topic_state = scrapy.Field()
+
+    @classmethod
+    def from_comments(cls, topic_id, comment_cls, comments):
+        columns = {field: [comment.get(field) for comment in comments]
+                   for field in comment_cls.fields}
+        return cls(topic_id=topic_id, comment_cls=comment_cls,
+                   columns=columns)
+
+    @property
+    def num_comments(self):
+        return len(self['columns']['topic_id'])
+
+    def comments(self):
+        '''Yield the comments as `comment_cls` items.'''
+        fields = list(self['columns'])
+        for values in zip(*self['columns'].values()):
+            yield self['comment_cls']({field: value
+                                       for field, value in zip(fields, values)
+                                       if value is not None})
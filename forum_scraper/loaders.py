@@ -5,6 +5,8 @@
 # See documentation in:
 # https://doc.scrapy.org/en/latest/topics/loaders.html
 
+from itemadapter import ItemAdapter
+from itemloaders.utils import arg_to_iter
 from scrapy.loader import ItemLoader
 from itemloaders.processors import (
     Compose,
@@ -19,12 +21,12 @@ from .utils.loaders import (
     extract_image_url,
     filter_datetime,
     prep_comment_id,
-    remove_span_img_tags,
     strip_space_characters,
     take_last,
     to_int,
     to_byte_size
 )
+from .utils.text import COMMENT_TEXT
 from .utils.urlutil import (
     forum_id_from_url,
     topic_id_from_url,
@@ -79,7 +81,71 @@ class CommentLoader(ItemLoader):
     # Metadata
     comment_id_out = Join('_')
     comment_url_out = Join('/')
-    body_out = Compose(Join(), strip_space_characters, remove_span_img_tags)
+    body_out = Compose(Join(), COMMENT_TEXT['body'])
     reply_to_out = Identity()  # To keep as a list
     is_aa_out = Compose(TakeFirst(), bool)
     image_urls_out = Identity()  # To keep as a list
+
+
+# Compiled equivalent of the `CommentLoader` processors, as (input, output)
+# functions by field, for the fields not using the default ones.
+def _map(func):
+    return lambda values: [v for v in map(func, values) if v is not None]
+
+
+_take_first = TakeFirst()
+
+
+_normalize_body = COMMENT_TEXT['body']
+
+
+def _comment_body(values):
+    return _normalize_body(' '.join(values))
+
+
+def _is_aa(values):
+    value = _take_first(values)
+    return None if value is None else bool(value)
+
+
+_COMMENT_PROCESSORS = {
+    'comment_id': (prep_comment_id, '_'.join),
+    'comment_url': (None, '/'.join),
+    'body': (None, _comment_body),
+    'reply_to': (_map(comment_id_from_url), None),
+    'is_aa': (None, _is_aa),
+    'image_urls': (_map(extract_image_url), None),
+}
+
+
+def build_comment_item(item, values):
+    '''Populate `item` from `values`, a dict of field names to a value or a
+    list of values, with the same results as adding each of them to a
+    `CommentLoader` and loading the item, at a fraction of the cost.'''
+    adapter = ItemAdapter(item)
+    for field_name, value in values.items():
+        in_proc, out_proc = _COMMENT_PROCESSORS.get(field_name,
+                                                    (None, _take_first))
+        value = arg_to_iter(value)
+        if in_proc is not None:
+            value = in_proc(value)
+        if not value:
+            continue
+        if out_proc is not None:
+            value = out_proc(value)
+        if value is not None:
+            adapter[field_name] = value
+
+    return item
+
+
+def load_comment_item(item, values, compiled=False):
+    '''Populate `item` from `values` (see `build_comment_item`) with a
+    `CommentLoader`, or with `build_comment_item` if `compiled`.'''
+    if compiled:
+        return build_comment_item(item, values)
+
+    cl = CommentLoader(item)
+    for field_name, value in values.items():
+        cl.add_value(field_name, value)
+    return cl.load_item()
@@ -6,8 +6,8 @@
 # https://doc.scrapy.org/en/latest/topics/spider-middleware.html
 
 from corvid.utils.middlewares import BaseDownloaderMiddleware
-from .items import ArchivedTopicItem
-from .utils.urlutil import forum_id_from_url
+from .items import ArchivedTopicItem, TopicCommentsBatch, TopicCompletedItem
+from .utils.urlutil import forum_id_from_url, topic_key_from_url
 
 
 class ForumDownloaderMiddleware(BaseDownloaderMiddleware):
@@ -15,4 +15,7 @@ class ForumDownloaderMiddleware(BaseDownloaderMiddleware):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.get_key = forum_id_from_url
+        self.get_topic = topic_key_from_url
         self.trgt_item_cls = ArchivedTopicItem
+        # Recorded once the comments of the topic are written
+        self.exported_item_cls = (TopicCompletedItem, TopicCommentsBatch)
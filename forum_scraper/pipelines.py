@@ -9,21 +9,65 @@ import csv
 from collections import defaultdict
 import json
 import logging
+import time
 
 from itemadapter import ItemAdapter
+from scrapy.pipelines.images import ImagesPipeline
+from twisted.internet import defer
 
 from corvid.utils.classes import ItemBuffer
+from corvid.utils.compression import (
+    compressed_path,
+    compression_settings,
+    open_text
+)
+from corvid.utils.fileutil import clear_known_dirs, saved_syscalls
+from corvid.utils.history import TopicStates
+from corvid.utils.writer import WriteQueue, write
 from .items import (
     BaseForumItem,
     BaseTopicItem,
     BaseCommentItem,
-    TopicCompletedItem
+    TopicCommentsBatch,
+    TopicCompletedItem,
+    TopicResumedItem
 )
-from .utils.fileutil import prepare_path
+from .utils.fileutil import get_parent_id, get_template_kwargs, prepare_path
 from .utils.pipelines import (
-    remove_excess_spaces,
+    iso8601_strs,
     to_iso8601
 )
+from .utils.segments import SegmentStore
+from .utils.text import EXPORTED_COMMENT_TEXT
+
+
+class CommentImagesPipeline(ImagesPipeline):
+    '''ImagesPipeline downloading the images of all the comments in
+    TopicCommentsBatches too.'''
+
+    def get_media_requests(self, item, info):
+        if not isinstance(item, TopicCommentsBatch):
+            return super().get_media_requests(item, info)
+
+        urls = [url for urls in item['columns'][self.images_urls_field]
+                if urls for url in urls]
+        return super().get_media_requests({self.images_urls_field: urls},
+                                          info)
+
+    def item_completed(self, results, item, info):
+        if not isinstance(item, TopicCommentsBatch):
+            return super().item_completed(results, item, info)
+
+        # Results are in the order of the requests, comment by comment.
+        columns = item['columns']
+        images = []
+        start = 0
+        for urls in columns[self.images_urls_field]:
+            end = start + len(urls or [])
+            images.append([x for ok, x in results[start:end] if ok])
+            start = end
+        columns[self.images_result_field] = images
+        return item
 
 
 class DatetimePipeline:
@@ -36,17 +80,42 @@ class DatetimePipeline:
 
         # Process TopicItems
         elif isinstance(item, BaseTopicItem):
-            to_iso8601(item, ['posted_on', 'last_comment_on'])
+            self.process_topic(item, ItemAdapter(item))
 
         # Process CommentItems
         elif isinstance(item, BaseCommentItem):
-            to_iso8601(item, [('posted_on_raw', 'posted_on')])
+            self.process_comment(item, ItemAdapter(item))
+
+        elif isinstance(item, TopicCommentsBatch):
+            self.process_batch(item)
+
+        return item
+
+    def process_topic(self, item, adapter):
+        to_iso8601(adapter, ['posted_on', 'last_comment_on'])
+        return item
+
+    def process_comment(self, item, adapter):
+        to_iso8601(adapter, [('posted_on_raw', 'posted_on')])
+        return item
 
+    def process_batch(self, item, adapter=None):
+        columns = item['columns']
+        raw = columns['posted_on_raw']
+        columns['posted_on'] = [
+            iso if isinstance(text, str) else value
+            for text, iso, value in zip(raw, iso8601_strs(raw),
+                                        columns['posted_on'])
+        ]
         return item
 
 
 class ForumItemExportPipeline:
     logger = logging.getLogger('pipelines.ForumItemExportPipeline')
+    write_queue = None
+    segments = None
+    compression = None
+    compression_level = None
 
     def __init__(self, **kwargs):
         for k, v in kwargs.items():
@@ -59,33 +128,54 @@ class ForumItemExportPipeline:
         kwargs = {
             'base_dir_path': crawler.settings.get('DATA_DIR'),
             'dirname_tmplt': crawler.settings.get('FORUM_DIR_TEMPLATE'),
-            'filename_tmplt': crawler.settings.get('FORUM_METADATA_TEMPLATE')
+            'filename_tmplt': crawler.settings.get('FORUM_METADATA_TEMPLATE'),
+            'write_queue': WriteQueue.from_crawler(crawler),
+            'segments': SegmentStore.from_crawler(crawler),
+            **compression_settings(crawler.settings)
         }
         return cls(**kwargs)
 
+    def close_spider(self, spider):
+        if self.write_queue is not None:
+            return self.write_queue.drain()
+
     def process_item(self, item, spider):
         # Only handle BaseForumItems
         if not isinstance(item, BaseForumItem):
             return item
 
-        adapter = ItemAdapter(item)
-        forum_id = adapter.get('forum_id')
+        return self.process_forum(item, ItemAdapter(item))
+
+    def process_forum(self, item, adapter):
+        return write(self.write_queue, item, self.export, adapter.asdict())
+
+    def export(self, data):
+        forum_id = data.get('forum_id')
         self.logger.debug(f'exporting ForumItem (id: {forum_id})')
 
+        if self.segments is not None:
+            forum_id = get_template_kwargs(data)['forum_id']
+            self.segments.append(forum_id, 'forum', forum_id, data)
+            self.logger.debug(f'exported ForumItem (id: {forum_id})')
+            return
+
         path = prepare_path(base_dir=self.base_dir_path,
                             dirname_template=self.dirname_tmplt,
                             filename_template=self.filename_tmplt,
-                            item=item)
-        with path.open('w') as wh:
-            json.dump(adapter.asdict(), wh)
+                            item=data)
+        with open_text(path, 'w', self.compression, self.compression_level,
+                       encoding='utf-8') as wh:
+            json.dump(data, wh, ensure_ascii=False)
 
         self.logger.debug(f'exported ForumItem (id: {forum_id})')
 
-        return item
-
 
 class TopicItemExportPipeline:
     logger = logging.getLogger('pipelines.TopicItemExportPipeline')
+    write_queue = None
+    segments = None
+    compression = None
+    compression_level = None
 
     def __init__(self, **kwargs):
         for k, v in kwargs.items():
@@ -98,79 +188,428 @@ class TopicItemExportPipeline:
         kwargs = {
             'base_dir_path': crawler.settings.get('DATA_DIR'),
             'dirname_tmplt': crawler.settings.get('TOPIC_DIR_TEMPLATE'),
-            'filename_tmplt': crawler.settings.get('TOPIC_METADATA_TEMPLATE')
+            'filename_tmplt': crawler.settings.get('TOPIC_METADATA_TEMPLATE'),
+            'write_queue': WriteQueue.from_crawler(crawler),
+            'segments': SegmentStore.from_crawler(crawler),
+            **compression_settings(crawler.settings)
         }
         return cls(**kwargs)
 
+    def close_spider(self, spider):
+        if self.write_queue is not None:
+            return self.write_queue.drain()
+
     def process_item(self, item, spider):
         # Only handle TopicItems
         if not isinstance(item, BaseTopicItem):
             return item
 
-        adapter = ItemAdapter(item)
-        topic_id = adapter.get('topic_id')
+        return self.process_topic(item, ItemAdapter(item))
+
+    def process_topic(self, item, adapter):
+        # Tagged for the topic to be recorded only if written, see `save_state`
+        return write(self.write_queue, item, self.export, adapter.asdict(),
+                     tag=adapter.get('topic_id'))
+
+    def export(self, data):
+        topic_id = data.get('topic_id')
         self.logger.debug(f'exporting TopicItem (id: {topic_id})')
 
+        if self.segments is not None:
+            self.segments.append(get_template_kwargs(data)['forum_id'],
+                                 'topic', topic_id, data)
+            self.logger.debug(f'exported TopicItem (id: {topic_id})')
+            return
+
         path = prepare_path(base_dir=self.base_dir_path,
                             dirname_template=self.dirname_tmplt,
                             filename_template=self.filename_tmplt,
-                            item=item)
-        with path.open('w') as wh:
-            json.dump(adapter.asdict(), wh)
+                            item=data)
+        with open_text(path, 'w', self.compression, self.compression_level,
+                       encoding='utf-8') as wh:
+            json.dump(data, wh, ensure_ascii=False)
 
         self.logger.debug(f'exported TopicItem (id: {topic_id})')
 
-        return item
-
 
 class CommentItemExportPipeline:
+    '''Write the comments of each topic to its CSV file.
+
+    Rows are buffered per topic and appended to the file every `chunk_rows`
+    rows, the first chunk of a topic overwriting the file of a previous
+    crawl. The buffer of a topic is released once its TopicCompletedItem
+    arrives. The rows of a topic announced by a TopicResumedItem, or of a
+    resumed TopicCommentsBatch, are appended to its file without the header
+    if the file exists. When more than `max_buffered_rows` rows are buffered
+    in all, the largest buffer is spilled to its file ahead of time.
+
+    With `segments` set, rows are appended to the forum's segments instead
+    (see `utils.segments`). Files are written by `write_queue` if set, in
+    which case `process_item` returns a Deferred fired once the writes of the
+    item are queued.
+
+    The `topic_state` of a TopicCompletedItem or TopicCommentsBatch is only
+    recorded in `topic_states` once the comments of the topic are written,
+    so that it never runs ahead of what was exported.
+    '''
     logger = logging.getLogger('pipelines.CommentItemExportPipeline')
+    chunk_rows = 500
+    max_buffered_rows = 100_000
+    stats = None
+    write_queue = None
+    segments = None
+    topic_states = None
+    compression = None
+    compression_level = None
 
     def __init__(self, **kwargs):
         for k, v in kwargs.items():
             setattr(self, k, v)
         self.comment_item_buffers = defaultdict(ItemBuffer)
+        # Topics whose file was (re)created during this crawl
+        self.started_topics = set()
+        # Topics whose rows are appended to the file of an earlier crawl
+        self.resumed_topics = set()
+        # Topics whose file was written by this process, maybe still queued
+        self.opened_topics = set()
+        self.buffered_rows = 0
+        self.peak_buffered_rows = 0
+        self.spilled_rows = 0
+        # Deferreds of the writes queued for the item being processed
+        self._queued = []
         self.logger.debug('initiated')
 
     @classmethod
     def from_crawler(cls, crawler):
         # Read params from settings
+        settings = crawler.settings
         kwargs = {
-            'base_dir_path': crawler.settings.get('DATA_DIR'),
-            'dirname_tmplt': crawler.settings.get('TOPIC_DIR_TEMPLATE'),
-            'filename_tmplt': crawler.settings.get('TOPIC_CONTENTS_TEMPLATE')
+            'base_dir_path': settings.get('DATA_DIR'),
+            'dirname_tmplt': settings.get('TOPIC_DIR_TEMPLATE'),
+            'filename_tmplt': settings.get('TOPIC_CONTENTS_TEMPLATE'),
+            'chunk_rows': settings.getint('COMMENT_EXPORT_CHUNK_ROWS',
+                                          cls.chunk_rows),
+            'max_buffered_rows': settings.getint(
+                'COMMENT_EXPORT_MAX_BUFFERED_ROWS', cls.max_buffered_rows
+            ),
+            'stats': crawler.stats,
+            'write_queue': WriteQueue.from_crawler(crawler),
+            'segments': SegmentStore.from_crawler(crawler),
+            'topic_states': TopicStates.from_crawler(crawler),
+            **compression_settings(crawler.settings)
         }
         return cls(**kwargs)
 
+    def close_spider(self, spider):
+        # Write what was scraped of topics left incomplete.
+        if self.comment_item_buffers:
+            self.logger.warning(f'{len(self.comment_item_buffers)} topics '
+                                'were not completed')
+        for topic_id in list(self.comment_item_buffers):
+            self.complete(topic_id)
+
+        self._queued.clear()
+        if self.write_queue is None:
+            return self._closed(None)
+        # The directories are made by the queued writes.
+        d = self.write_queue.drain()
+        d.addBoth(self._closed)
+        return d
+
+    def _closed(self, result):
+        clear_known_dirs()
+        self.update_stats()
+        return result
+
+    def update_stats(self):
+        if self.stats is None:
+            return
+        self.stats.set_value('comment_export/peak_buffered_rows',
+                             self.peak_buffered_rows)
+        self.stats.set_value('comment_export/spilled_rows',
+                             self.spilled_rows)
+        # Counted for all the export pipelines
+        self.stats.set_value('export/saved_dir_syscalls', saved_syscalls())
+
     def process_item(self, item, spider):
+        if isinstance(item, TopicCommentsBatch):
+            return self.process_batch(item)
+
         # Only handle CommentItems
         if not isinstance(item, BaseCommentItem):
             return item
 
         adapter = ItemAdapter(item)
-        topic_id = adapter.get('topic_id', 0)
-
         if isinstance(item, TopicCompletedItem):
-            self.logger.debug(f'exporting CommentItems (id: {topic_id})')
+            return self.process_completed(item, adapter)
+        if isinstance(item, TopicResumedItem):
+            return self.process_resumed(item, adapter)
+        return self.process_comment(item, adapter)
+
+    def process_comment(self, item, adapter):
+        # Remove excess spaces if comment is not Ascii Art.
+        if not adapter.get('is_aa') and not adapter.get('body'):
+            adapter['is_aa'] = False
+            EXPORTED_COMMENT_TEXT(adapter)
+
+        self.store(adapter.get('topic_id', 0), item)
+        return self.when_queued(item)
+
+    def process_completed(self, item, adapter):
+        self.complete(adapter.get('topic_id', 0))
+        item = self.when_queued(item)
+        self.save_state(adapter.get('topic_id', 0),
+                        adapter.get('topic_state'))
+        return item
 
-            path = prepare_path(base_dir=self.base_dir_path,
-                                dirname_template=self.dirname_tmplt,
-                                filename_template=self.filename_tmplt,
-                                item=dict(topic_id=topic_id))
+    def process_resumed(self, item, adapter):
+        self.resumed_topics.add(adapter.get('topic_id', 0))
+        return item
 
-            with path.open('w') as wh:
-                writer = csv.writer(wh)
-                for row in self.comment_item_buffers[topic_id]:
-                    writer.writerow(row)
+    def process_batch(self, item, adapter=None):
+        columns = item['columns']
+        is_aa, body = columns['is_aa'], columns['body']
+        normalize = EXPORTED_COMMENT_TEXT['body']
+        for i in range(item.num_comments):
+            # Remove excess spaces if comment is not Ascii Art.
+            if not is_aa[i] and not body[i]:
+                is_aa[i] = False
+                if isinstance(body[i], str):
+                    body[i] = normalize(body[i])
+
+        buffer = ItemBuffer()
+        buffer.store_columns(columns)
+        topic_id = item['topic_id']
+        topic_state = item.get('topic_state')
+        exist = item.get('resumed') and self.contents_exist(topic_id)
+        self.opened_topics.add(topic_id)
+        if exist:
+            item = write(self.write_queue, item, self.export, topic_id,
+                         buffer.detach(header=False), mode='a', tag=topic_id)
+        else:
+            item = write(self.write_queue, item, self.export, topic_id,
+                         buffer, tag=topic_id)
+        self.save_state(topic_id, topic_state)
+        return item
 
+    def save_state(self, topic_id, topic_state):
+        '''Record a (forum key, topic number, state) `topic_state` once the
+        writes queued so far are done, unless one of `topic_id` failed.'''
+        if topic_state is None or self.topic_states is None:
+            return
+        if self.write_queue is None:
+            self.topic_states.set(*topic_state)
+            return
+        # Failures of other topics are left to drain() in close_spider.
+        d = self.write_queue.wait()
+        d.addCallback(self._save_state_after, topic_id, topic_state)
+
+    def _save_state_after(self, _, topic_id, topic_state):
+        if self.write_queue.failed(topic_id):
+            # Fetched in full by the next crawl
+            self.logger.error(f'State of {topic_id} not recorded, its export '
+                              'failed')
+        else:
+            self.topic_states.set(*topic_state)
+
+    def store(self, topic_id, item):
+        buffer = self.comment_item_buffers[topic_id]
+        buffer.store(item)
+        self.buffered_rows += 1
+        if self.buffered_rows > self.peak_buffered_rows:
+            self.peak_buffered_rows = self.buffered_rows
+
+        if self.chunk_rows and len(buffer) >= self.chunk_rows:
+            self.flush(topic_id)
+        if self.max_buffered_rows and \
+                self.buffered_rows > self.max_buffered_rows:
+            self.spill()
+
+    def flush(self, topic_id):
+        '''Append the rows buffered for a topic to its file.'''
+        buffer = self.comment_item_buffers[topic_id]
+        if topic_id in self.started_topics:
+            rows = buffer.detach()
+            self.queue(self.export, topic_id, rows, mode='a', tag=topic_id)
+            self.buffered_rows -= len(rows)
+        elif topic_id in self.resumed_topics and \
+                self.contents_exist(topic_id):
+            rows = buffer.detach(header=False)
+            self.queue(self.export, topic_id, rows, mode='a', tag=topic_id)
+            self.started_topics.add(topic_id)
+            self.buffered_rows -= len(rows)
+        else:
+            rows = buffer.detach()
+            self.queue(self.export, topic_id, rows, tag=topic_id)
+            self.started_topics.add(topic_id)
+            # The header comes with the first row.
+            self.buffered_rows -= max(len(rows) - 1, 0)
+        self.opened_topics.add(topic_id)
+
+    def spill(self):
+        '''Flush the largest buffer to stay within `max_buffered_rows`.'''
+        topic_id = max(self.comment_item_buffers,
+                       key=lambda k: len(self.comment_item_buffers[k]))
+        rows = self.buffered_rows
+        self.flush(topic_id)
+        rows -= self.buffered_rows
+        self.logger.debug(f'spilled {rows} CommentItems (id: {topic_id})')
+        self.spilled_rows += rows
+
+    def complete(self, topic_id):
+        '''Write the rest of a topic's rows and release its buffer.'''
+        self.flush(topic_id)
+        del self.comment_item_buffers[topic_id]
+        self.started_topics.discard(topic_id)
+        self.resumed_topics.discard(topic_id)
+
+    def contents_exist(self, topic_id):
+        '''Return whether rows of the topic were exported, always True for
+        segments, which are only appended to. The file is only looked for
+        when this process hasn't written it, as its writes may be queued.'''
+        if self.segments is not None or topic_id in self.opened_topics:
+            return True
+        path = prepare_path(base_dir=self.base_dir_path,
+                            dirname_template=self.dirname_tmplt,
+                            filename_template=self.filename_tmplt,
+                            item=dict(topic_id=topic_id))
+        return compressed_path(path, self.compression).exists()
+
+    def queue(self, func, *args, **kwargs):
+        d = write(self.write_queue, None, func, *args, **kwargs)
+        if d is not None:
+            self._queued.append(d)
+
+    def when_queued(self, item):
+        '''Return `item`, or a Deferred fired with it once the writes queued
+        while processing it are.'''
+        if not self._queued:
+            return item
+        d = defer.gatherResults(self._queued)
+        self._queued = []
+        d.addCallback(lambda _: item)
+        return d
+
+    def export(self, topic_id, rows, mode='w'):
+        '''Write the rows of the comments on a topic, header first.'''
+        self.logger.debug(f'exporting CommentItems (id: {topic_id})')
+
+        if self.segments is not None:
+            # Rows written with 'w' replace those of a previous crawl.
+            self.segments.append(get_parent_id(topic_id), 'comments',
+                                 topic_id, [list(row) for row in rows],
+                                 first=mode == 'w')
             self.logger.debug(f'exported CommentItems (id: {topic_id})')
+            return
 
-        else:
-            # Remove excess spaces if comment is not Ascii Art.
-            if not adapter.get('is_aa') and not adapter.get('body'):
-                adapter['is_aa'] = False
-                remove_excess_spaces(item, 'body')
+        path = prepare_path(base_dir=self.base_dir_path,
+                            dirname_template=self.dirname_tmplt,
+                            filename_template=self.filename_tmplt,
+                            item=dict(topic_id=topic_id))
 
-            self.comment_item_buffers[topic_id].store(item)
+        with open_text(path, mode, self.compression,
+                       self.compression_level) as wh:
+            writer = csv.writer(wh)
+            for row in rows:
+                writer.writerow(row)
 
-        return item
+        self.logger.debug(f'exported CommentItems (id: {topic_id})')
+
+
+class ItemRouterPipeline:
+    '''Run the handlers of `DatetimePipeline` and the export pipelines that
+    act on each item, in their order, in place of these pipelines.
+
+    Handlers are found by the class of the item once, and given the item and
+    its ItemAdapter, built once for all of them. The result of the last one,
+    the item or a Deferred fired with it, is returned. The items and the time
+    spent in each handler are counted in the stats as
+    ``item_router/{handler}/items`` and ``item_router/{handler}/seconds``
+    when the spider closes.
+    '''
+    logger = logging.getLogger('pipelines.ItemRouterPipeline')
+    stats = None
+
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+        # Handlers by item base class, first match wins
+        self.routes = [
+            (BaseForumItem, [
+                ('forum_export', self.forum_pipeline.process_forum)
+            ]),
+            (BaseTopicItem, [
+                ('topic_datetime', self.datetime_pipeline.process_topic),
+                ('topic_export', self.topic_pipeline.process_topic)
+            ]),
+            (TopicCompletedItem, [
+                ('topic_completed', self.comment_pipeline.process_completed)
+            ]),
+            (TopicResumedItem, [
+                ('topic_resumed', self.comment_pipeline.process_resumed)
+            ]),
+            (BaseCommentItem, [
+                ('comment_datetime', self.datetime_pipeline.process_comment),
+                ('comment_export', self.comment_pipeline.process_comment)
+            ]),
+            (TopicCommentsBatch, [
+                ('batch_datetime', self.datetime_pipeline.process_batch),
+                ('batch_export', self.comment_pipeline.process_batch)
+            ])
+        ]
+        # Handlers by item class, filled as new classes come
+        self.table = {}
+        self.items = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.logger.debug('initiated')
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        kwargs = {
+            'datetime_pipeline': DatetimePipeline(),
+            'forum_pipeline': ForumItemExportPipeline.from_crawler(crawler),
+            'topic_pipeline': TopicItemExportPipeline.from_crawler(crawler),
+            'comment_pipeline':
+                CommentItemExportPipeline.from_crawler(crawler),
+            'stats': crawler.stats
+        }
+        return cls(**kwargs)
+
+    def close_spider(self, spider):
+        self.update_stats()
+        return defer.DeferredList([
+            defer.maybeDeferred(pipeline.close_spider, spider)
+            for pipeline in (self.forum_pipeline, self.topic_pipeline,
+                             self.comment_pipeline)
+        ], fireOnOneErrback=True, consumeErrors=True)
+
+    def update_stats(self):
+        if self.stats is None:
+            return
+        for name, count in self.items.items():
+            self.stats.set_value(f'item_router/{name}/items', count)
+            self.stats.set_value(f'item_router/{name}/seconds',
+                                 round(self.seconds[name], 6))
+
+    def handlers(self, item_cls):
+        '''Return the handlers of the items of `item_cls`.'''
+        handlers = self.table.get(item_cls)
+        if handlers is None:
+            handlers = next((handlers for base, handlers in self.routes
+                             if issubclass(item_cls, base)), [])
+            self.table[item_cls] = handlers
+        return handlers
+
+    def process_item(self, item, spider):
+        handlers = self.handlers(type(item))
+        if not handlers:
+            return item
+
+        adapter = ItemAdapter(item)
+        result = item
+        for name, handler in handlers:
+            start = time.perf_counter()
+            result = handler(item, adapter)
+            self.seconds[name] += time.perf_counter() - start
+            self.items[name] += 1
+        return result
@@ -28,6 +28,7 @@ def generate_settings(site, data_dir, site_params_path, start_time):
     # Dir settings
     settings['IMAGES_STORE'] = str(data_dir/'images')
     settings['DAILY_DIR'] = str(daily_dir)
+    settings['HISTORY_DIR'] = str(data_dir/site/'HISTORY')
     settings['DATA_DIR'] = str(daily_dir/'data')
 
     # Templates
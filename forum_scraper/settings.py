@@ -46,10 +46,83 @@ DOWNLOADER_MIDDLEWARES = {
 
 # Configure item pipelines
 # See https://doc.scrapy.org/en/latest/topics/item-pipeline.html
+# ItemRouterPipeline runs DatetimePipeline and the export pipelines in one.
 ITEM_PIPELINES = {
-    'scrapy.pipelines.images.ImagesPipeline': 1,
-    'forum_scraper.pipelines.DatetimePipeline': 300,
-    'forum_scraper.pipelines.ForumItemExportPipeline': 700,
-    'forum_scraper.pipelines.TopicItemExportPipeline': 710,
-    'forum_scraper.pipelines.CommentItemExportPipeline': 720
+    'forum_scraper.pipelines.CommentImagesPipeline': 1,
+    'forum_scraper.pipelines.ItemRouterPipeline': 300
 }
+
+# Reload the site params JSON file if it changed, checked when a spider opens
+# and every N seconds (0 only checks when a spider opens).
+SITE_PARAMS_CHECK_INTERVAL = 1.0
+
+# Flush crawl history to disk every N seconds and every N new records, so that
+# an interrupted crawl is resumed from there (0 disables either trigger).
+HISTORY_CHECKPOINT_INTERVAL = 300
+HISTORY_CHECKPOINT_ITEMS = 1000
+
+# Memory for the history shards (one per forum/blog) loaded at once. The least
+# recently used shards are written back and unloaded beyond it.
+HISTORY_MEMORY_BUDGET = 256 * 1024 * 1024
+# Open history shards at once, each holding a couple of files. The least
+# recently used are closed beyond it, however little memory they take.
+HISTORY_MAX_OPEN_SHARDS = 256
+
+# Bloom filter in front of the crawl history, so that new URLs skip the exact
+# lookups. Sized for HISTORY_BLOOM_CAPACITY records (about 1.2 bytes each at
+# 1%), 0 disables it.
+HISTORY_BLOOM_ERROR_RATE = 0.01
+HISTORY_BLOOM_CAPACITY = 10_000_000
+
+# How comment items are built: 'loader' runs CommentLoader, 'compiled' gives
+# the same items without the loader machinery, several times faster.
+COMMENT_ITEM_BUILDER = 'loader'
+
+# Send the comments of a topic through the pipelines as one
+# TopicCommentsBatch, instead of one item per comment.
+COMMENT_BATCHES = False
+
+# Parse topics in this many worker processes instead of the reactor thread,
+# with at most PARSE_POOL_MAX_IN_FLIGHT topics sent to them at once.
+# 0 parses on the reactor thread.
+PARSE_POOL_WORKERS = 0
+PARSE_POOL_MAX_IN_FLIGHT = 8
+
+# Only request the bytes added to the .dat of the active 2ch topics since the
+# last crawl, whose size and comment count are kept in the history dir. The
+# whole .dat is fetched again when it shrank or was rewritten.
+DAT_RANGE_REQUESTS = True
+
+# Likewise, only request the posts of the active 5ch topics numbered after the
+# last one fetched (read.cgi `{n}-n`), and append them to the exported topic.
+READ_CGI_RANGE_REQUESTS = True
+
+# Don't request the active topics whose comment count in the topic list is
+# the one kept by the above, so that an unchanged forum costs a list download.
+SKIP_UNCHANGED_TOPICS = True
+
+# Append the comments of a topic to its file every COMMENT_EXPORT_CHUNK_ROWS
+# rows (0 writes them once the topic is completed), and spill the largest
+# topic to its file when more than COMMENT_EXPORT_MAX_BUFFERED_ROWS rows are
+# buffered in all (0 for no limit).
+COMMENT_EXPORT_CHUNK_ROWS = 500
+COMMENT_EXPORT_MAX_BUFFERED_ROWS = 100_000
+
+# Write exported files in a background thread with at most EXPORT_QUEUE_SIZE
+# writes pending, beyond which the export pipelines wait (0 writes them in
+# the pipelines).
+EXPORT_QUEUE_SIZE = 100
+
+# 'directories' exports a directory of files per topic, 'segments' appends
+# the records of each forum to rolling segments of SEGMENT_MAX_BYTES with an
+# offset index (see forum_scraper.utils.segments). The files of at most
+# SEGMENT_MAX_OPEN forums are open at once.
+EXPORT_LAYOUT = 'directories'
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+SEGMENT_MAX_OPEN = 64
+
+# Compress the exported files with 'gzip' or 'zstd' (needs `zstandard`) at
+# EXPORT_COMPRESSION_LEVEL, None for the codec's default. None writes plain
+# files. See corvid.utils.compression to read them back.
+EXPORT_COMPRESSION = None
+EXPORT_COMPRESSION_LEVEL = None
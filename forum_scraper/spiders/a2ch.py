@@ -1,38 +1,63 @@
 # -*- coding: utf-8 -*-
 
-from collections import namedtuple
-import json
+import inspect
 import re
 
 import scrapy
-from scrapy import Selector
 from urllib.parse import urljoin, urlparse
 
+from corvid.utils.history import TopicStates
 from .. import items
 from ..items import (
     ForumItem,
+    ActiveCommentItem,
     ActiveTopicItem,
     ArchivedTopicItem,
-    TopicCompletedItem
+    TopicCommentsBatch,
+    TopicCompletedItem,
+    TopicResumedItem
 )
-from ..loaders import ForumLoader, CommentLoader, TopicLoader
+from ..loaders import ForumLoader, TopicLoader, load_comment_item
+from ..utils.dat import (
+    dat_delta,
+    find_images,
+    find_replies,
+    listed_count,
+    parse_dat,
+    range_headers
+)
+from ..utils.parse_pool import ParsePool
+from ..utils.site_params import site_params
 from ..utils.urlutil import forum_id_from_url
-from ..utils.pipelines import DATETIME_PTTRN
 
 
 class A2chSpider(scrapy.spiders.Spider):
     name = '2ch'
-    row_tuple = namedtuple('Row', ['uname', 'mail', 'body',
-                                   'title', 'date', 'uid'])
+    # Pool of processes to parse topics in, when PARSE_POOL_WORKERS > 0
+    parse_pool = None
+    # Size, comment counts and metadata of the .dat of active topics last
+    # fetched, to only request what was added since, when DAT_RANGE_REQUESTS
+    topic_states = None
+    # Not to request the active topics listing as many comments as last time
+    skip_unchanged = False
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        site_params.watch(crawler)
+        spider.parse_pool = ParsePool.from_crawler(crawler)
+        if crawler.settings.getbool('DAT_RANGE_REQUESTS', True):
+            spider.topic_states = TopicStates.from_crawler(crawler)
+        spider.skip_unchanged = \
+            crawler.settings.getbool('SKIP_UNCHANGED_TOPICS', True)
+        return spider
 
     def start_requests(self):
-        with open(self.settings.get('SITE_PARAMS_PATH'), 'r') as rh:
-            site_params = json.load(rh)
+        site_params.configure(self.settings.get('SITE_PARAMS_PATH'))
+        sites = site_params.sites_named(self.name)
 
-        self.target_forums = {site['target_forums'] for site in site_params
-                              if site['name'] == self.name}
-        bbs_table = ''.join([site['bbs_table']for site in site_params
-                             if site['name'] == self.name])
+        self.target_forums = {site['target_forums'] for site in sites}
+        bbs_table = ''.join([site['bbs_table'] for site in sites])
         if not bbs_table:
             raise ValueError(
                 f'no `bbs_table` for {self.name} in the site params JSON file'
@@ -82,12 +107,35 @@ class A2chSpider(scrapy.spiders.Spider):
     def parse_active_list(self, response, **kwargs):
         '''Parse URLs for active topics.'''
 
-        for topic_url in response.css('.trad > a::attr(href)'):
-            m = re.match(r'\d+', topic_url.get())
+        for link in response.css('.trad > a'):
+            m = re.match(r'\d+', link.attrib.get('href', ''))
             if m is not None:
                 kwargs['topic_num'] = m.group(0)
-                yield response.follow(f'dat/{m.group(0)}.dat',
-                                      self.parse_topic, cb_kwargs=kwargs)
+                request = self.follow_dat(
+                    response, f'dat/{m.group(0)}.dat', kwargs,
+                    listed_count(''.join(link.css('::text').getall()))
+                )
+                if request is not None:
+                    yield request
+
+    def follow_dat(self, response, url, kwargs, count=None):
+        '''Follow to the .dat of an active topic, only requesting the bytes
+        added since it was last fetched if it was. Return None if the topic
+        lists `count` comments, as many as then.'''
+        state = self.get_topic_state(kwargs)
+        if self.is_unchanged(state, count):
+            return None
+        if count is not None:
+            # Recorded with the state, see `with_state`
+            kwargs = {**kwargs, 'listed_count': count}
+        if state is None:
+            return response.follow(url, self.parse_topic, cb_kwargs=kwargs)
+
+        self.inc_stat('dat_range/requests')
+        return response.follow(url, self.parse_topic, cb_kwargs=kwargs,
+                               headers=range_headers(state['offset']),
+                               meta={'dat_state': state,
+                                     'handle_httpstatus_list': [416]})
 
     def parse_archive_list(self, response, **kwargs):
         '''Parse URLs for active topics.'''
@@ -123,23 +171,120 @@ class A2chSpider(scrapy.spiders.Spider):
                                  cb_kwargs=kwargs)
 
     def parse_topic(self, response, **kwargs):
-        body = [r for r in response.text.split('\n')
-                if r and not r.startswith('過去ログ')]
+        state = None if self.topic_states is None \
+            else response.meta.get('dat_state')
+        if state is not None:
+            delta = dat_delta(response.status, response.headers,
+                              response.body, state['offset'])
+            if delta is None:
+                # Shrunk or rewritten, fetch it all again.
+                self.inc_stat('dat_range/fallbacks')
+                return [scrapy.Request(response.url, self.parse_topic,
+                                       cb_kwargs=kwargs, dont_filter=True)]
+
+            self.inc_stat('dat_range/saved_bytes', state['offset'] - 1)
+            if not delta:
+                self.inc_stat('dat_range/unchanged')
+                return []
+            # Parse the new rows only, numbered after the known ones.
+            kwargs = {**kwargs, 'resume': state}
+            response = response.replace(body=delta,
+                                        encoding=state['encoding'])
+            offset = state['offset'] + len(delta)
+        else:
+            offset = len(response.body)
+
+        if self.parse_pool is not None:
+            # Parse in a worker process, see `ParsePool`.
+            result = self.parse_pool.run(self, 'parse_topic', response,
+                                         kwargs)
+        else:
+            result = self._parse_topic(response, **kwargs)
+
+        if self.topic_states is None \
+                or kwargs['thd_item_cls'] is not ActiveTopicItem:
+            return result
+        if inspect.iscoroutine(result):
+            return self._with_state_after(result, kwargs, offset,
+                                          response.encoding)
+        return self.with_state(result, kwargs, offset, response.encoding)
+
+    def is_unchanged(self, state, count):
+        '''Return whether a topic lists `count` comments, as it did when its
+        `state` was recorded.'''
+        if not self.skip_unchanged or state is None or count is None:
+            return False
+        self.inc_stat('topic_counts/hits')
+        if count != state.get('listed_count'):
+            return False
+        self.inc_stat('topic_counts/skipped')
+        return True
+
+    def get_topic_state(self, kwargs):
+        if self.topic_states is None \
+                or kwargs['thd_item_cls'] is not ActiveTopicItem:
+            return None
+        return self.topic_states.get(kwargs['forum_id'],
+                                     int(kwargs['topic_num']))
+
+    def with_state(self, items, kwargs, offset, encoding):
+        '''Yield the items parsed from the .dat of an active topic, with
+        its state set on the item completing it, for the comment export
+        pipeline to record once they are written. The state holds the
+        metadata of the topic as loaded.'''
+        state = {'offset': offset, 'encoding': encoding,
+                 'listed_count': kwargs.get('listed_count')}
+        resume = kwargs.get('resume')
+        num_comments = 0 if resume is None else resume['num_comments']
+        for item in items:
+            if isinstance(item, ActiveTopicItem):
+                # Before the pipelines format them
+                for field in ('topic_title', 'posted_on', 'last_comment_on'):
+                    state[field] = item.get(field)
+            elif isinstance(item, ActiveCommentItem):
+                num_comments += 1
+            elif isinstance(item, TopicCommentsBatch):
+                num_comments += item.num_comments
+            if isinstance(item, (TopicCompletedItem, TopicCommentsBatch)):
+                item['topic_state'] = (
+                    kwargs['forum_id'], int(kwargs['topic_num']),
+                    {**state, 'num_comments': num_comments}
+                )
+            yield item
+
+    async def _with_state_after(self, coro, kwargs, offset, encoding):
+        return list(self.with_state(await coro, kwargs, offset, encoding))
+
+    def inc_stat(self, key, count=1):
+        crawler = getattr(self, 'crawler', None)
+        if crawler is not None:
+            crawler.stats.inc_value(key, count)
+
+    def _parse_topic(self, response, **kwargs):
+        rows = parse_dat(response.text)
         topic_url = (f'http://{urlparse(response.url).netloc}/test/read.cgi/'
                      f'{kwargs["forum_id"]}/{kwargs["topic_num"]}/')
+        # State of a previous fetch when `rows` were appended since
+        resume = kwargs.get('resume')
 
         tl = TopicLoader(item=kwargs['thd_item_cls'](), response=response)
         # Basic identity
         tl.add_value('site', '2ch')
         tl.add_value('topic_id', response.url)
         tl.add_value('topic_url', topic_url)
-        first_row = self._decompose_row(body[0])
-        tl.add_value('topic_title', first_row.title)
         # Metadata
-        tl.add_value('posted_on', first_row.date)
-        tl.add_value('last_comment_on',
-                     [self._decompose_row(row).date for row in body[-20:]])
-        tl.add_value('num_comments', str(min(len(body), 1000)))
+        if resume is None:
+            tl.add_value('topic_title', rows[0].title)
+            tl.add_value('posted_on', rows[0].date)
+            tl.add_value('last_comment_on', [row.date for row in rows[-20:]])
+            num_comments = len(rows)
+        else:
+            tl.add_value('topic_title', resume['topic_title'])
+            tl.add_value('posted_on', resume['posted_on'])
+            tl.add_value('last_comment_on', [resume['last_comment_on']]
+                         + [row.date for row in rows[-20:]])
+            num_comments = resume['num_comments'] + len(rows)
+        tl.add_value('num_comments', str(min(num_comments, 1000)))
         tl.add_value('reported_size', None)
         # Foreign keys
         tl.add_value('forum_id', kwargs['forum_id'])
@@ -148,53 +293,48 @@ class A2chSpider(scrapy.spiders.Spider):
 
         thd_item_name = kwargs['thd_item_cls'].__name__
         cmt_cls = getattr(items, thd_item_name.replace('Topic', 'Comment'))
-        yield from self.parse_comments(body, item['topic_id'], topic_url,
-                                       cmt_cls)
+        yield from self.parse_comments(rows, item['topic_id'], topic_url,
+                                       cmt_cls, num_comments - len(rows) + 1)
 
-    def parse_comments(self, body, topic_id, topic_url, cmt_item_cls):
-        i = 1
-        for row in body:
-            row = self._decompose_row(row)
-            body_html = Selector(text=row.body)
-
-            cl = CommentLoader(cmt_item_cls(), selector=body_html)
-            # Basic identity
-            cl.add_value('site', '2ch')
-            cl.add_value('comment_id', topic_id)
-            cl.add_value('comment_id', str(i))
-            cl.add_value('comment_url', topic_url)
-            cl.add_value('comment_url', str(i))
-            # Metadata
-            cl.add_value('posted_on_raw', row.date)
-            cl.add_value('user_id', row.uid)
-            cl.add_value('user_name', row.uname)
-            cl.add_value('body', row.body)
-            p_res = r'(\.{2})?/test/read.cgi/\w+/\d+/\d+/?'
-            cl.add_value('reply_to', re.findall(p_res, row.body))
-            cl.add_value('is_aa', False)
-            p_img = r'\bhttps?://[\w/\.]+\.(?:png|gif|jpg)\b'
-            cl.add_value('image_urls', re.findall(p_img, row.body))
-            # Foreign keys
-            cl.add_value('topic_id', topic_id)
-            yield cl.load_item()
-            i += 1
+    def parse_comments(self, rows, topic_id, topic_url, cmt_item_cls,
+                       start=1):
+        compiled = self.settings.get('COMMENT_ITEM_BUILDER') == 'compiled'
+        # Comments to send at once, or None to send them one by one.
+        batch = [] if self.settings.getbool('COMMENT_BATCHES') else None
+        if start > 1 and batch is None:
+            # Added to the comments exported by an earlier crawl
+            yield TopicResumedItem(comment_id=-1, topic_id=topic_id)
+        for i, row in enumerate(rows, start):
+            values = {
+                # Basic identity
+                'site': '2ch',
+                'comment_id': [topic_id, str(i)],
+                'comment_url': [topic_url, str(i)],
+                # Metadata
+                'posted_on_raw': row.date,
+                'user_id': row.uid,
+                'user_name': row.uname,
+                'body': row.body,
+                'reply_to': find_replies(row.body),
+                'is_aa': False,
+                'image_urls': find_images(row.body),
+                # Foreign keys
+                'topic_id': topic_id
+            }
+            item = load_comment_item(cmt_item_cls(), values, compiled)
+            if batch is None:
+                yield item
+            else:
+                batch.append(item)
+
+        if batch is not None:
+            batch = TopicCommentsBatch.from_comments(topic_id, cmt_item_cls,
+                                                     batch)
+            if start > 1:
+                batch['resumed'] = True
+            yield batch
+            return
 
         yield TopicCompletedItem(comment_id=-1,
                                  topic_id=topic_id,
                                  posted_on_raw='2001/01/01(日) 00:00:00.00')
-
-    def _decompose_row(self, row):
-        if not isinstance(row, str):
-            raise TypeError
-        data = row.split('<>')
-        date_uid = data.pop(2)
-        m = re.match(DATETIME_PTTRN, date_uid)
-        date = m.group(0) if m is not None else None
-        m2 = re.search(r'([^: ]+)$', date_uid)
-        uid = m2.group(0) if m2 is not None else None
-        data = [seg.strip() if isinstance(seg, str) else ''
-                for seg in data + [date, uid]]
-        try:
-            return self.row_tuple(*data)
-        except Exception as e:
-            raise Exception(e, data + [date_uid])
@@ -1,31 +1,59 @@
 # -*- coding: utf-8 -*-
-import json
+
+import inspect
 
 import scrapy
 
+from corvid.utils.history import TopicStates
 from .. import items
 from ..items import (
     ForumItem,
+    ActiveCommentItem,
     ActiveTopicItem,
     ArchivedTopicItem,
-    TopicCompletedItem
+    TopicCommentsBatch,
+    TopicCompletedItem,
+    TopicResumedItem
+)
+from ..loaders import ForumLoader, TopicLoader, load_comment_item
+from ..utils.dat import listed_count
+from ..utils.parse_pool import ParsePool
+from ..utils.site_params import site_params
+from ..utils.urlutil import (
+    forum_id_from_url,
+    topic_key_from_url,
+    topic_range_url
 )
-from ..loaders import ForumLoader, CommentLoader, TopicLoader
-from ..utils.urlutil import forum_id_from_url
 
 
 class A5chSpider(scrapy.spiders.Spider):
     name = '5ch'
     allowed_domains = ['5ch.net']
+    # Pool of processes to parse topics in, when PARSE_POOL_WORKERS > 0
+    parse_pool = None
+    # Last comment number and metadata of the active topics last fetched, to
+    # only request the posts added since, when READ_CGI_RANGE_REQUESTS
+    topic_states = None
+    # Not to request the active topics listing as many comments as last time
+    skip_unchanged = False
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        site_params.watch(crawler)
+        spider.parse_pool = ParsePool.from_crawler(crawler)
+        if crawler.settings.getbool('READ_CGI_RANGE_REQUESTS', True):
+            spider.topic_states = TopicStates.from_crawler(crawler)
+        spider.skip_unchanged = \
+            crawler.settings.getbool('SKIP_UNCHANGED_TOPICS', True)
+        return spider
 
     def start_requests(self):
-        with open(self.settings.get('SITE_PARAMS_PATH'), 'r') as rh:
-            site_params = json.load(rh)
+        site_params.configure(self.settings.get('SITE_PARAMS_PATH'))
+        sites = site_params.sites_named(self.name)
 
-        self.target_forums = {site['target_forums'] for site in site_params
-                              if site['name'] == self.name}
-        bbs_table = ''.join([site['bbs_table']for site in site_params
-                             if site['name'] == self.name])
+        self.target_forums = {site['target_forums'] for site in sites}
+        bbs_table = ''.join([site['bbs_table'] for site in sites])
         if not bbs_table:
             raise ValueError(
                 f'no `bbs_table` for {self.name} in the site params JSON file'
@@ -59,36 +87,153 @@ class A5chSpider(scrapy.spiders.Spider):
         # Scrape active topics
         actv_kwargs = {'forum_id': item['forum_id'],
                        'tpc_item_cls': ActiveTopicItem,
-                       'css_selector': '.trad > a::attr(href)'}
+                       'css_selector': '.trad > a'}
         yield response.follow('subback.html', self.parse_list,
                               cb_kwargs=actv_kwargs)
 
         # Scrape archived topics
         arch_kwargs = {'forum_id': item['forum_id'],
                        'tpc_item_cls': ArchivedTopicItem,
-                       'css_selector': '.title > a::attr(href)'}
+                       'css_selector': '.title > a'}
         yield response.follow('kako/kako0000.html', self.parse_list,
                               cb_kwargs=arch_kwargs)
 
     def parse_list(self, response, **kwargs):
         '''Parse URLs for active topics.'''
-        for topic_url in response.css(kwargs['css_selector']):
-            yield response.follow(topic_url.get(), self.parse_topic,
-                                  cb_kwargs=kwargs)
+        for link in response.css(kwargs['css_selector']):
+            # The link text of active topics ends with their comment count
+            count = listed_count(''.join(link.css('::text').getall()))
+            request = self.follow_topic(response, link.attrib.get('href', ''),
+                                        kwargs, count)
+            if request is not None:
+                yield request
+
+    def follow_topic(self, response, url, kwargs, count=None):
+        '''Follow to a topic, only requesting the posts added since it was
+        last fetched if it is an active one that was. Return None if it lists
+        `count` comments, as many as then.'''
+        url = response.urljoin(url)
+        state = self.get_topic_state(url, kwargs)
+        if self.is_unchanged(state, count):
+            return None
+        if count is not None:
+            # Recorded with the state, see `with_state`
+            kwargs = {**kwargs, 'listed_count': count}
+        range_url = None if state is None \
+            else topic_range_url(url, state['last_comment'] + 1)
+        if range_url is None:
+            return scrapy.Request(url, self.parse_topic, cb_kwargs=kwargs)
+
+        self.inc_stat('read_cgi_range/requests')
+        return scrapy.Request(range_url, self.parse_topic,
+                              cb_kwargs={**kwargs, 'resume': state})
 
     def parse_topic(self, response, **kwargs):
+        if self.parse_pool is not None:
+            # Parse in a worker process, see `ParsePool`.
+            result = self.parse_pool.run(self, 'parse_topic', response,
+                                         kwargs)
+        else:
+            result = self._parse_topic(response, **kwargs)
+
+        if self.topic_states is None \
+                or kwargs['tpc_item_cls'] is not ActiveTopicItem:
+            return result
+        if inspect.iscoroutine(result):
+            return self._with_state_after(result, kwargs)
+        return self.with_state(result, kwargs)
+
+    def is_unchanged(self, state, count):
+        '''Return whether a topic lists `count` comments, as it did when its
+        `state` was recorded.'''
+        if not self.skip_unchanged or state is None or count is None:
+            return False
+        self.inc_stat('topic_counts/hits')
+        if count != state.get('listed_count'):
+            return False
+        self.inc_stat('topic_counts/skipped')
+        return True
+
+    def get_topic_state(self, url, kwargs):
+        if self.topic_states is None \
+                or kwargs['tpc_item_cls'] is not ActiveTopicItem:
+            return None
+        key = topic_key_from_url(url)
+        return None if key is None else self.topic_states.get(*key)
+
+    def with_state(self, items, kwargs):
+        '''Yield the items parsed from an active topic, with its state set
+        on the item completing it, for the comment export pipeline to record
+        once they are written. The state holds the metadata of the topic as
+        loaded. Nothing is parsed from a topic without new posts, whose state
+        is kept.'''
+        resume = kwargs.get('resume')
+        state = key = None
+        last_comment = 0 if resume is None else resume['last_comment']
+        for item in items:
+            if isinstance(item, ActiveTopicItem):
+                # Before the pipelines format them
+                state = {'topic_url': item.get('topic_url'),
+                         'listed_count': kwargs.get('listed_count')}
+                for field in ('topic_title', 'posted_on', 'last_comment_on'):
+                    state[field] = item.get(field)
+                key = topic_key_from_url(item['topic_url'])
+            elif isinstance(item, ActiveCommentItem):
+                last_comment = max(last_comment,
+                                   comment_number(item['comment_id']))
+            elif isinstance(item, TopicCommentsBatch):
+                last_comment = max(
+                    [last_comment]
+                    + [comment_number(comment_id) for comment_id
+                       in item['columns']['comment_id']]
+                )
+            if key is not None and \
+                    isinstance(item, (TopicCompletedItem, TopicCommentsBatch)):
+                item['topic_state'] = (*key, {**state,
+                                              'last_comment': last_comment})
+            yield item
+
+        if state is None and resume is not None:
+            self.inc_stat('read_cgi_range/unchanged')
+
+    async def _with_state_after(self, coro, kwargs):
+        return list(self.with_state(await coro, kwargs))
+
+    def inc_stat(self, key, count=1):
+        crawler = getattr(self, 'crawler', None)
+        if crawler is not None:
+            crawler.stats.inc_value(key, count)
+
+    def _parse_topic(self, response, **kwargs):
         '''Parse and extract metadata from single topic.
         Then call self.parse_comments.
         '''
+        posts = response.css('div.topic > div.post')
+        # State of a previous fetch when only the posts added since were
+        # requested, see `follow_topic`.
+        resume = kwargs.get('resume')
+        if resume is not None:
+            posts = [post for post in posts
+                     if int(post.css('.number::text').re_first(r'\d+', '0'))
+                     > resume['last_comment']]
+            if not posts:
+                return
+        topic_url = response.url if resume is None else resume['topic_url']
+
         tl = TopicLoader(item=kwargs['tpc_item_cls'](), response=response)
         # Basic identity
         tl.add_value('site', '5ch')
         tl.add_value('topic_id', response.url)
-        tl.add_value('topic_url', response.url)
+        tl.add_value('topic_url', topic_url)
         tl.add_css('topic_title', 'title::text')
         # Metadata
-        tl.add_css('posted_on', '#1 > .meta > .date::text')
-        tl.add_css('last_comment_on', '.topic .date::text')
+        if resume is None:
+            tl.add_css('posted_on', '#1 > .meta > .date::text')
+            tl.add_css('last_comment_on', '.topic .date::text')
+        else:
+            tl.add_value('posted_on', resume['posted_on'])
+            tl.add_value('last_comment_on', [resume['last_comment_on']]
+                         + [post.css('.date::text').get() for post in posts])
         stats = response.css('.pagestats .meta::text').getall()
         tl.add_value('num_comments', stats)
         tl.add_value('reported_size', stats)
@@ -100,29 +245,61 @@ class A5chSpider(scrapy.spiders.Spider):
         # Get a proper CommentItem class from matome.items
         tpc_item_name = kwargs['tpc_item_cls'].__name__
         cmt_cls = getattr(items, tpc_item_name.replace('Topic', 'Comment'))
-        yield from self.parse_comments(response, item['topic_id'], cmt_cls)
-
-    def parse_comments(self, response, topic_id, cmt_item_cls):
-        for comment in response.css('div.topic > div.post'):
-            cl = CommentLoader(cmt_item_cls(), selector=comment)
-            # Basic identity
-            cl.add_value('site', '5ch')
-            cl.add_value('comment_id', topic_id)
-            cl.add_css('comment_id', '.number::text')
-            cl.add_value('comment_url', response.url)
-            cl.add_css('comment_url', '.number::text')
-            # Metadata
-            cl.add_css('posted_on_raw', '.date::text')
-            cl.add_css('user_id', '.uid', re=r'ID:([^<]+)<')
-            cl.add_css('user_name', '.name b::text')
-            cl.add_css('body', '.escaped')
-            cl.add_css('reply_to', '.reply_link::attr(href)')
-            cl.add_css('is_aa', '.AA')
-            cl.add_css('image_urls', '.image::attr(href)')
-            # Foreign keys
-            cl.add_value('topic_id', topic_id)
-            yield cl.load_item()
+        yield from self.parse_comments(response, item['topic_id'], cmt_cls,
+                                       posts, topic_url, resume is not None)
+
+    def parse_comments(self, response, topic_id, cmt_item_cls, posts=None,
+                       topic_url=None, resumed=False):
+        '''Parse `posts` (all those of `response` by default), the comments
+        added since a previous crawl if `resumed`.'''
+        if posts is None:
+            posts = response.css('div.topic > div.post')
+        if topic_url is None:
+            topic_url = response.url
+        compiled = self.settings.get('COMMENT_ITEM_BUILDER') == 'compiled'
+        # Comments to send at once, or None to send them one by one.
+        batch = [] if self.settings.getbool('COMMENT_BATCHES') else None
+        if resumed and batch is None:
+            # Added to the comments exported by an earlier crawl
+            yield TopicResumedItem(comment_id=-1, topic_id=topic_id)
+        for comment in posts:
+            number = comment.css('.number::text').getall()
+            values = {
+                # Basic identity
+                'site': '5ch',
+                'comment_id': [topic_id, *number],
+                'comment_url': [topic_url, *number],
+                # Metadata
+                'posted_on_raw': comment.css('.date::text').getall(),
+                'user_id': comment.css('.uid').re(r'ID:([^<]+)<'),
+                'user_name': comment.css('.name b::text').getall(),
+                'body': comment.css('.escaped').getall(),
+                'reply_to': comment.css('.reply_link::attr(href)').getall(),
+                'is_aa': comment.css('.AA').getall(),
+                'image_urls': comment.css('.image::attr(href)').getall(),
+                # Foreign keys
+                'topic_id': topic_id
+            }
+            item = load_comment_item(cmt_item_cls(), values, compiled)
+            if batch is None:
+                yield item
+            else:
+                batch.append(item)
+
+        if batch is not None:
+            batch = TopicCommentsBatch.from_comments(topic_id, cmt_item_cls,
+                                                     batch)
+            if resumed:
+                batch['resumed'] = True
+            yield batch
+            return
 
         yield TopicCompletedItem(comment_id=-1,
                                  topic_id=topic_id,
                                  posted_on_raw='2001/01/01(日) 00:00:00.00')
+
+
+def comment_number(comment_id):
+    '''Return the number of a comment from its ID, 0 if it has none.'''
+    num = str(comment_id).rsplit('_', 1)[-1]
+    return int(num) if num.isdigit() else 0
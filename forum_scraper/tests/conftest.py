@@ -4,3 +4,9 @@ import os
 import sys
 proj_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, proj_dir)
+
+# `forum_scraper.utils.site_params` reads the site params on first use.
+os.environ.setdefault(
+    'SITE_PARAMS_PATH',
+    os.path.join(os.path.dirname(__file__), 'data', 'site_params.json')
+)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from scrapy import Selector
+
+from forum_scraper.items import ArchivedCommentItem
+from forum_scraper.loaders import build_comment_item, load_comment_item
+from .statics import TOPIC_URL, VALID_DATETIME, VALID_TOPIC_ID
+
+POST_HTML = '''
+<div class="post" id="72">
+  <div class="meta">
+    <span class="number">72</span>
+    <span class="name"><b> 名無しさん </b></span>
+    <span class="date">2019/04/12(金) 19:12:51.87</span>
+    <span class="uid">ID:AbCdEfGh0</span>
+  </div>
+  <div class="message">
+    <span class="escaped"> <a href="https://hayabusa9.5ch.net/test/read.cgi\
+/mnewsplus/1596250713/1" class="reply_link">&gt;&gt;1</a>
+    本文 <span class="AA">(´・ω・｀)</span><img src="x.png">
+    <a href="http://jump.5ch.net/?http://imgur.com/abc.jpg" class="image">
+    http://imgur.com/abc.jpg</a> </span>
+  </div>
+</div>
+'''
+
+
+def css_values(html):
+    '''The values `A5chSpider.parse_comments` gets from a post.'''
+    post = Selector(text=html)
+    number = post.css('.number::text').getall()
+    return {
+        'site': '5ch',
+        'comment_id': [VALID_TOPIC_ID, *number],
+        'comment_url': [TOPIC_URL, *number],
+        'posted_on_raw': post.css('.date::text').getall(),
+        'user_id': post.css('.uid').re(r'ID:([^<]+)<'),
+        'user_name': post.css('.name b::text').getall(),
+        'body': post.css('.escaped').getall(),
+        'reply_to': post.css('.reply_link::attr(href)').getall(),
+        'is_aa': post.css('.AA').getall(),
+        'image_urls': post.css('.image::attr(href)').getall(),
+        'topic_id': VALID_TOPIC_ID
+    }
+
+
+DAT_VALUES = {
+    'site': '2ch',
+    'comment_id': [VALID_TOPIC_ID, '1'],
+    'comment_url': [TOPIC_URL, '1'],
+    'posted_on_raw': VALID_DATETIME,
+    'user_id': 'AbCdEfGh0',
+    'user_name': '名無しさん',
+    'body': ' 本文 <br> http://i.imgur.com/abc.jpg ',
+    'reply_to': ['..', ''],
+    'is_aa': False,
+    'image_urls': ['http://i.imgur.com/abc.jpg'],
+    'topic_id': VALID_TOPIC_ID
+}
+
+
+class TestBuildCommentItem:
+
+    @pytest.mark.parametrize('values', [
+        css_values(POST_HTML),
+        css_values('<div class="post"></div>'),
+        DAT_VALUES,
+        dict(DAT_VALUES, comment_id=[VALID_TOPIC_ID, '12345']),
+        dict(DAT_VALUES, body='', user_id='', posted_on_raw=None),
+        dict(DAT_VALUES, body=['\n', '<span>a</span>'], user_name=['', 'b']),
+        dict(DAT_VALUES, is_aa=[None, '', 0], reply_to=[], image_urls=None),
+        dict(DAT_VALUES, is_aa='', comment_id=[], comment_url=['']),
+        dict(DAT_VALUES, image_urls=['http://imgur.com/a.gif', 'foo', None]),
+    ])
+    def test_same_as_loader(self, values):
+        expected = load_comment_item(ArchivedCommentItem(), values)
+        actual = build_comment_item(ArchivedCommentItem(), values)
+        assert dict(actual) == dict(expected)
+
+    def test_values(self):
+        item = build_comment_item(ArchivedCommentItem(),
+                                  css_values(POST_HTML))
+        assert item['comment_id'] == 'mnewsplus_1596250713_0072'
+        assert item['comment_url'] == f'{TOPIC_URL}/72'
+        assert item['image_urls'] == ['https://i.imgur.com/abc.jpg']
+        assert item['is_aa'] is True
+        assert '<span' not in item['body'] and '<img' not in item['body']
+
+    def test_compiled(self):
+        item = load_comment_item(ArchivedCommentItem(), DAT_VALUES,
+                                 compiled=True)
+        assert item['comment_id'] == 'mnewsplus_1596250713_0001'
+
+    def test_invalid_field(self):
+        with pytest.raises(KeyError):
+            build_comment_item(ArchivedCommentItem(), {'foo': 'bar'})
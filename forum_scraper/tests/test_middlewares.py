@@ -1,39 +1,92 @@
 # -*- conding: utf-8 -*-
-from copy import deepcopy
 from pathlib import Path
 import pytest
 from unittest.mock import Mock
 
 from scrapy.exceptions import IgnoreRequest
 
+from twisted.internet import defer
+
 from forum_scraper.items import (
     BaseForumItem,
     BaseCommentItem,
-    ArchivedTopicItem
+    ArchivedTopicItem,
+    TopicCompletedItem
 )
-from forum_scraper.middlewares import DownloaderMiddleware
-from forum_scraper.utils.exceptions import (
+from forum_scraper.middlewares import ForumDownloaderMiddleware
+from corvid.utils.history import TopicStates, URLHistory
+from corvid.utils.exceptions import (
     BlacklistedURLException,
     ExpiredURLException,
     AlreadyScrapedURLsException
 )
 
 
+BLACKLIST = [
+    'https://agree.5ch.net/mango',
+    'https://qb5.5ch.net/saku2ch',
+    'https://mao.5ch.net/accuse',
+    'https://headline.5ch.net/bbypinkH0/',
+    'https://headline.5ch.net/bbypinkH1/'
+]
+EXPIRED_URLS = [
+    'https://mao.5ch.net/test/read.cgi/bass/1579960729/',
+    'https://egg.5ch.net/test/read.cgi/ruins/1491723120/'
+]
+SCRAPED_URLS = [
+    'https://mao.5ch.net/test/read.cgi/bass/1579960720/',
+    'https://mao.5ch.net/test/read.cgi/bass/1579960721/',
+    'https://mao.5ch.net/test/read.cgi/bass/1579960722/'
+]
+
+
 @pytest.fixture
-def mock_mw():
+def mock_mw(tmp_path):
     tests_dir = Path(__file__).parents[0] / 'data'
     fake_date = '2020_0101'
-    last_dir_name = tests_dir / 'LATEST' / 'latest.txt'
+    last_dir_name = tmp_path / 'LATEST' / 'latest.txt'
+    last_dir_name.parent.mkdir()
     daily_dir_name = tests_dir / fake_date
     with open(last_dir_name, 'w') as wh:
         wh.write(str(daily_dir_name))
 
-    return DownloaderMiddleware(last_dir_name, daily_dir_name)
+    mw = ForumDownloaderMiddleware(last_dir_name, daily_dir_name,
+                                   tmp_path / 'HISTORY',
+                                   checkpoint_interval=0, checkpoint_items=10)
+    # Recorded in single URL stores, moved to the sharded topic stores when
+    # the spider opens.
+    URLHistory(mw.history_dir, 'expired_urls').update(EXPIRED_URLS)
+    URLHistory(mw.history_dir, 'scraped_urls').update(SCRAPED_URLS)
+    mw.spider_opened(Mock())
+    mw.blacklist.update(BLACKLIST)
+    return mw
+
+
+class HeldQueue:
+    '''WriteQueue finishing the writes queued when `run` is called, with
+    those tagged `failed_tags` failed.'''
+
+    def __init__(self):
+        self.drains = []
+        self.failed_tags = set()
+
+    def wait(self):
+        self.drains.append(defer.Deferred())
+        return self.drains[-1]
+
+    def failed(self, tag):
+        return tag in self.failed_tags
+
+    def run(self):
+        drains, self.drains = self.drains, []
+        for d in drains:
+            d.callback(None)
 
 
 class MockRequest:
-    def __init__(self, url):
+    def __init__(self, url, meta=None):
         self.url = url
+        self.meta = {} if meta is None else meta
 
 
 class MockResponse:
@@ -42,6 +95,38 @@ class MockResponse:
         self.url = url
 
 
+def scrape_topic(mw, url, item=None):
+    '''Send the items of an archived topic, up to its exported comments.'''
+    response = MockResponse(200, url)
+    mw.item_scraped(ArchivedTopicItem() if item is None else item, response,
+                    Mock())
+    mw.item_scraped(TopicCompletedItem(comment_id=-1), response, Mock())
+
+
+class TestDownloaderMiddlewareMigration:
+
+    def test_migrate_pickles(self, mock_mw):
+        # Imported from blacklist.pickle in the latest daily dir
+        assert 'https://mercury.bbspink.com/pinkj/' in mock_mw.blacklist
+        assert 'https://phoebe.bbspink.com/pinkplus/' in mock_mw.blacklist
+
+    def test_migrate_flat_urls(self, mock_mw):
+        assert ('5ch_bass', 1579960729) in mock_mw.expired_topics
+        assert ('5ch_ruins', 1491723120) in mock_mw.expired_topics
+        assert len(mock_mw.scraped_topics) == len(SCRAPED_URLS)
+        assert not (mock_mw.history_dir / 'scraped_urls.log').exists()
+
+    @pytest.mark.parametrize('url', [
+        'https://mao.5ch.net/test/read.cgi/bass/1579960720',
+        'https://mao.5ch.net/test/read.cgi/bass/1579960720/l50',
+        'https://mao.5ch.net/bass/dat/1579960720.dat'
+    ])
+    def test_topic_url_forms(self, url, mock_mw):
+        # Any URL of a scraped topic is skipped.
+        with pytest.raises(AlreadyScrapedURLsException):
+            mock_mw.process_request(MockRequest(url), Mock())
+
+
 class TestDownloaderMiddlewareProcRequese:
     @pytest.mark.parametrize('url', [
         'https://mao.5ch.net/test/read.cgi/bass/1579966729/',
@@ -52,42 +137,26 @@ class TestDownloaderMiddlewareProcRequese:
         request = MockRequest(url)
         assert mock_mw.process_request(request, Mock()) is None
 
-    @pytest.mark.parametrize('url', [
-        'https://agree.5ch.net/mango',
-        'https://qb5.5ch.net/saku2ch',
-        'https://mao.5ch.net/accuse',
-        'https://headline.5ch.net/bbypinkH0/',
-        'https://headline.5ch.net/bbypinkH1/'
-    ])
+    @pytest.mark.parametrize('url', BLACKLIST)
     def test_blacklist(self, url, mock_mw):
         request = MockRequest(url)
-        try:
+        with pytest.raises(BlacklistedURLException) as e:
             mock_mw.process_request(request, Mock())
-        except BlacklistedURLException as e:
-            assert isinstance(e, IgnoreRequest)
+        assert isinstance(e.value, IgnoreRequest)
 
-    @pytest.mark.parametrize('url', [
-        'https://mao.5ch.net/test/read.cgi/bass/1579960729/',
-        'https://egg.5ch.net/test/read.cgi/ruins/1491723120/'
-    ])
+    @pytest.mark.parametrize('url', EXPIRED_URLS)
     def test_expired(self, url, mock_mw):
         request = MockRequest(url)
-        try:
+        with pytest.raises(ExpiredURLException) as e:
             mock_mw.process_request(request, Mock())
-        except ExpiredURLException as e:
-            assert isinstance(e, IgnoreRequest)
+        assert isinstance(e.value, IgnoreRequest)
 
-    @pytest.mark.parametrize('url', [
-        'https://mao.5ch.net/test/read.cgi/bass/1579960720/',
-        'https://mao.5ch.net/test/read.cgi/bass/1579960721/',
-        'https://mao.5ch.net/test/read.cgi/bass/1579960722/'
-    ])
+    @pytest.mark.parametrize('url', SCRAPED_URLS)
     def test_scraped(self, url, mock_mw):
         request = MockRequest(url)
-        try:
+        with pytest.raises(AlreadyScrapedURLsException) as e:
             mock_mw.process_request(request, Mock())
-        except AlreadyScrapedURLsException as e:
-            assert isinstance(e, IgnoreRequest)
+        assert isinstance(e.value, IgnoreRequest)
 
 
 class TestDownloaderMiddlewareProcResponse:
@@ -117,19 +186,27 @@ class TestDownloaderMiddlewareProcResponse:
             url in mock_mw.blacklist
             assert isinstance(e, IgnoreRequest)
 
-    @pytest.mark.parametrize('url,status,forum_id', [
-        ('http://host.5ch.net/test/read.cgi/foo/45678900', 400, 'foo'),
-        ('http://host.5ch.net/test/read.cgi/bar/56789121/', 403, 'bar'),
-        ('http://host.5ch.net/test/read.cgi/foobar/12122124/', 410, 'foobar')
+    @pytest.mark.parametrize('url,status', [
+        ('http://host.5ch.net/test/read.cgi/foo/45678900', 400),
+        ('http://host.5ch.net/test/read.cgi/bar/56789121/', 403),
+        ('http://host.5ch.net/test/read.cgi/foobar/12122124/', 410)
     ])
-    def test_expired(self, url, status, forum_id, mock_mw):
+    def test_expired(self, url, status, mock_mw):
         request = MockRequest(url)
         response = MockResponse(status)
-        try:
+        with pytest.raises(ExpiredURLException) as e:
             mock_mw.process_response(request, response, Mock())
-        except ExpiredURLException as e:
-            url == mock_mw.expired_urls[forum_id][0]
-            assert isinstance(e, IgnoreRequest)
+        assert mock_mw.get_topic(url) in mock_mw.expired_topics
+        assert isinstance(e.value, IgnoreRequest)
+
+    def test_handled_status(self, mock_mw):
+        # A Range request past the end of a .dat file
+        url = 'http://host.5ch.net/test/read.cgi/foo/45678900'
+        request = MockRequest(url, {'handle_httpstatus_list': [416]})
+        response = MockResponse(416)
+        assert mock_mw.process_response(request, response, Mock()) \
+            is response
+        assert mock_mw.get_topic(url) not in mock_mw.expired_topics
 
 
 class FakeForumItem(BaseForumItem):
@@ -146,50 +223,182 @@ class TestDownloaderMiddlewareItemScraped:
         ('https://host.5ch.net/test/read.cgi/thditem/45678900', 'thditem')
     ])
     def test_topic_item(self, url, topic_id, mock_mw):
-        response = MockResponse(200, url)
-        item = ArchivedTopicItem(topic_id=topic_id)
-        len_before = len(mock_mw.scraped_urls.get(topic_id, []))
+        len_before = len(mock_mw.scraped_topics)
 
-        mock_mw.item_scraped(item, response, Mock())
-        assert mock_mw.scraped_urls.get(topic_id) is not None
-        assert len(mock_mw.scraped_urls[topic_id]) == len_before + 1
-        assert mock_mw.scraped_urls[topic_id][0] == url
+        scrape_topic(mock_mw, url, ArchivedTopicItem(topic_id=topic_id))
+        assert ('5ch_thditem', 45678900) in mock_mw.scraped_topics
+        assert len(mock_mw.scraped_topics) == len_before + 1
 
     def test_another_item_type(self, mock_mw):
-        scraped_urls_before = deepcopy(mock_mw.scraped_urls)
+        scraped_before = list(mock_mw.scraped_topics)
         response = spider = Mock()
 
         item = FakeCommentItem()
         mock_mw.item_scraped(item, response, spider)
-        assert mock_mw.scraped_urls == scraped_urls_before
+        assert list(mock_mw.scraped_topics) == scraped_before
 
         item = FakeForumItem()
         mock_mw.item_scraped(item, response, spider)
-        assert mock_mw.scraped_urls == scraped_urls_before
+        assert list(mock_mw.scraped_topics) == scraped_before
 
 
 class TestDownloaderMiddlewareSpiderClosed:
 
-    def test_is_trimed(self, mock_mw, mocker):
-        to_pickle = mocker.patch('forum_scraper.middlewares.to_pickle')
-
+    def test_is_persisted(self, mock_mw):
         for i in range(1100):
             fake_url = f'http://host.5ch.net/test/read.cgi/fake/{i:0>6}/'
-            mock_mw.scraped_urls['fake'].add_url(fake_url)
-            mock_mw.expired_urls['fake'].add_url(fake_url)
+            scrape_topic(mock_mw, fake_url)
+            mock_mw._record('expired', fake_url)
 
-        scrpd_urls = mock_mw.scraped_urls['fake']
-        exprd_urls = mock_mw.expired_urls['fake']
         mock_mw.spider_closed(Mock(), 'for test')
-        assert len(scrpd_urls) == 1000
-        assert scrpd_urls.pivot_url == scrpd_urls[0]
-        assert len(exprd_urls) == 1000
-        assert exprd_urls.pivot_url == exprd_urls[0]
-
-        to_pickle.assert_any_call(mock_mw.blacklist,
-                                  mock_mw.daily_dir/'blacklist.pickle')
-        to_pickle.assert_any_call(mock_mw.scraped_urls,
-                                  mock_mw.daily_dir/'scraped_urls.pickle')
-        to_pickle.assert_any_call(mock_mw.expired_urls,
-                                  mock_mw.daily_dir/'expired_urls.pickle')
-        assert to_pickle.call_count == 3
+
+        with mock_mw.latest_dir_pointer.open() as rh:
+            assert rh.read() == str(mock_mw.daily_dir.resolve())
+
+        # History is not trimmed and is readable by the next run.
+        reopened = ForumDownloaderMiddleware(mock_mw.latest_dir_pointer,
+                                             mock_mw.daily_dir,
+                                             mock_mw.history_dir)
+        assert len(reopened.scraped_topics) == 1100 + len(SCRAPED_URLS)
+        assert len(reopened.expired_topics) == 1100 + len(EXPIRED_URLS)
+        assert all(url in reopened.blacklist for url in BLACKLIST)
+        assert ('5ch_fake', 0) in reopened.scraped_topics
+
+
+class TestDownloaderMiddlewareCheckpoint:
+
+    def test_checkpoint_by_items(self, mock_mw):
+        mock_mw.latest_dir_pointer.write_text('')
+        urls = [f'http://host.5ch.net/test/read.cgi/fake/{i}/'
+                for i in range(25)]
+        for url in urls:
+            scrape_topic(mock_mw, url)
+
+        # Checkpointed after the 10th and the 20th record.
+        assert mock_mw._uncheckpointed == 5
+        with mock_mw.latest_dir_pointer.open() as rh:
+            assert rh.read() == str(mock_mw.daily_dir.resolve())
+
+        # Killed before `spider_closed`: the next run starts from the last
+        # checkpoint.
+        reopened = ForumDownloaderMiddleware(mock_mw.latest_dir_pointer,
+                                             mock_mw.daily_dir,
+                                             mock_mw.history_dir)
+        assert all(mock_mw.get_topic(url) in reopened.scraped_topics
+                   for url in urls[:20])
+
+
+    def test_crash_before_comments(self, mock_mw):
+        mock_mw.write_queue = HeldQueue()
+        url = 'http://host.5ch.net/test/read.cgi/fake/12345/'
+        response = MockResponse(200, url)
+        mock_mw.item_scraped(ArchivedTopicItem(), response, Mock())
+        mock_mw.checkpoint()
+
+        def scraped_on_restart():
+            reopened = ForumDownloaderMiddleware(mock_mw.latest_dir_pointer,
+                                                 mock_mw.daily_dir,
+                                                 mock_mw.history_dir)
+            return mock_mw.get_topic(url) in reopened.scraped_topics
+
+        # Killed while the comments were buffered
+        assert not scraped_on_restart()
+
+        # Or still being written
+        mock_mw.item_scraped(TopicCompletedItem(comment_id=-1), response,
+                             Mock())
+        mock_mw.checkpoint()
+        assert not scraped_on_restart()
+
+        mock_mw.write_queue.run()
+        assert scraped_on_restart()
+
+    def test_failed_export(self, mock_mw):
+        mock_mw.write_queue = HeldQueue()
+        urls = [f'http://host.5ch.net/test/read.cgi/fake/{n}/'
+                for n in (12345, 12346)]
+        for n, url in zip((12345, 12346), urls):
+            response = MockResponse(200, url)
+            mock_mw.item_scraped(ArchivedTopicItem(), response, Mock())
+            mock_mw.item_scraped(
+                TopicCompletedItem(comment_id=-1, topic_id=f'fake_{n}'),
+                response, Mock()
+            )
+        mock_mw.write_queue.failed_tags.add('fake_12345')
+        mock_mw.checkpoint()
+        mock_mw.write_queue.run()
+        assert mock_mw.get_topic(urls[0]) not in mock_mw.scraped_topics
+        assert mock_mw.get_topic(urls[1]) in mock_mw.scraped_topics
+
+        # Later checkpoints record the topics written since
+        url = 'http://host.5ch.net/test/read.cgi/fake/12347/'
+        response = MockResponse(200, url)
+        mock_mw.item_scraped(ArchivedTopicItem(), response, Mock())
+        mock_mw.item_scraped(
+            TopicCompletedItem(comment_id=-1, topic_id='fake_12347'),
+            response, Mock()
+        )
+        mock_mw.checkpoint()
+        mock_mw.write_queue.run()
+        assert mock_mw.get_topic(url) in mock_mw.scraped_topics
+
+    def test_topic_states(self, mock_mw):
+        mock_mw.topic_states = TopicStates(mock_mw.history_dir/'topic_states')
+        mock_mw.topic_states.set('5ch_fake', 12345, {'last_comment': 3})
+        mock_mw.checkpoint()
+
+        reopened = TopicStates(mock_mw.history_dir/'topic_states')
+        assert reopened.get('5ch_fake', 12345) == {'last_comment': 3}
+
+
+class TestBloomFilter:
+
+    @pytest.fixture
+    def bloom_mw(self, mock_mw):
+        # Reopen the history of `mock_mw` with a Bloom filter built from it.
+        mock_mw.checkpoint()
+        mw = ForumDownloaderMiddleware(
+            mock_mw.latest_dir_pointer, mock_mw.daily_dir,
+            mock_mw.history_dir, checkpoint_interval=0, checkpoint_items=10,
+            bloom_error_rate=0.01, bloom_capacity=1000
+        )
+        mw.stats = Mock()
+        mw.spider_opened(Mock())
+        return mw
+
+    def test_is_built(self, bloom_mw):
+        assert len(bloom_mw.bloom) == \
+            sum(len(store) for store in bloom_mw._history_stores())
+
+    @pytest.mark.parametrize('url,err', [
+        (BLACKLIST[0], BlacklistedURLException),
+        (EXPIRED_URLS[0], ExpiredURLException),
+        (SCRAPED_URLS[0], AlreadyScrapedURLsException)
+    ])
+    def test_hit(self, bloom_mw, url, err):
+        with pytest.raises(err):
+            bloom_mw.process_request(Mock(url=url), Mock())
+
+    def test_miss(self, bloom_mw):
+        url = 'https://mao.5ch.net/test/read.cgi/bass/1579960799/'
+        assert bloom_mw.process_request(Mock(url=url), Mock()) is None
+        assert bloom_mw.bloom.misses >= 1
+
+        bloom_mw.spider_closed(Mock(), 'finished')
+        bloom_mw.stats.set_value.assert_any_call(
+            'history/bloom/misses', bloom_mw.bloom.misses
+        )
+
+    @pytest.mark.parametrize('blacklist', [True, False])
+    def test_one_probe(self, bloom_mw, blacklist):
+        if not blacklist:
+            bloom_mw.blacklist = URLHistory(bloom_mw.history_dir, 'empty')
+        url = 'https://mao.5ch.net/test/read.cgi/bass/1579960799/'
+        bloom_mw.process_request(Mock(url=url), Mock())
+        assert bloom_mw.bloom.hits + bloom_mw.bloom.misses == 1
+
+    def test_recorded(self, bloom_mw):
+        url = 'https://mao.5ch.net/test/read.cgi/bass/1579960799/'
+        scrape_topic(bloom_mw, url)
+        with pytest.raises(AlreadyScrapedURLsException):
+            bloom_mw.process_request(Mock(url=url), Mock())
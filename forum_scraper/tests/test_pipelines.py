@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+import csv
+import io
+
+import pytest
+
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer
+
+from corvid.utils.compression import open_export
+from corvid.utils.history import TopicStates
+from forum_scraper.items import (
+    ArchivedCommentItem,
+    ArchivedTopicItem,
+    ForumItem,
+    TopicCommentsBatch,
+    TopicCompletedItem,
+    TopicResumedItem
+)
+from forum_scraper.pipelines import (
+    CommentImagesPipeline,
+    CommentItemExportPipeline,
+    DatetimePipeline,
+    ForumItemExportPipeline,
+    ItemRouterPipeline,
+    TopicItemExportPipeline
+)
+from forum_scraper.utils.segments import SegmentStore, read_topic
+from .statics import TOPIC_URL, VALID_DATETIME, VALID_TOPIC_ID
+
+
+def make_comments():
+    return [
+        ArchivedCommentItem(
+            site='5ch', comment_id=f'{VALID_TOPIC_ID}_0001',
+            comment_url=f'{TOPIC_URL}/1', posted_on_raw=VALID_DATETIME,
+            user_id='AbCd', body='本文  <br> 本文', is_aa=False,
+            reply_to=['mnewsplus_1596250713_0001'],
+            image_urls=['https://i.imgur.com/a.jpg',
+                        'https://i.imgur.com/b.jpg'],
+            topic_id=VALID_TOPIC_ID
+        ),
+        ArchivedCommentItem(
+            site='5ch', comment_id=f'{VALID_TOPIC_ID}_0002',
+            comment_url=f'{TOPIC_URL}/2', posted_on_raw='あぼーん',
+            body='', topic_id=VALID_TOPIC_ID
+        ),
+        ArchivedCommentItem(
+            site='5ch', comment_id=f'{VALID_TOPIC_ID}_0003',
+            comment_url=f'{TOPIC_URL}/3', body=' (´・ω・｀) ', is_aa=True,
+            image_urls=['https://i.imgur.com/c.jpg'], topic_id=VALID_TOPIC_ID
+        )
+    ]
+
+
+@pytest.fixture
+def export_pipeline(tmp_path):
+    return CommentItemExportPipeline(
+        base_dir_path=str(tmp_path), dirname_tmplt='{forum_id}/{topic_id}',
+        filename_tmplt='{topic_id}_contents.csv'
+    )
+
+
+class HeldQueue:
+    '''WriteQueue holding the writes until `run` is called.'''
+
+    def __init__(self):
+        self.jobs = []
+        self.failed_tags = set()
+
+    def submit(self, func, *args, tag=None, **kwargs):
+        self.jobs.append((func, args, kwargs, tag))
+        return defer.succeed(None)
+
+    def drain(self):
+        done = defer.Deferred()
+        self.jobs.append((done.callback, (None,), {}, None))
+        return done
+
+    wait = drain
+
+    def failed(self, tag):
+        return tag in self.failed_tags
+
+    def run(self):
+        jobs, self.jobs = self.jobs, []
+        for func, args, kwargs, _ in jobs:
+            func(*args, **kwargs)
+
+
+def contents_path(tmp_path):
+    return (tmp_path / 'mnewsplus' / VALID_TOPIC_ID
+            / f'{VALID_TOPIC_ID}_contents.csv')
+
+
+class TestTopicCommentsBatch:
+
+    def test_columns(self):
+        comments = make_comments()
+        batch = TopicCommentsBatch.from_comments(
+            VALID_TOPIC_ID, ArchivedCommentItem, comments
+        )
+        assert batch.num_comments == 3
+        assert list(batch['columns']) == list(ArchivedCommentItem.fields)
+        assert batch['columns']['is_aa'] == [False, None, True]
+        assert list(batch.comments()) == comments
+
+
+class TestCommentPipelines:
+
+    def test_same_as_items(self, tmp_path, export_pipeline):
+        datetime_pipeline = DatetimePipeline()
+        for item in make_comments() + [
+            TopicCompletedItem(comment_id=-1, topic_id=VALID_TOPIC_ID)
+        ]:
+            item = datetime_pipeline.process_item(item, None)
+            export_pipeline.process_item(item, None)
+        expected = contents_path(tmp_path).read_bytes()
+        contents_path(tmp_path).unlink()
+
+        batch = TopicCommentsBatch.from_comments(
+            VALID_TOPIC_ID, ArchivedCommentItem, make_comments()
+        )
+        batch = datetime_pipeline.process_item(batch, None)
+        export_pipeline.process_item(batch, None)
+        assert contents_path(tmp_path).read_bytes() == expected
+
+
+class TestCommentItemExportPipeline:
+
+    def export(self, pipeline, comments):
+        for item in comments:
+            pipeline.process_item(item, None)
+        for topic_id in sorted({item['topic_id'] for item in comments}):
+            pipeline.process_item(
+                TopicCompletedItem(comment_id=-1, topic_id=topic_id), None
+            )
+
+    def make_topics(self):
+        '''Comments of 2 topics, interleaved.'''
+        comments = []
+        for comment in make_comments() * 3:
+            for topic_id in (VALID_TOPIC_ID, f'{VALID_TOPIC_ID}0'):
+                comments.append(comment.copy())
+                comments[-1]['topic_id'] = topic_id
+        return comments
+
+    def read_all(self, tmp_path):
+        return {path.name: path.read_bytes()
+                for path in sorted(tmp_path.glob('**/*.csv'))}
+
+    @pytest.mark.parametrize('kwargs', [
+        {'chunk_rows': 2},
+        {'chunk_rows': 0, 'max_buffered_rows': 4},
+        {'chunk_rows': 5, 'max_buffered_rows': 1}
+    ])
+    def test_chunks(self, tmp_path, kwargs):
+        pipeline = CommentItemExportPipeline(
+            base_dir_path=str(tmp_path / 'whole'),
+            dirname_tmplt='{forum_id}/{topic_id}',
+            filename_tmplt='{topic_id}_contents.csv', chunk_rows=0,
+            max_buffered_rows=0
+        )
+        self.export(pipeline, self.make_topics())
+        expected = self.read_all(tmp_path / 'whole')
+        assert len(expected) == 2
+        assert pipeline.peak_buffered_rows == 18
+
+        pipeline = CommentItemExportPipeline(
+            base_dir_path=str(tmp_path / 'chunked'),
+            dirname_tmplt='{forum_id}/{topic_id}',
+            filename_tmplt='{topic_id}_contents.csv', **kwargs
+        )
+        self.export(pipeline, self.make_topics())
+        assert self.read_all(tmp_path / 'chunked') == expected
+        assert pipeline.comment_item_buffers == {}
+        assert pipeline.buffered_rows == 0
+        assert pipeline.peak_buffered_rows < 18
+
+    def test_segments(self, tmp_path, export_pipeline):
+        export_pipeline.chunk_rows = 2
+        self.export(export_pipeline, make_comments())
+        expected = contents_path(tmp_path).read_bytes()
+
+        segments = SegmentStore(tmp_path / 'segments', 1 << 20)
+        export_pipeline.segments = segments
+        self.export(export_pipeline, make_comments())
+        segments.close()
+        rows = read_topic(tmp_path / 'segments' / 'mnewsplus',
+                          VALID_TOPIC_ID)['comments']
+        out = io.StringIO()
+        csv.writer(out).writerows(rows)
+        assert out.getvalue().encode() == expected
+
+    def test_compression(self, tmp_path, export_pipeline):
+        export_pipeline.chunk_rows = 2
+        self.export(export_pipeline, make_comments())
+        expected = contents_path(tmp_path).read_bytes()
+        contents_path(tmp_path).unlink()
+
+        export_pipeline.compression = 'gzip'
+        self.export(export_pipeline, make_comments())
+        assert not contents_path(tmp_path).exists()
+        with open_export(contents_path(tmp_path), newline='') as rh:
+            assert rh.read().encode() == expected
+
+    def test_overwrite(self, tmp_path, export_pipeline):
+        contents_path(tmp_path).parent.mkdir(parents=True)
+        contents_path(tmp_path).write_text('previous crawl\n')
+        export_pipeline.chunk_rows = 2
+        self.export(export_pipeline, make_comments())
+        assert 'previous crawl' not in contents_path(tmp_path).read_text()
+
+    @pytest.mark.parametrize('chunk_rows', [0, 1])
+    def test_resumed(self, tmp_path, export_pipeline, chunk_rows):
+        comments = make_comments()
+        export_pipeline.chunk_rows = chunk_rows
+        self.export(export_pipeline, comments)
+        expected = contents_path(tmp_path).read_bytes()
+
+        # Appended without the header when the file exists
+        self.export(export_pipeline, comments[:2])
+        export_pipeline.process_item(
+            TopicResumedItem(comment_id=-1, topic_id=VALID_TOPIC_ID), None
+        )
+        self.export(export_pipeline, comments[2:])
+        assert contents_path(tmp_path).read_bytes() == expected
+        assert export_pipeline.resumed_topics == set()
+
+        # Written with it otherwise, by a later crawl
+        contents_path(tmp_path).unlink()
+        pipeline = CommentItemExportPipeline(
+            base_dir_path=str(tmp_path), dirname_tmplt='{forum_id}/{topic_id}',
+            filename_tmplt='{topic_id}_contents.csv', chunk_rows=chunk_rows
+        )
+        pipeline.process_item(
+            TopicResumedItem(comment_id=-1, topic_id=VALID_TOPIC_ID), None
+        )
+        self.export(pipeline, comments)
+        assert contents_path(tmp_path).read_bytes() == expected
+
+    def test_resumed_queued(self, tmp_path, export_pipeline):
+        comments = make_comments()
+        self.export(export_pipeline, comments)
+        expected = contents_path(tmp_path).read_bytes()
+        contents_path(tmp_path).unlink()
+
+        # The file isn't written yet when the topic is resumed.
+        export_pipeline.write_queue = HeldQueue()
+        self.export(export_pipeline, comments[:2])
+        export_pipeline.process_item(
+            TopicResumedItem(comment_id=-1, topic_id=VALID_TOPIC_ID), None
+        )
+        self.export(export_pipeline, comments[2:])
+        assert not contents_path(tmp_path).exists()
+        export_pipeline.write_queue.run()
+        assert contents_path(tmp_path).read_bytes() == expected
+
+    @pytest.mark.parametrize('batches', [False, True])
+    def test_topic_state(self, tmp_path, export_pipeline, batches):
+        export_pipeline.topic_states = states = \
+            TopicStates(tmp_path / 'topic_states')
+        export_pipeline.write_queue = HeldQueue()
+        topic_state = ('5ch_mnewsplus', 1596250713, {'last_comment': 3})
+        if batches:
+            batch = TopicCommentsBatch.from_comments(
+                VALID_TOPIC_ID, ArchivedCommentItem, make_comments()
+            )
+            batch['topic_state'] = topic_state
+            export_pipeline.process_item(batch, None)
+        else:
+            for item in make_comments():
+                export_pipeline.process_item(item, None)
+            export_pipeline.process_item(
+                TopicCompletedItem(comment_id=-1, topic_id=VALID_TOPIC_ID,
+                                   topic_state=topic_state), None
+            )
+
+        # Recorded once the comments are written only
+        assert states.get('5ch_mnewsplus', 1596250713) is None
+        export_pipeline.write_queue.run()
+        assert contents_path(tmp_path).exists()
+        assert states.get('5ch_mnewsplus', 1596250713) == {'last_comment': 3}
+
+        # Not recorded if the topic failed to be written
+        export_pipeline.write_queue.failed_tags.add(VALID_TOPIC_ID)
+        export_pipeline.save_state(
+            VALID_TOPIC_ID, ('5ch_mnewsplus', 1596250713, {'last_comment': 5})
+        )
+        export_pipeline.write_queue.run()
+        assert states.get('5ch_mnewsplus', 1596250713) == {'last_comment': 3}
+
+    def test_resumed_batch(self, tmp_path, export_pipeline):
+        comments = make_comments()
+        self.export(export_pipeline, comments)
+        expected = contents_path(tmp_path).read_bytes()
+
+        self.export(export_pipeline, comments[:2])
+        batch = TopicCommentsBatch.from_comments(
+            VALID_TOPIC_ID, ArchivedCommentItem, comments[2:]
+        )
+        batch['resumed'] = True
+        export_pipeline.process_item(batch, None)
+        assert contents_path(tmp_path).read_bytes() == expected
+
+    def test_close_spider(self, tmp_path):
+        crawler = get_crawler(settings_dict={
+            'DATA_DIR': str(tmp_path),
+            'TOPIC_DIR_TEMPLATE': '{forum_id}/{topic_id}',
+            'TOPIC_CONTENTS_TEMPLATE': '{topic_id}_contents.csv',
+            'COMMENT_EXPORT_CHUNK_ROWS': 0,
+            'COMMENT_EXPORT_MAX_BUFFERED_ROWS': 2,
+            'EXPORT_QUEUE_SIZE': 0
+        })
+        pipeline = CommentItemExportPipeline.from_crawler(crawler)
+        for item in make_comments():
+            pipeline.process_item(item, None)
+        pipeline.close_spider(None)
+
+        assert len(contents_path(tmp_path).read_text().splitlines()) == 4
+        assert crawler.stats.get_value(
+            'comment_export/peak_buffered_rows') == 3
+        assert crawler.stats.get_value('comment_export/spilled_rows') == 3
+
+
+class TestItemRouterPipeline:
+
+    def make_items(self):
+        return [
+            ForumItem(forum_id='mnewsplus', site='5ch'),
+            ArchivedTopicItem(topic_id=VALID_TOPIC_ID,
+                              posted_on=VALID_DATETIME),
+            *make_comments(),
+            TopicCompletedItem(comment_id=-1, topic_id=VALID_TOPIC_ID),
+            TopicCommentsBatch.from_comments(
+                f'{VALID_TOPIC_ID}0', ArchivedCommentItem, make_comments()
+            )
+        ]
+
+    def make_crawler(self, tmp_path):
+        return get_crawler(settings_dict={
+            'DATA_DIR': str(tmp_path),
+            'FORUM_DIR_TEMPLATE': '{forum_id}',
+            'FORUM_METADATA_TEMPLATE': '{forum_id}_metadata.json',
+            'TOPIC_DIR_TEMPLATE': '{forum_id}/{topic_id}',
+            'TOPIC_METADATA_TEMPLATE': '{topic_id}_metadata.json',
+            'TOPIC_CONTENTS_TEMPLATE': '{topic_id}_contents.csv',
+            'EXPORT_QUEUE_SIZE': 0
+        })
+
+    def read_all(self, tmp_path):
+        return {path.relative_to(tmp_path): path.read_bytes()
+                for path in sorted(tmp_path.glob('**/*.*'))}
+
+    def test_same_as_pipelines(self, tmp_path):
+        crawler = self.make_crawler(tmp_path / 'pipelines')
+        pipelines = [DatetimePipeline()] + [
+            cls.from_crawler(crawler)
+            for cls in (ForumItemExportPipeline, TopicItemExportPipeline,
+                        CommentItemExportPipeline)
+        ]
+        expected = []
+        for item in self.make_items():
+            for pipeline in pipelines:
+                item = pipeline.process_item(item, None)
+            expected.append(item)
+
+        crawler = self.make_crawler(tmp_path / 'router')
+        router = ItemRouterPipeline.from_crawler(crawler)
+        assert [router.process_item(item, None)
+                for item in self.make_items()] == expected
+        assert self.read_all(tmp_path / 'router') == \
+            self.read_all(tmp_path / 'pipelines')
+
+    def test_stats(self, tmp_path):
+        crawler = self.make_crawler(tmp_path)
+        router = ItemRouterPipeline.from_crawler(crawler)
+        for item in self.make_items():
+            router.process_item(item, None)
+        assert router.process_item({'foo': 'bar'}, None) == {'foo': 'bar'}
+        router.close_spider(None)
+
+        stats = crawler.stats
+        assert stats.get_value('item_router/comment_export/items') == 3
+        assert stats.get_value('item_router/batch_export/items') == 1
+        assert stats.get_value('item_router/topic_completed/items') == 1
+        assert stats.get_value('item_router/forum_export/seconds') >= 0
+        assert router.table[dict] == []
+
+
+class TestCommentImagesPipeline:
+
+    @pytest.fixture
+    def pipeline(self, tmp_path):
+        crawler = get_crawler(settings_dict={
+            'IMAGES_STORE': str(tmp_path / 'images')
+        })
+        return CommentImagesPipeline.from_crawler(crawler)
+
+    def test_batch(self, pipeline):
+        batch = TopicCommentsBatch.from_comments(
+            VALID_TOPIC_ID, ArchivedCommentItem, make_comments()
+        )
+        requests = pipeline.get_media_requests(batch, None)
+        assert [r.url for r in requests] == [
+            'https://i.imgur.com/a.jpg', 'https://i.imgur.com/b.jpg',
+            'https://i.imgur.com/c.jpg'
+        ]
+
+        results = [(True, {'url': 'a'}), (False, None), (True, {'url': 'c'})]
+        batch = pipeline.item_completed(results, batch, None)
+        assert batch['columns']['images'] == \
+            [[{'url': 'a'}], [], [{'url': 'c'}]]
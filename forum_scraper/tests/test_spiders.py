@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+import os
+from pathlib import Path
+
+import pytest
+from scrapy import Request
+from scrapy.http import HtmlResponse, TextResponse
+from scrapy.utils.test import get_crawler
+
+from forum_scraper.items import (
+    BaseCommentItem,
+    ActiveCommentItem,
+    ActiveTopicItem,
+    ArchivedTopicItem,
+    TopicCommentsBatch,
+    TopicCompletedItem,
+    TopicResumedItem
+)
+from forum_scraper.pipelines import CommentItemExportPipeline
+from forum_scraper.spiders.a2ch import A2chSpider
+from forum_scraper.spiders.a5ch import A5chSpider
+
+FORUM_URL = 'http://hayabusa5.2ch.sc/mnewsplus/'
+DAT_URL = f'{FORUM_URL}dat/1597213268.dat'
+ROWS = [
+    '名無しさん<>sage<>2020/08/12(水) 12:34:56.78 ID:AbCdEf12<> 本文 <>スレタイ',
+    '名無しさん<><>2020/08/12(水) 12:35:00.12 ID:XyZ<> 本文 <>',
+    '名無しさん<><>2020/08/13(木) 01:02:03.45 ID:Foo<> 新着 <>'
+]
+KWARGS = {'forum_id': '2ch_mnewsplus', 'forum_url': FORUM_URL,
+          'topic_num': '1597213268', 'thd_item_cls': ActiveTopicItem}
+
+
+def export(spider, items):
+    '''Export the comments of `items` as a crawl would, recording the state
+    of their topic.'''
+    pipeline = CommentItemExportPipeline(
+        base_dir_path=str(Path(spider.settings['HISTORY_DIR']) / 'data'),
+        dirname_tmplt='{forum_id}/{topic_id}',
+        filename_tmplt='{topic_id}_contents.csv',
+        topic_states=spider.topic_states
+    )
+    for item in items:
+        if isinstance(item, (BaseCommentItem, TopicCommentsBatch)):
+            pipeline.process_item(item, spider)
+    return items
+
+
+def dat(rows):
+    return ''.join(f'{row}\n' for row in rows).encode('cp932')
+
+
+class TestA2chDatRangeRequests:
+
+    @pytest.fixture
+    def spider(self, tmp_path):
+        crawler = get_crawler(A2chSpider, settings_dict={
+            'HISTORY_DIR': str(tmp_path),
+            'SITE_PARAMS_PATH': os.environ['SITE_PARAMS_PATH']
+        })
+        return A2chSpider.from_crawler(crawler)
+
+    def fetch(self, spider, request, status=200, body=b'', headers=None):
+        response = TextResponse(request.url, status=status, body=body,
+                                headers=headers, encoding='cp932',
+                                request=request)
+        return export(spider,
+                      list(spider.parse_topic(response, **request.cb_kwargs)))
+
+    def follow(self, spider):
+        subback = TextResponse(f'{FORUM_URL}subback.html', body=b'')
+        return spider.follow_dat(subback, 'dat/1597213268.dat', dict(KWARGS))
+
+    def test_full_then_delta(self, spider):
+        full = dat(ROWS[:2])
+        request = self.follow(spider)
+        assert 'Range' not in request.headers
+        assert len(self.fetch(spider, request, body=full)) == 4
+        state = spider.topic_states.get('2ch_mnewsplus', 1597213268)
+        assert state['offset'] == len(full)
+        assert state['num_comments'] == 2
+
+        request = self.follow(spider)
+        assert request.headers['Range'] == f'bytes={len(full) - 1}-'.encode()
+        assert request.meta['handle_httpstatus_list'] == [416]
+        delta = dat(ROWS[2:])
+        size = len(full) + len(delta)
+        items = self.fetch(
+            spider, request, status=206, body=b'\n' + delta,
+            headers={'Content-Range': f'bytes {len(full) - 1}-{size - 1}/'
+                                      f'{size}'}
+        )
+
+        topic, resumed, comment, completed = items
+        assert isinstance(topic, ActiveTopicItem)
+        assert topic['topic_title'] == 'スレタイ'
+        assert topic['posted_on'] == '2020/08/12(水) 12:34:56'
+        assert topic['last_comment_on'] == '2020/08/13(木) 01:02:03'
+        assert isinstance(resumed, TopicResumedItem)
+        assert isinstance(comment, ActiveCommentItem)
+        assert comment['comment_id'] == '2ch_mnewsplus_1597213268_0003'
+        assert comment['body'] == '新着'
+        assert isinstance(completed, TopicCompletedItem)
+
+        state = spider.topic_states.get('2ch_mnewsplus', 1597213268)
+        assert state['offset'] == size
+        assert state['num_comments'] == 3
+
+        # Nothing new since
+        request = self.follow(spider)
+        assert self.fetch(
+            spider, request, status=206, body=b'\n',
+            headers={'Content-Range': f'bytes {size - 1}-{size - 1}/{size}'}
+        ) == []
+        stats = spider.crawler.stats
+        assert stats.get_value('dat_range/requests') == 2
+        assert stats.get_value('dat_range/unchanged') == 1
+
+    def test_skip_unchanged(self, spider):
+        spider.topic_states.set('2ch_mnewsplus', 1597213268,
+                                {'offset': 42, 'num_comments': 2,
+                                 'encoding': 'cp932', 'listed_count': 2})
+        subback = TextResponse(
+            f'{FORUM_URL}subback.html', encoding='cp932',
+            body='<small class="trad">'
+                 '<a href="1597213268/l50">1: スレタイ (2)</a>'
+                 '<a href="1597213269/l50">2: スレタイ (5)</a>'
+                 '</small>'.encode('cp932')
+        )
+        request, = spider.parse_active_list(subback, **KWARGS)
+        assert request.url == f'{FORUM_URL}dat/1597213269.dat'
+
+        spider.topic_states.set('2ch_mnewsplus', 1597213268,
+                                {'offset': 42, 'num_comments': 2,
+                                 'encoding': 'cp932', 'listed_count': 1})
+        request, _ = spider.parse_active_list(subback, **KWARGS)
+        assert request.url == DAT_URL
+        stats = spider.crawler.stats
+        assert stats.get_value('topic_counts/hits') == 2
+        assert stats.get_value('topic_counts/skipped') == 1
+
+    def test_state_after_export(self, spider):
+        subback = TextResponse(f'{FORUM_URL}subback.html', body=b'')
+        request = spider.follow_dat(subback, 'dat/1597213268.dat',
+                                    dict(KWARGS), count=3)
+        response = TextResponse(DAT_URL, body=dat(ROWS[:2]),
+                                encoding='cp932', request=request)
+        items = list(spider.parse_topic(response, **request.cb_kwargs))
+        assert spider.topic_states.get('2ch_mnewsplus', 1597213268) is None
+
+        export(spider, items)
+        state = spider.topic_states.get('2ch_mnewsplus', 1597213268)
+        assert state['num_comments'] == 2
+        # As listed, whatever the number of the last comment
+        assert state['listed_count'] == 3
+
+    @pytest.mark.parametrize('status,body,headers', [
+        (416, b'', {'Content-Range': 'bytes */10'}),  # Shrunk
+        (206, b'x', {'Content-Range': 'bytes 41-41/42'}),  # Rewritten
+    ])
+    def test_fallback(self, spider, status, body, headers):
+        spider.topic_states.set('2ch_mnewsplus', 1597213268,
+                                {'offset': 42, 'num_comments': 1,
+                                 'encoding': 'cp932'})
+        request = self.follow(spider)
+        retry, = self.fetch(spider, request, status, body, headers)
+        assert isinstance(retry, Request)
+        assert retry.url == DAT_URL
+        assert retry.dont_filter
+        assert 'Range' not in retry.headers
+        assert spider.crawler.stats.get_value('dat_range/fallbacks') == 1
+
+
+READ_CGI_URL = 'https://hayabusa9.5ch.net/test/read.cgi/mnewsplus/1596250713/'
+POSTS = [
+    ('2020/08/01(土) 12:00:00.00', '本文'),
+    ('2020/08/01(土) 12:34:56.78', '本文'),
+    ('2020/08/02(日) 01:02:03.45', '新着')
+]
+
+
+def read_cgi(numbers):
+    posts = ''.join(
+        f'<div class="post" id="{i}"><div class="meta">'
+        f'<span class="number">{i}</span>'
+        f'<span class="name"><b>名無しさん</b></span>'
+        f'<span class="date">{POSTS[i - 1][0]}</span>'
+        f'<span class="uid">ID:AbCd{i}</span></div><div class="message">'
+        f'<span class="escaped">{POSTS[i - 1][1]}</span></div></div>'
+        for i in numbers
+    )
+    return (f'<html><head><title>スレタイ</title></head><body>'
+            f'<ul class="pagestats">'
+            f'<li class="meta">{len(POSTS)}コメント</li>'
+            f'<li class="meta">1KB</li></ul>'
+            f'<div class="topic">{posts}</div></body></html>').encode()
+
+
+class TestA5chReadCgiRangeRequests:
+
+    @pytest.fixture(params=[False, True])
+    def spider(self, request, tmp_path):
+        crawler = get_crawler(A5chSpider, settings_dict={
+            'HISTORY_DIR': str(tmp_path),
+            'COMMENT_BATCHES': request.param
+        })
+        return A5chSpider.from_crawler(crawler)
+
+    def fetch(self, spider, request, numbers):
+        response = HtmlResponse(request.url, body=read_cgi(numbers),
+                                encoding='utf-8', request=request)
+        return export(spider,
+                      list(spider.parse_topic(response, **request.cb_kwargs)))
+
+    def follow(self, spider):
+        subback = HtmlResponse('https://hayabusa9.5ch.net/mnewsplus/'
+                               'subback.html', body=b'')
+        kwargs = {'forum_id': '5ch_mnewsplus', 'tpc_item_cls': ActiveTopicItem,
+                  'css_selector': '.trad > a'}
+        return spider.follow_topic(
+            subback, '/test/read.cgi/mnewsplus/1596250713/l50', kwargs
+        )
+
+    def test_full_then_delta(self, spider):
+        request = self.follow(spider)
+        assert request.url == f'{READ_CGI_URL}l50'
+        self.fetch(spider, request, [1, 2])
+        state = spider.topic_states.get('5ch_mnewsplus', 1596250713)
+        assert state['last_comment'] == 2
+        assert state['topic_url'] == f'{READ_CGI_URL}l50'
+
+        request = self.follow(spider)
+        assert request.url == f'{READ_CGI_URL}3-n'
+        items = self.fetch(spider, request, [1, 3])  # As read.cgi, 1 too
+        topic = items[0]
+        assert isinstance(topic, ActiveTopicItem)
+        assert topic['topic_id'] == '5ch_mnewsplus_1596250713'
+        assert topic['topic_url'] == f'{READ_CGI_URL}l50'
+        assert topic['topic_title'] == 'スレタイ'
+        assert topic['posted_on'] == POSTS[0][0]
+        assert topic['last_comment_on'] == POSTS[2][0]
+        assert topic['num_comments'] == 3
+        if spider.settings.getbool('COMMENT_BATCHES'):
+            batch, = items[1:]
+            assert batch['resumed']
+            comments = list(batch.comments())
+        else:
+            resumed, *comments, completed = items[1:]
+            assert isinstance(resumed, TopicResumedItem)
+            assert isinstance(completed, TopicCompletedItem)
+        comment, = comments
+        assert comment['comment_id'] == '5ch_mnewsplus_1596250713_0003'
+        assert comment['comment_url'] == f'{READ_CGI_URL}l50/3'
+        assert comment['body'] == '新着'
+        state = spider.topic_states.get('5ch_mnewsplus', 1596250713)
+        assert state['last_comment'] == 3
+
+        # Nothing new since
+        request = self.follow(spider)
+        assert request.url == f'{READ_CGI_URL}4-n'
+        assert self.fetch(spider, request, [1]) == []
+        assert spider.topic_states.get('5ch_mnewsplus',
+                                       1596250713)['last_comment'] == 3
+        stats = spider.crawler.stats
+        assert stats.get_value('read_cgi_range/requests') == 2
+        assert stats.get_value('read_cgi_range/unchanged') == 1
+
+    def test_skip_unchanged(self, spider):
+        # A deleted post is not listed, nor counted in the last comment
+        spider.topic_states.set('5ch_mnewsplus', 1596250713,
+                                {'last_comment': 4, 'listed_count': 3})
+        subback = HtmlResponse(
+            'https://hayabusa9.5ch.net/mnewsplus/subback.html',
+            encoding='utf-8',
+            body='<base href="../test/read.cgi/mnewsplus/">'
+                 '<small class="trad">'
+                 '<a href="1596250713/l50">1: スレタイ (3)</a>'
+                 '<a href="1596250714/l50">2: スレタイ (5)</a>'
+                 '</small>'.encode()
+        )
+        kwargs = {'forum_id': '5ch_mnewsplus', 'tpc_item_cls': ActiveTopicItem,
+                  'css_selector': '.trad > a'}
+        request, = spider.parse_list(subback, **kwargs)
+        assert request.url == \
+            'https://hayabusa9.5ch.net/test/read.cgi/mnewsplus/1596250714/l50'
+        assert request.cb_kwargs['listed_count'] == 5
+        assert spider.crawler.stats.get_value('topic_counts/hits') == 1
+        assert spider.crawler.stats.get_value('topic_counts/skipped') == 1
+
+        spider.skip_unchanged = False
+        assert len(list(spider.parse_list(subback, **kwargs))) == 2
+
+    def test_archived(self, spider):
+        subback = HtmlResponse('https://hayabusa9.5ch.net/mnewsplus/',
+                               body=b'')
+        spider.topic_states.set('5ch_mnewsplus', 1596250713,
+                                {'last_comment': 2})
+        request = spider.follow_topic(
+            subback, READ_CGI_URL,
+            {'forum_id': '5ch_mnewsplus', 'tpc_item_cls': ArchivedTopicItem}
+        )
+        assert request.url == READ_CGI_URL
+        assert 'resume' not in request.cb_kwargs
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from corvid.utils.bloom import BloomFilter, optimal_params
+
+FAKE_URLS = [f'https://mao.5ch.net/test/read.cgi/bass/{1579960000 + i}/'
+             for i in range(10000)]
+
+
+@pytest.fixture
+def bloom(tmp_path):
+    return BloomFilter(tmp_path / 'history.bloom', 10000, 0.01)
+
+
+@pytest.mark.parametrize('capacity,error_rate', [
+    (0, 0.01),
+    (1000, 0),
+    (1000, 1)
+])
+def test_optimal_params_invalid(capacity, error_rate):
+    with pytest.raises(ValueError):
+        optimal_params(capacity, error_rate)
+
+
+class TestBloomFilter:
+
+    def test_no_false_negatives(self, bloom):
+        assert bloom.is_new
+        bloom.update(FAKE_URLS)
+        assert all(url in bloom for url in FAKE_URLS)
+        assert bloom.hits == len(FAKE_URLS)
+        assert bloom.misses == 0
+
+    def test_false_positive_rate(self, bloom):
+        bloom.update(FAKE_URLS)
+        others = [url.replace('bass', 'news') for url in FAKE_URLS]
+        fps = sum(url in bloom for url in others)
+        assert fps / len(others) < 0.02
+        assert bloom.misses == len(others) - fps
+
+    def test_reopen(self, tmp_path, bloom):
+        bloom.update(FAKE_URLS[:100])
+        bloom.close()
+
+        reopened = BloomFilter(tmp_path / 'history.bloom', 10000, 0.01)
+        assert not reopened.is_new
+        assert len(reopened) == 100
+        assert all(url in reopened for url in FAKE_URLS[:100])
+
+    def test_recover_dirty(self, tmp_path, bloom):
+        bloom.update(FAKE_URLS[:100])
+        bloom.flush()
+        bloom.add(FAKE_URLS[100])  # Unflushed when the process is killed
+
+        reopened = BloomFilter(tmp_path / 'history.bloom', 10000, 0.01)
+        assert reopened.is_new
+        assert FAKE_URLS[0] not in reopened
+
+    def test_reset_on_new_params(self, tmp_path, bloom):
+        bloom.update(FAKE_URLS[:100])
+        bloom.close()
+
+        reopened = BloomFilter(tmp_path / 'history.bloom', 10000, 0.001)
+        assert reopened.is_new
+        assert len(reopened) == 0
@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
 from copy import deepcopy
+import csv
+import io
+import pickle
+import sys
 
+from itemadapter import ItemAdapter
 import pytest
 
-from forum_scraper.utils.classes import (
+from corvid.utils.classes import (
+    ItemBuffer,
     OrderedSet,
     URLOrderedSet
 )
+from forum_scraper.items import ArchivedCommentItem
 
 FAKE_DATA_PATH = '/'
 FAKE_THD_DIR_TMPLT = '{start_time}-{topic_id}'
@@ -14,6 +21,45 @@ FAKE_THD_CONT_TMPLT = '{start_time}-{topic_id}.tsv'
 FAKE_EXPTR_KWARGS = {'foo': 'bar'}
 
 
+def legacy_state(keys, pivot_url=None):
+    '''State of a URLOrderedSet pickled by the linked-list implementation.'''
+    end = []
+    end += [None, end, end]
+    map = {}
+    for key in keys:
+        curr = end[1]
+        curr[2] = end[1] = map[key] = [key, curr, end]
+    return {'end': end, 'map': map, 'pivot_url': pivot_url}
+
+
+def legacy_rows(items):
+    '''Rows stored by the list-of-lists ItemBuffer, header first.'''
+    header = ItemAdapter(items[0]).field_names()
+    rows = [header]
+    for item in items:
+        adapter = ItemAdapter(item)
+        rows.append([';'.join([str(v) for v in adapter.get(field)])
+                     if isinstance(adapter.get(field), list)
+                     else adapter.get(field) for field in header])
+    return rows
+
+
+def to_csv(rows):
+    out = io.StringIO()
+    csv.writer(out).writerows(rows)
+    return out.getvalue()
+
+
+def make_items():
+    return [
+        ArchivedCommentItem(site='5ch', comment_id=f'mnewsplus_1_{i:04}',
+                            body=f'本文 "{i}",\n', is_aa=bool(i % 2),
+                            reply_to=[f'mnewsplus_1_{i - 1:04}', i - 1],
+                            image_urls=[], topic_id='mnewsplus_1')
+        for i in range(1, 6)
+    ] + [{'site': '5ch', 'comment_id': 'mnewsplus_1_0006'}]
+
+
 @pytest.fixture
 def ref():
     return list(range(1, 11))
@@ -101,6 +147,79 @@ class TestOrderedSet:
         with pytest.raises(KeyError):
             os_new.pop()
 
+        with pytest.raises(KeyError):
+            os_copy[len(ref)]
+
+    def test_mixed_inserts(self, os, ref):
+        # Move the gap back and forth, then check order and positions.
+        os_copy, ref_copy = deepcopy(os), deepcopy(ref)
+        for i, key in enumerate([100, 101, 102]):
+            os_copy.add_before(ref[2], key)
+            ref_copy.insert(2 + i, key)
+        os_copy.add_after(ref[8], 103)
+        ref_copy.insert(ref_copy.index(ref[8]) + 1, 103)
+        os_copy.add(104)
+        ref_copy.append(104)
+        os_copy.add_before(ref[0], 105)
+        ref_copy.insert(0, 105)
+        os_copy.discard(ref[5])
+        ref_copy.remove(ref[5])
+
+        assert list(os_copy) == ref_copy
+        assert list(reversed(os_copy)) == ref_copy[::-1]
+        assert [os_copy[i] for i in range(len(ref_copy))] == ref_copy
+        assert [os_copy[-i] for i in range(1, len(ref_copy) + 1)] \
+            == ref_copy[::-1]
+
+    def test_mixed_at_large_n(self, monkeypatch):
+        # Adding at the end while the gap is open, and popping the first keys,
+        # used to shift every key after them.
+        moved = 0
+        move_gap = OrderedSet._move_gap
+
+        def counted_move_gap(self, index):
+            nonlocal moved
+            front, tail = len(self._front), len(self._tail)
+            move_gap(self, index)
+            moved += abs(len(self._front) - front) + tail - len(self._tail)
+
+        monkeypatch.setattr(OrderedSet, '_move_gap', counted_move_gap)
+        n = 200_000
+        os = OrderedSet(range(n))
+        ref = list(range(n))
+        for i in range(n, 2 * n, 2):
+            os.add_after(100, i)
+            os.add(i + 1)
+        for _ in range(n // 2):
+            os.pop(last=False)
+            os.pop()
+        # Each key moved across the gap twice at most, not once per key added
+        assert moved <= 2 * n
+
+        ref[101:101] = reversed(range(n, 2 * n, 2))
+        ref += range(n + 1, 2 * n, 2)
+        ref = ref[n // 2:len(ref) - n // 2]
+        assert list(os) == ref
+        assert list(reversed(os)) == ref[::-1]
+        assert os[0] == ref[0] and os[-1] == ref[-1]
+        assert os[len(ref) // 2] == ref[len(ref) // 2]
+        os.discard(ref[1])
+        os.discard(ref[-2])
+        assert list(os) == ref[:1] + ref[2:-2] + ref[-1:]
+
+    def test_truncate(self, os, ref):
+        os_copy = deepcopy(os)
+        os_copy.add_before(ref[5], 100)  # Split keys around the gap
+        os_copy.truncate(3)
+        assert list(os_copy) == ref[:3]
+        assert ref[3] not in os_copy and 100 not in os_copy
+
+    def test_memory_per_key(self):
+        n = 1_000_000
+        os = OrderedSet(range(n))
+        # Container overhead only, the int keys are not counted.
+        assert sys.getsizeof(os) / n < 64
+
 
 class TestURLOrderedSet:
     def test_init(self):
@@ -147,3 +266,86 @@ class TestURLOrderedSet:
         uos.trim(max_length)
         assert len(uos) == max_length
         assert list(uos) == list(range(max_length))
+
+    def test_run_cycle(self):
+        # New URLs of a run go before the first URL of the previous run, and
+        # the oldest ones are trimmed at the end of the run.
+        uos = URLOrderedSet(range(10))
+        uos.set_pivot_url()
+        for i in range(100, 105):
+            uos.add_url(i)
+        uos.trim(12)
+        uos.set_pivot_url()
+        assert list(uos) == [100, 101, 102, 103, 104, *range(7)]
+        assert uos.pivot_url == 100
+        assert uos[5] == 0 and uos[-1] == 6
+
+
+class TestSerialization:
+
+    def test_round_trip(self, ref):
+        uos = URLOrderedSet(ref)
+        uos.add_before(ref[3], 100)  # Keys on both sides of the gap
+        uos.set_pivot_url(ref[1])
+        loaded = pickle.loads(pickle.dumps(uos))
+        assert isinstance(loaded, URLOrderedSet)
+        assert list(loaded) == list(uos)
+        assert loaded.pivot_url == ref[1]
+
+    def test_large_set(self):
+        # Used to exceed the recursion limit with linked-list nodes.
+        uos = URLOrderedSet(range(200_000))
+        loaded = pickle.loads(pickle.dumps(uos))
+        assert len(loaded) == 200_000 and loaded[-1] == 199_999
+
+    def test_legacy_state(self, ref):
+        uos = URLOrderedSet.__new__(URLOrderedSet)
+        uos.__setstate__(legacy_state(ref, ref[0]))
+        assert list(uos) == ref
+        assert uos.pivot_url == ref[0]
+        uos.add_url(100)
+        assert list(uos) == [100] + ref
+
+    def test_unknown_state(self):
+        with pytest.raises(ValueError):
+            OrderedSet().__setstate__({'version': 100, 'keys': []})
+
+
+class TestItemBuffer:
+
+    def test_same_as_legacy(self):
+        items = make_items()
+        buffer = ItemBuffer()
+        for item in items:
+            buffer.store(item)
+        assert len(buffer) == len(items) + 1
+        assert to_csv(buffer) == to_csv(legacy_rows(items))
+
+    def test_store_columns(self):
+        items = make_items()[:5]
+        columns = {field: [item.get(field) for item in items]
+                   for field in ArchivedCommentItem.fields}
+        buffer = ItemBuffer()
+        buffer.store_columns(columns)
+        assert to_csv(buffer) == to_csv(legacy_rows(items))
+
+    def test_detach(self):
+        items = make_items()
+        buffer = ItemBuffer()
+        for item in items[:2]:
+            buffer.store(item)
+        first = buffer.detach()
+        assert len(buffer) == 0
+        for item in items[2:]:
+            buffer.store(item)
+        assert len(buffer) == len(items) - 2
+        assert to_csv(first) + to_csv(buffer) == \
+            to_csv(legacy_rows(items))
+
+    def test_interned(self):
+        buffer = ItemBuffer()
+        for item in make_items():
+            item['topic_id'] = ''.join(['mnewsplus', '_1'])
+            buffer.store(item)
+        topic_ids = buffer.columns[buffer.header.index('topic_id')]
+        assert all(topic_id is topic_ids[0] for topic_id in topic_ids)
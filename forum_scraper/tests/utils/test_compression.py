@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from corvid.utils import compression
+from corvid.utils.compression import (
+    compress,
+    compressed_path,
+    decompress,
+    open_export,
+    open_text
+)
+
+CODECS = [None, 'gzip', pytest.param('zstd', marks=pytest.mark.skipif(
+    compression.zstandard is None, reason='zstandard is not installed'
+))]
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_round_trip(tmp_path, codec):
+    path = tmp_path / 'topic_contents.csv'
+    with open_text(path, 'w', codec) as wh:
+        wh.write('site,body\r\n5ch,本文\r\n')
+    # Appended as another gzip member or zstd frame
+    with open_text(path, 'a', codec, level=1) as wh:
+        wh.write('5ch,ぬるぽ\r\n')
+
+    assert compressed_path(path, codec).exists()
+    with open_export(path, newline='') as rh:
+        assert rh.read() == 'site,body\r\n5ch,本文\r\n5ch,ぬるぽ\r\n'
+
+
+@pytest.mark.parametrize('codec', CODECS[1:])
+def test_compress(codec):
+    data = 'スレタイ'.encode('utf-8') * 100
+    assert len(compress(data, codec)) < len(data)
+    assert decompress(compress(data, codec)) == data
+
+
+@pytest.mark.parametrize('codec', CODECS[1:])
+def test_decompress_concatenated(codec):
+    # gzip members or zstd frames appended one after the other
+    data = compress('スレタイ'.encode('utf-8'), codec) \
+        + compress('ぬるぽ'.encode('utf-8'), codec, 1)
+    assert decompress(data) == 'スレタイぬるぽ'.encode('utf-8')
+
+
+def test_invalid_codec():
+    with pytest.raises(ValueError):
+        open_text('topic.csv', 'w', 'lzma')
+
+
+def test_missing(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        open_export(tmp_path / 'topic_contents.csv')
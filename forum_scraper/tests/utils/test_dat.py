@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from forum_scraper.utils.dat import (
+    Row,
+    dat_delta,
+    decompose_row,
+    find_images,
+    listed_count,
+    parse_dat,
+    range_headers
+)
+
+ROWS = [
+    '名無しさん<>sage<>2020/08/12(水) 12:34:56.78 ID:AbCdEf12<> 本文 <>スレタイ',
+    '名無しさん<><>2020/08/12(水) 12:35:00.12 ID:XyZ<> '
+    '<a href="../test/read.cgi/mnewsplus/1597213268/1">&gt;&gt;1</a> '
+    'http://i.imgur.com/abc.jpg <>',
+]
+
+
+class TestDecomposeRow:
+
+    def test_first_row(self):
+        assert decompose_row(ROWS[0]) == Row(
+            '名無しさん', 'sage', '本文', 'スレタイ', '2020/08/12(水) 12:34:56',
+            'AbCdEf12'
+        )
+
+    def test_no_date(self):
+        row = decompose_row('名無しさん<><>あぼーん<>あぼーん<>')
+        assert row.date == ''
+        assert row.uid == 'あぼーん'
+
+    @pytest.mark.parametrize('row,err', [
+        (None, TypeError),
+        ('名無しさん<>sage', IndexError)
+    ])
+    def test_invalid_input(self, row, err):
+        with pytest.raises(err):
+            decompose_row(row)
+
+
+def test_parse_dat():
+    text = '\n'.join(ROWS + ['過去ログ ★', ''])
+    rows = parse_dat(text)
+    assert [row.date for row in rows] == \
+        ['2020/08/12(水) 12:34:56', '2020/08/12(水) 12:35:00']
+    assert rows[1].title == ''
+
+
+def test_find_images():
+    assert find_images(decompose_row(ROWS[1]).body) == \
+        ['http://i.imgur.com/abc.jpg']
+
+
+@pytest.mark.parametrize('text,expected', [
+    ('1597213268.dat<>スレタイ (123)', 123),
+    ('1: スレタイ (1000) ', 1000),
+    ('1: スレタイ (1000+)', 1000),
+    ('1: (2) スレタイ', None),
+    ('1597213268.dat<>スレタイ', None),
+    (None, None)
+])
+def test_listed_count(text, expected):
+    assert listed_count(text) == expected
+
+
+class TestDatDelta:
+
+    def test_range_headers(self):
+        assert range_headers(100)['Range'] == 'bytes=99-'
+
+    @pytest.mark.parametrize('status,content_range,body,expected', [
+        (206, b'bytes 99-102/103', b'\nabc', b'abc'),  # Appended
+        (206, b'bytes 99-99/100', b'\n', b''),  # Unchanged
+        (206, b'bytes 99-102/*', b'\nabc', b'abc'),  # Unknown size
+        (200, None, b'abc', None),  # Range ignored
+        (416, b'bytes */50', b'', None),  # Shrunk
+        (206, b'bytes 99-102/103', b'xabc', None),  # Rewritten
+        (206, b'bytes 98-102/103', b'\nabcd', None),  # Other start
+        (206, b'bytes 99-110/111', b'\nabc', None),  # Truncated body
+        (206, None, b'\nabc', None)
+    ])
+    def test_delta(self, status, content_range, body, expected):
+        headers = {} if content_range is None \
+            else {'Content-Range': content_range}
+        assert dat_delta(status, headers, body, 100) == expected
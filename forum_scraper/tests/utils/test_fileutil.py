@@ -1,6 +1,15 @@
 # -*- coding: utf-8 -*-
+import threading
+
 import pytest
 
+from corvid.utils.fileutil import (
+    _known_dirs,
+    clear_known_dirs,
+    compile_template,
+    make_dirs,
+    saved_syscalls
+)
 from forum_scraper.utils import fileutil
 from forum_scraper.tests.statics import (
     VALID_COMMENT_ID,
@@ -58,6 +67,80 @@ class TestGetTemplateKwargs:
         assert actual['forum_id'] == exp_frm_id
 
 
+class TestCompileTemplate:
+
+    KWARGS = {'forum_id': VALID_FORUM_ID, 'topic_id': VALID_TOPIC_ID,
+              'comment_id': None}
+
+    @pytest.mark.parametrize('template', [
+        '{forum_id}/{topic_id}',
+        '{topic_id}_contents.csv',
+        '100%_{comment_id}',
+        '{forum_id:>20}.{topic_id!r}',
+        'no fields'
+    ])
+    def test_same_as_format(self, template):
+        assert compile_template(template)(self.KWARGS) == \
+            template.format(**self.KWARGS)
+
+    def test_missing_field(self):
+        with pytest.raises(KeyError):
+            compile_template('{blog}.csv')(self.KWARGS)
+
+
+class TestPreparePath:
+
+    def test_dir_cache(self, tmp_path):
+        item = {'comment_id': VALID_COMMENT_ID}
+        kwargs = {'base_dir': str(tmp_path),
+                  'dirname_template': '{forum_id}/{topic_id}',
+                  'filename_template': '{topic_id}_contents.csv'}
+        path = fileutil.prepare_path(item=item, **kwargs)
+        assert path == (tmp_path / VALID_FORUM_ID / VALID_TOPIC_ID
+                        / f'{VALID_TOPIC_ID}_contents.csv')
+        assert path.parent.is_dir()
+
+        saved = saved_syscalls()
+        kwargs['filename_template'] = '{topic_id}_metadata.json'
+        assert fileutil.prepare_path(item=item, **kwargs).parent == \
+            path.parent
+        assert saved_syscalls() == saved + 1
+
+    def test_dir_cache_bounded(self, tmp_path, monkeypatch):
+        monkeypatch.setattr('corvid.utils.fileutil._MAX_KNOWN_DIRS', 2)
+        clear_known_dirs()
+        for name in ('a', 'b', 'a', 'c'):
+            make_dirs(str(tmp_path), name, {})
+        # The least recently used is dropped
+        assert [dirname for _, dirname in _known_dirs] == ['a', 'c']
+
+        clear_known_dirs()
+        assert not _known_dirs
+
+    def test_dir_cache_threads(self, tmp_path, monkeypatch):
+        # Used by the writer thread and the reactor thread alike
+        monkeypatch.setattr('corvid.utils.fileutil._MAX_KNOWN_DIRS', 4)
+        clear_known_dirs()
+        errors = []
+
+        def make(start):
+            try:
+                for i in range(2000):
+                    make_dirs(str(tmp_path), str((start + i) % 8), {})
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=make, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        assert len(_known_dirs) <= 4
+        clear_known_dirs()
+
+
 class TestPickles:
 
     def test_read_non_exisiting(self, tmp_path):
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+import pytest
+from scrapy.utils.test import get_crawler
+
+from corvid.utils.history import (
+    ShardedURLHistory,
+    TopicHistory,
+    TopicStates,
+    URLHistory
+)
+
+FAKE_URLS = [f'https://mao.5ch.net/test/read.cgi/bass/{1579960000 + i}/'
+             for i in range(5000)]
+
+
+@pytest.fixture
+def history(tmp_path):
+    return URLHistory(tmp_path, 'scraped_urls')
+
+
+class TestURLHistory:
+
+    def test_add(self, history):
+        assert history.add(FAKE_URLS[0]) is True
+        assert history.add(FAKE_URLS[0]) is False
+        assert len(history) == 1
+        assert FAKE_URLS[0] in history
+        assert FAKE_URLS[1] not in history
+
+    def test_iter(self, history):
+        history.update(FAKE_URLS[:10] + FAKE_URLS[:5])
+        assert list(history) == FAKE_URLS[:10]
+
+    def test_grow(self, history):
+        # More entries than the initial capacity allows
+        assert history.update(FAKE_URLS) == len(FAKE_URLS)
+        assert all(url in history for url in FAKE_URLS)
+        assert 'https://mao.5ch.net/foo' not in history
+
+    @pytest.mark.parametrize('entry,err', [
+        (None, TypeError),
+        (1, TypeError),
+        ('https://mao.5ch.net/\n', ValueError)
+    ])
+    def test_invalid_entry(self, history, entry, err):
+        with pytest.raises(err):
+            history.add(entry)
+
+    def test_reopen(self, tmp_path, history):
+        history.update(FAKE_URLS)
+        history.close()
+
+        reopened = URLHistory(tmp_path, 'scraped_urls')
+        assert len(reopened) == len(FAKE_URLS)
+        assert all(url in reopened for url in FAKE_URLS)
+
+    def test_recover_unflushed_index(self, tmp_path, history):
+        # Entries in the log but not flushed to the index header -> replay
+        history.update(FAKE_URLS[:100])
+        history.flush()
+        history.update(FAKE_URLS[100:200])
+        history._log.flush()  # Simulate a crash after a buffer flush
+
+        reopened = URLHistory(tmp_path, 'scraped_urls')
+        assert len(reopened) == 200
+        assert all(url in reopened for url in FAKE_URLS[:200])
+
+    def test_recover_partial_record(self, tmp_path, history):
+        history.update(FAKE_URLS[:10])
+        history.close()
+        with history.log_path.open('ab') as wh:
+            wh.write(b'https://mao.5ch.net/test/rea')  # Torn write
+
+        reopened = URLHistory(tmp_path, 'scraped_urls')
+        assert list(reopened) == FAKE_URLS[:10]
+
+    def test_recover_corrupted_index(self, tmp_path, history):
+        history.update(FAKE_URLS[:10])
+        history.close()
+        history.idx_path.write_bytes(b'broken')
+
+        reopened = URLHistory(tmp_path, 'scraped_urls')
+        assert len(reopened) == 10
+        assert all(url in reopened for url in FAKE_URLS[:10])
+
+
+@pytest.fixture
+def topics(tmp_path):
+    return TopicHistory(tmp_path / 'scraped_topics')
+
+
+class TestTopicHistory:
+
+    def test_add(self, topics):
+        assert topics.add(('5ch_bass', 1579960729)) is True
+        assert topics.add(('5ch_bass', 1579960729)) is False
+        assert ('5ch_bass', 1579960729) in topics
+        assert ('5ch_bass', 1579960728) not in topics
+        assert ('5ch_news', 1579960729) not in topics
+        assert len(topics) == 1
+
+    @pytest.mark.parametrize('topic', [None, 1, ('5ch_bass',), 'bass'])
+    def test_contains_invalid(self, topics, topic):
+        assert topic not in topics
+
+    def test_sorted(self, topics):
+        # Archived topics are often recorded from the newest.
+        nums = [1579960729, 1491723120, 1597213268, 1500000000]
+        topics.update(('5ch_bass', num) for num in nums)
+        assert [num for _, num in topics] == sorted(nums)
+
+    def test_reopen(self, tmp_path, topics):
+        topics.update(('5ch_bass', 1579960000 + i) for i in range(1000))
+        topics.add(('blog/with:odd key', 1))
+        topics.close()
+        assert (tmp_path / 'scraped_topics' / '5ch_bass.topics') \
+            .stat().st_size == 4 * 1000  # 4 bytes per topic
+
+        reopened = TopicHistory(tmp_path / 'scraped_topics')
+        assert len(reopened) == 1001
+        assert ('5ch_bass', 1579960999) in reopened
+        assert ('blog/with:odd key', 1) in reopened
+
+    def test_recover_partial_record(self, tmp_path, topics):
+        topics.add(('5ch_bass', 1579960729))
+        topics.close()
+        with (tmp_path / 'scraped_topics' / '5ch_bass.topics') \
+                .open('ab') as wh:
+            wh.write(b'\x01\x02')  # Torn write
+
+        reopened = TopicHistory(tmp_path / 'scraped_topics')
+        assert list(reopened) == [('5ch_bass', 1579960729)]
+
+
+class TestShardedHistory:
+
+    def test_lazy_loading(self, tmp_path, topics):
+        topics.update(('5ch_bass', 1579960000 + i) for i in range(10))
+        topics.add(('5ch_news', 1579960000))
+        topics.close()
+
+        reopened = TopicHistory(tmp_path / 'scraped_topics')
+        assert reopened.keys() == {'5ch_bass', '5ch_news'}
+        assert len(reopened) == 11
+        assert reopened.nbytes == 0  # Nothing loaded yet
+
+        assert ('5ch_news', 1579960000) in reopened
+        assert list(reopened._shards) == ['5ch_news']
+        assert ('5ch_foo', 1579960000) not in reopened
+        assert '5ch_foo' not in reopened.keys()
+
+    def test_is_empty(self, tmp_path, topics):
+        assert topics.is_empty()
+        topics.shard('5ch_bass')
+        assert topics.is_empty()
+        topics.add(('5ch_news', 1579960000))
+        assert not topics.is_empty()
+        topics.close()
+
+        reopened = TopicHistory(tmp_path / 'scraped_topics')
+        assert not reopened.is_empty()
+        assert reopened.nbytes == 0  # Without loading the shards
+
+    def test_lru_eviction(self, tmp_path):
+        # Room for about one shard of 1000 topics at a time
+        topics = TopicHistory(tmp_path / 'scraped_topics', 6000)
+        for key in ('5ch_a', '5ch_b', '5ch_c'):
+            topics.update((key, 1579960000 + i) for i in range(1000))
+
+        assert list(topics._shards) == ['5ch_c']
+        # Evicted shards were written back and load again on access.
+        assert ('5ch_a', 1579960999) in topics
+        assert list(topics._shards) == ['5ch_a']
+        assert len(topics) == 3000
+
+    def test_max_open(self, tmp_path):
+        # Small shards still hold their files open
+        topics = TopicHistory(tmp_path / 'scraped_topics', max_open=2)
+        for key in ('5ch_a', '5ch_b', '5ch_c'):
+            topics.add((key, 1579960000))
+
+        assert list(topics._shards) == ['5ch_b', '5ch_c']
+        assert ('5ch_a', 1579960000) in topics
+        assert list(topics._shards) == ['5ch_c', '5ch_a']
+        assert len(topics) == 3
+
+    def test_urls(self, tmp_path):
+        urls = ShardedURLHistory(tmp_path / 'scraped_urls')
+        urls.add(('dqnplus', 'http://blog.livedoor.jp/dqnplus/archives/1'))
+        urls.close()
+
+        reopened = ShardedURLHistory(tmp_path / 'scraped_urls')
+        assert len(reopened) == 1
+        assert ('dqnplus', 'http://blog.livedoor.jp/dqnplus/archives/1') \
+            in reopened
+        assert ('news23vip', 'http://blog.livedoor.jp/dqnplus/archives/1') \
+            not in reopened
+
+
+class TestTopicStates:
+
+    def test_set(self, tmp_path):
+        states = TopicStates(tmp_path / 'topic_states')
+        assert states.get('2ch_bass', 1579960729) is None
+        assert states.set('2ch_bass', 1579960729, {'offset': 10}) is True
+        assert states.set('2ch_bass', 1579960729, {'offset': 10}) is False
+        assert states.set('2ch_bass', 1579960729, {'offset': 20}) is True
+        assert states.get('2ch_bass', 1579960729) == {'offset': 20}
+        assert ('2ch_bass', 1579960729) in states
+        assert states.get('2ch_news', 1579960729) is None
+        assert '2ch_news' not in states.keys()
+
+    def test_from_crawler(self, tmp_path):
+        crawler = get_crawler(settings_dict={'HISTORY_DIR': str(tmp_path)})
+        states = TopicStates.from_crawler(crawler)
+        assert states.dir_path == tmp_path / 'topic_states'
+        # Shared by the spider, pipelines and middlewares
+        assert TopicStates.from_crawler(crawler) is states
+        assert TopicStates.from_crawler(get_crawler()) is None
+
+    def test_reopen(self, tmp_path):
+        states = TopicStates(tmp_path / 'topic_states')
+        for offset in range(10):
+            states.set('2ch_bass', 1579960729, {'offset': offset})
+        states.set('2ch_bass', 1579960730, {'title': 'スレタイ'})
+        states.close()
+        path = tmp_path / 'topic_states' / '2ch_bass.states'
+        # Rewritten with the last states only
+        assert len(path.read_text(encoding='utf-8').splitlines()) == 2
+
+        reopened = TopicStates(tmp_path / 'topic_states')
+        assert len(reopened) == 2
+        assert reopened.get('2ch_bass', 1579960729) == {'offset': 9}
+        assert reopened.get('2ch_bass', 1579960730) == {'title': 'スレタイ'}
+
+    def test_recover_partial_record(self, tmp_path):
+        states = TopicStates(tmp_path / 'topic_states')
+        states.set('2ch_bass', 1579960729, {'offset': 10})
+        states.close()
+        with (tmp_path / 'topic_states' / '2ch_bass.states') \
+                .open('a') as wh:
+            wh.write('[1579960729, {"off')  # Torn write
+
+        reopened = TopicStates(tmp_path / 'topic_states')
+        assert reopened.get('2ch_bass', 1579960729) == {'offset': 10}
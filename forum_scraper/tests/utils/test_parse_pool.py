@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import sys
+
+from scrapy.http import TextResponse
+from scrapy.settings import Settings
+from scrapy.utils.test import get_crawler
+
+from forum_scraper.items import ArchivedTopicItem
+from forum_scraper.spiders.a2ch import A2chSpider
+from forum_scraper.utils.parse_pool import ParsePool, _run_callback
+
+DAT_URL = 'http://hayabusa5.2ch.sc/mnewsplus/dat/1597213268.dat'
+DAT = '\n'.join([
+    '名無しさん<>sage<>2020/08/12(水) 12:34:56.78 ID:AbCdEf12<> 本文 <>スレタイ',
+    '名無しさん<><>2020/08/12(水) 12:35:00.12 ID:XyZ<> '
+    '<a href="../test/read.cgi/mnewsplus/1597213268/1">&gt;&gt;1</a> '
+    'http://i.imgur.com/abc.jpg <>',
+    ''
+])
+KWARGS = {'forum_id': '2ch_mnewsplus', 'topic_num': '1597213268',
+          'thd_item_cls': ArchivedTopicItem}
+SETTINGS = {'SITE_PARAMS_PATH': os.environ['SITE_PARAMS_PATH'],
+            'COMMENT_ITEM_BUILDER': 'loader',
+            'COMMENT_BATCHES': False}
+
+
+def test_run_callback():
+    response = TextResponse(DAT_URL, body=DAT.encode('cp932'),
+                            encoding='cp932')
+    spider = A2chSpider()
+    spider.settings = Settings(SETTINGS)
+    expected = list(spider.parse_topic(response, **KWARGS))
+
+    items = _run_callback(A2chSpider, SETTINGS, 'parse_topic', TextResponse,
+                          response.url, response.body, response.encoding,
+                          KWARGS)
+    assert [dict(item) for item in items] == \
+        [dict(item) for item in expected]
+    assert [type(item) for item in items] == \
+        [type(item) for item in expected]
+
+
+def test_from_crawler():
+    crawler = get_crawler(settings_dict={'PARSE_POOL_WORKERS': 0})
+    assert ParsePool.from_crawler(crawler) is None
+
+    crawler = get_crawler(settings_dict={'PARSE_POOL_WORKERS': 2,
+                                         'COMMENT_BATCHES': True})
+    pool = ParsePool.from_crawler(crawler)
+    try:
+        assert pool.semaphore.limit == 4
+        assert pool.settings['COMMENT_BATCHES'] is True
+    finally:
+        pool.close()
+
+
+def test_no_reactor_on_import():
+    # In a fresh process, as the reactor is installed in this one.
+    code = ('import sys\n'
+            'import forum_scraper.spiders.a2ch\n'
+            'import forum_scraper.spiders.a5ch\n'
+            "assert 'twisted.internet.reactor' not in sys.modules\n")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    subprocess.run([sys.executable, '-c', code], env=env, check=True)
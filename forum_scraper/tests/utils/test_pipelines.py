@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+from datetime import datetime
+import random
+import re
 
 import pytest
 
@@ -68,6 +71,77 @@ class TestToIso8601:
         assert actual['time'] == expected
 
 
+def legacy_iso8601_str(text):
+    m = re.search(pipelines.DATETIME_PTTRN, text)
+    if m is None:
+        return None
+    date, time = m.group('date'), m.group('time')
+    frmt = '%Y/%m/%d%H:%M:%S'
+    if len(date) == 8:
+        frmt = frmt.replace('%Y', '%y')
+    if len(time) == 5:
+        frmt = frmt.replace(':%S', '')
+    return datetime.strptime(date+time, frmt).strftime(
+        '%Y-%m-%dT%H:%M:%S+09:00'
+    )
+
+
+class TestIso8601Str:
+
+    @pytest.mark.parametrize('text', [
+        VALID_DATETIME,
+        '2019/04/12(金) 19:12:51',
+        '2019/04/12(金) 19:12',
+        '2019/04/12(金) 19:12:5',
+        '2019/04/12 19:12:51',
+        '19/04/12(金) 19:12:51.87',
+        '70/01/01(木) 00:00',
+        '0999/04/12(金) 19:12:51',
+        'ID:AbCd 2020/08/12(水) 12:34:56.78',
+        '2019/04/12(1) 19:12:51',
+        '2020/02/29(土) 23:59:59',
+        'あぼーん',
+        ''
+    ])
+    def test_same_as_legacy(self, text):
+        assert pipelines.iso8601_str(text) == legacy_iso8601_str(text)
+
+    @pytest.mark.parametrize('text', [
+        '2019/02/29(金) 19:12:51',
+        '2019/13/12(金) 19:12:51',
+        '2019/04/12(金) 24:12:51',
+        '2019/04/12(金) 19:60:51',
+        '2019/04/12(金) 19:12:60',
+        '201/04/12(金) 19:12:51'
+    ])
+    def test_invalid(self, text):
+        with pytest.raises(ValueError):
+            legacy_iso8601_str(text)
+        with pytest.raises(ValueError):
+            pipelines.iso8601_str(text)
+
+    def test_fuzz(self):
+        # Mutations of a valid datetime
+        rnd = random.Random(0)
+        chars = '0123456789/:() .金'
+        for _ in range(5000):
+            text = list(VALID_DATETIME)
+            for _ in range(rnd.randint(1, 3)):
+                text[rnd.randrange(len(text))] = rnd.choice(chars)
+            text = ''.join(text)[:rnd.randint(16, len(text))]
+            try:
+                expected = legacy_iso8601_str(text)
+            except ValueError:
+                with pytest.raises(ValueError):
+                    pipelines.iso8601_str(text)
+            else:
+                assert pipelines.iso8601_str(text) == expected
+
+    def test_batch(self):
+        assert pipelines.iso8601_strs([VALID_DATETIME, None, 'あぼーん']) == \
+            [PROCESSED_DATETIME, None, None]
+
+
 class TestRemoveExcessSpaces:
 
     # ------------
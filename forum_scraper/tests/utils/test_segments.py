@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from corvid.utils import compression
+from forum_scraper.utils.segments import (
+    SegmentStore,
+    read_records,
+    read_topic
+)
+
+FORUM_ID = 'mnewsplus'
+TOPIC_IDS = [f'{FORUM_ID}_{n}' for n in (1596250713, 1596250714)]
+
+
+@pytest.fixture(params=[None, 'gzip', 'zstd'])
+def store(request, tmp_path):
+    if request.param == 'zstd' and compression.zstandard is None:
+        pytest.skip('zstandard is not installed')
+    store = SegmentStore(tmp_path, max_bytes=300,
+                         compression=request.param)
+    yield store
+    store.close()
+
+
+def fill(store):
+    store.append(FORUM_ID, 'forum', FORUM_ID, {'forum_id': FORUM_ID})
+    for topic_id in TOPIC_IDS:
+        store.append(FORUM_ID, 'topic', topic_id,
+                     {'topic_id': topic_id, 'title': 'スレタイ'})
+        store.append(FORUM_ID, 'comments', topic_id,
+                     [['comment_id', 'body'], [f'{topic_id}_1', '本文']],
+                     first=True)
+    for topic_id in TOPIC_IDS:
+        store.append(FORUM_ID, 'comments', topic_id,
+                     [[f'{topic_id}_2', 'ぬるぽ']], first=False)
+    store.close()
+
+
+def test_rolling(store, tmp_path):
+    fill(store)
+    segments = sorted((tmp_path / FORUM_ID).glob('*.jsonl*'))
+    assert len(segments) > 1
+    assert all(path.stat().st_size <= 300 for path in segments)
+    assert [r['kind'] for r in read_records(tmp_path / FORUM_ID)] == \
+        ['forum'] + ['topic', 'comments'] * 2 + ['comments'] * 2
+
+
+def test_read_topic(store, tmp_path):
+    fill(store)
+    topic = read_topic(tmp_path / FORUM_ID, TOPIC_IDS[0])
+    assert topic['topic']['title'] == 'スレタイ'
+    assert topic['comments'] == [['comment_id', 'body'],
+                                 [f'{TOPIC_IDS[0]}_1', '本文'],
+                                 [f'{TOPIC_IDS[0]}_2', 'ぬるぽ']]
+
+
+def test_recrawl(store, tmp_path):
+    fill(store)
+    # A topic exported again replaces the rows of the previous export.
+    store.append(FORUM_ID, 'comments', TOPIC_IDS[1], [['comment_id']],
+                 first=True)
+    store.close()
+    assert read_topic(tmp_path / FORUM_ID, TOPIC_IDS[1])['comments'] == \
+        [['comment_id']]
+    assert len(read_topic(tmp_path / FORUM_ID, TOPIC_IDS[0])['comments']) \
+        == 3
+
+
+def test_crash(store, tmp_path):
+    store.append(FORUM_ID, 'forum', FORUM_ID, {'forum_id': FORUM_ID})
+    segment, = (tmp_path / FORUM_ID).glob('*.jsonl*')
+    # Written before it is indexed
+    assert segment.stat().st_size > 0
+    fill(store)
+
+    # Index flushed past the data, and a torn index line
+    segment = sorted((tmp_path / FORUM_ID).glob('*.jsonl*'))[-1]
+    idx = segment.with_name(segment.name.split('.jsonl')[0] + '.idx')
+    with segment.open('r+b') as fh:
+        fh.truncate(segment.stat().st_size - 1)
+    with idx.open('a') as fh:
+        fh.write(f'{TOPIC_IDS[1]}\tcomments\t0')
+    topic = read_topic(tmp_path / FORUM_ID, TOPIC_IDS[1])
+    assert topic['topic']['title'] == 'スレタイ'
+    assert topic['comments'] == [['comment_id', 'body'],
+                                 [f'{TOPIC_IDS[1]}_1', '本文']]
+
+
+def test_max_open(tmp_path):
+    store = SegmentStore(tmp_path, max_bytes=1 << 20, max_open=1)
+    forum_ids = [FORUM_ID, 'poverty']
+    for n in range(3):
+        for forum_id in forum_ids:
+            store.append(forum_id, 'topic', f'{forum_id}_{n}', {})
+            # Only the last forum written to keeps its files open
+            assert [key for key, writer in store._writers.items()
+                    if writer._fh is not None] == [forum_id]
+    store.close()
+
+    for forum_id in forum_ids:
+        # Appended to the same segment once reopened
+        assert len(list((tmp_path / forum_id).glob('*.idx'))) == 1
+        assert [r['key'] for r in read_records(tmp_path / forum_id)] == \
+            [f'{forum_id}_{n}' for n in range(3)]
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+from pathlib import Path
+
+import pytest
+from scrapy import signals
+from scrapy.utils.test import get_crawler
+
+from forum_scraper.utils.site_params import SiteParams
+
+SITES = json.loads(
+    (Path(__file__).parents[1] / 'data' / 'site_params.json').read_text()
+)
+
+
+@pytest.fixture
+def params_path(tmp_path):
+    path = tmp_path / 'site_params.json'
+    path.write_text(json.dumps(SITES))
+    return path
+
+
+def rewrite(path, sites):
+    # Make sure the mtime changes on coarse-grained file systems.
+    mtime = path.stat().st_mtime_ns
+    path.write_text(json.dumps(sites))
+    os.utime(path, ns=(mtime + 10**9, mtime + 10**9))
+
+
+class TestSiteParams:
+
+    def test_lazy(self, monkeypatch):
+        monkeypatch.delenv('SITE_PARAMS_PATH')
+        params = SiteParams()  # Nothing read yet
+        with pytest.raises(RuntimeError):
+            params.sites
+
+    def test_sites_named(self, params_path):
+        params = SiteParams(params_path)
+        assert [site['domain'] for site in params.sites_named('2ch')] \
+            == ['2ch.sc']
+        assert params.sites_named('foo') == []
+
+    def test_reload(self, params_path):
+        params = SiteParams(params_path)
+        classifier = params.classifier
+        assert params.classifier is classifier
+        assert params.version == 1
+
+        rewrite(params_path, SITES[:1])
+        params.reload_if_changed()
+        assert [site['name'] for site in params.sites] == ['5ch']
+        assert params.classifier is not classifier
+        assert params.version == 2
+
+    def test_no_check_on_lookup(self, params_path):
+        params = SiteParams(params_path)
+        params.sites
+        rewrite(params_path, SITES[:1])
+        assert len(params.sites) == 2
+        assert params.version == 1
+
+    def test_watch(self, params_path):
+        params = SiteParams()
+        crawler = get_crawler(settings_dict={
+            'SITE_PARAMS_PATH': str(params_path),
+            'SITE_PARAMS_CHECK_INTERVAL': 0
+        })
+        params.watch(crawler)
+        params.sites
+        rewrite(params_path, SITES[:1])
+        crawler.signals.send_catch_log(signals.spider_opened, spider=None)
+        assert [site['name'] for site in params.sites] == ['5ch']
+        assert params.version == 2
+
+    @pytest.mark.parametrize('sites', [
+        {'name': '5ch'},
+        [{'name': '5ch'}],
+        [dict(SITES[0], topic_pat='(?P<forum_id>')]
+    ])
+    def test_invalid(self, params_path, sites):
+        params_path.write_text(json.dumps(sites))
+        with pytest.raises(ValueError):
+            SiteParams(params_path).sites
+
+    def test_keep_on_invalid_reload(self, params_path):
+        params = SiteParams(params_path)
+        params.sites
+        rewrite(params_path, [{'name': '5ch'}])
+        params.reload_if_changed()
+        assert len(params.sites) == 2
@@ -0,0 +1,94 @@
+# -*- encoding: utf-8 -*-
+
+import random
+import re
+
+import pytest
+from w3lib import html
+
+from forum_scraper.utils import text
+
+SPACE_CHARACTERS = r'\t\n\x0b\x0c\r '
+# Pieces of comment bodies, tags and spaces around them
+PIECES = [
+    ' ', '\n', '\t', '\r', '\x0b', '　', '<br>', '<br', '>', '<', '/', '=',
+    '"', "'", 'a', 'br', 'span', 'ぬるぽ', '<span>', '</SPAN>', '<img src="x">',
+    '<Img', '<a href="https://example.com">', '</a>', '<a title="<span>">'
+]
+
+
+def legacy_remove_excess_spaces_str(value):
+    value = value.strip(SPACE_CHARACTERS)
+    value = re.sub(r'['+SPACE_CHARACTERS+r']+', ' ', value)
+    value = value.replace(' <br>', '<br>').replace('<br> ', '<br>')
+    return value.replace(' >', '>')
+
+
+def legacy_comment_body(value):
+    value = value.strip('\t\n\x0b\x0c\r ')
+    return html.remove_tags(value, which_ones=('span', 'img'))
+
+
+def random_texts(n):
+    rnd = random.Random(0)
+    for _ in range(n):
+        yield ''.join(rnd.choice(PIECES) for _ in range(rnd.randint(0, 12)))
+
+
+class TestCollapseSpaces:
+    @pytest.mark.parametrize('value,expected', [
+        ('', ''),
+        (' \n\x0cfoo bar<br><a>\r\t\x0b ', ' foo bar<br><a> '),
+        ('foo      bar<br><a>', 'foo bar<br><a>'),
+        ('foo bar <br> <a>', 'foo bar<br><a>'),
+        ('foo bar<br><a >', 'foo bar<br><a>'),
+        ('foo <br \n>', 'foo <br>'),
+        ('\nfoo bar', ' foo ba'),  # Strips as remove_excess_spaces_str
+        ('foo <br>\n <br> baz', 'foo<br><br>baz')
+    ])
+    def test_valid(self, value, expected):
+        assert text.collapse_spaces(value) == expected
+
+    def test_fuzz(self):
+        for value in random_texts(20000):
+            assert text.collapse_spaces(value) == \
+                legacy_remove_excess_spaces_str(value), value
+
+
+class TestRemoveSpanImg:
+    @pytest.mark.parametrize('value,expected', [
+        ('', ''),
+        ('foo<br>bar', 'foo<br>bar'),
+        ('<SPAN class="x">foo</Span><IMG src="x">', 'foo'),
+        ('<a title="<span>">foo</a>', '<a title="<span>">foo</a>')
+    ])
+    def test_valid(self, value, expected):
+        assert text.remove_span_img(value) == expected
+
+    def test_fuzz(self):
+        for value in random_texts(20000):
+            assert text.remove_span_img(value) == \
+                html.remove_tags(value, which_ones=('span', 'img')), value
+
+
+class TestTextNormalizer:
+    def test_unknown_step(self):
+        with pytest.raises(ValueError):
+            text.TextNormalizer({'body': ('strip', 'lower')})
+
+    @pytest.mark.parametrize('value', [None, 1, []])
+    def test_not_str(self, value):
+        assert text.COMMENT_TEXT['body'](value) is None
+
+    def test_comment_body(self):
+        for value in random_texts(20000):
+            assert text.COMMENT_TEXT['body'](value) == \
+                legacy_comment_body(value), value
+
+    def test_item(self):
+        item = {'body': ' foo <br> baz ', 'user_name': ' foo '}
+        assert text.EXPORTED_COMMENT_TEXT(item) is item
+        assert item == {'body': 'foo<br>baz', 'user_name': ' foo '}
+
+        item = {'body': None}
+        assert text.EXPORTED_COMMENT_TEXT(item) == {'body': None}
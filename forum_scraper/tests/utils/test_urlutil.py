@@ -2,6 +2,7 @@
 import pytest
 
 from forum_scraper.utils import urlutil
+from forum_scraper.utils.site_params import site_params
 
 TEST_URLS = [
     # 2 x Forum URLs
@@ -83,3 +84,38 @@ class TestExtractHostname:
     def test_valid_input(self, input, expected):
         actual = urlutil.extract_hostname(input)
         assert actual == expected
+
+
+class TestURLClassifier:
+
+    @pytest.fixture
+    def classify(self):
+        return urlutil.URLClassifier(site_params.sites, cache_size=2)
+
+    def test_one_pass(self, classify):
+        parsed = classify(TEST_URLS[2])
+        assert parsed.sld == '5ch'
+        assert parsed.forum is None
+        assert parsed.topic == {'forum_id': 'mnewsplus',
+                                'topic_num': '1597213268'}
+        assert parsed.comment is None
+
+    def test_domain_dispatch(self, classify):
+        assert classify('https://example.com/mnewsplus/').forum is None
+
+    def test_cache(self, classify):
+        for url in TEST_URLS[:3] + TEST_URLS[2:3]:
+            classify(url)
+        info = classify.cache_info()
+        assert (info.hits, info.misses, info.currsize) == (1, 3, 2)
+
+    def test_cached_groups_read_only(self, classify):
+        parsed = classify(TEST_URLS[2])
+        with pytest.raises(TypeError):
+            parsed.topic['forum_id'] = 'news'
+        assert classify(TEST_URLS[2]).topic['forum_id'] == 'mnewsplus'
+
+    @pytest.mark.parametrize('input', [None, 1, b'https://5ch.net/'])
+    def test_invalid_input(self, classify, input):
+        with pytest.raises(TypeError):
+            classify(input)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import queue
+import time
+
+import pytest
+from scrapy.utils.test import get_crawler
+
+from corvid.utils.writer import WriteQueue, write
+
+
+class FakeReactor:
+    '''Run the calls from the writer thread when `pump` is called.'''
+
+    def __init__(self):
+        self.calls = queue.Queue()
+
+    def callFromThread(self, func, *args):
+        self.calls.put((func, args))
+
+    def pump(self, n, timeout=5):
+        deadline = time.monotonic() + timeout
+        for _ in range(n):
+            func, args = self.calls.get(timeout=deadline - time.monotonic())
+            func(*args)
+
+
+@pytest.fixture
+def reactor():
+    return FakeReactor()
+
+
+@pytest.fixture
+def write_queue(reactor):
+    write_queue = WriteQueue(2, reactor=reactor)
+    yield write_queue
+    write_queue.stop()
+
+
+def test_backpressure(reactor, write_queue):
+    written = []
+    ds = [write_queue.submit(written.append, i) for i in range(3)]
+    assert [d.called for d in ds] == [True, True, False]
+
+    reactor.pump(1)  # Semaphore released after the 1st write
+    assert ds[2].called
+    reactor.pump(2)
+    assert written == [0, 1, 2]
+
+
+def test_drain(reactor, write_queue):
+    written = []
+    for i in range(3):
+        write_queue.submit(written.append, i)
+    d = write_queue.drain()
+    assert not d.called
+
+    # A release per write, then the drain fired and released.
+    reactor.pump(5)
+    assert d.called
+    assert written == [0, 1, 2]
+
+
+def test_errors(reactor, write_queue):
+    write_queue.submit(int, 'x')
+    write_queue.submit(int, '1')
+    reactor.pump(2)
+    assert write_queue.errors == 1
+
+
+def test_drain_failure(reactor, write_queue):
+    write_queue.stats = stats = get_crawler().stats
+    write_queue.submit(int, 'x')
+    write_queue.submit(int, 'y')
+    d = write_queue.drain()
+    failures = []
+    d.addErrback(failures.append)
+
+    reactor.pump(4)
+    failure, = failures
+    assert failure.check(ValueError)
+    assert "'x'" in str(failure.value)
+    assert stats.get_value('export/write_errors') == 2
+
+
+def test_drain_reports_once(reactor, write_queue):
+    write_queue.submit(int, 'x', tag='topic_1')
+    failures = []
+    write_queue.drain().addErrback(failures.append)
+    reactor.pump(3)  # A release per write, then the drain and its release
+    assert len(failures) == 1
+
+    # Writes since the failure reported succeeded.
+    write_queue.submit(int, '1', tag='topic_2')
+    d = write_queue.drain()
+    reactor.pump(3)
+    assert d.called and d.result is None
+    assert write_queue.failed('topic_1')
+    assert not write_queue.failed('topic_2')
+
+
+def test_wait(reactor, write_queue):
+    write_queue.submit(int, 'x', tag='topic_1')
+    d = write_queue.wait()
+    reactor.pump(3)
+    assert d.called and d.result is None
+    assert write_queue.failed('topic_1')
+
+    # Still reported by the next drain
+    failures = []
+    write_queue.drain().addErrback(failures.append)
+    reactor.pump(2)
+    assert len(failures) == 1
+
+
+def test_write_without_queue():
+    written = []
+    assert write(None, 'item', written.append, 1) == 'item'
+    assert written == [1]
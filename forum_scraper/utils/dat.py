@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+'''Tokenizer for .dat files, the raw topic format of 2ch.sc.
+
+A .dat file has a row per comment, made of fields separated by '<>':
+
+    user name<>mail<>date and user ID<>body HTML<>topic title
+
+The title is only set on the first row.
+
+Rows are only appended to the .dat of an active topic, so that what was
+added since a fetch is requested with a Range header, see `range_headers`.
+
+The topic lists, subject.txt and subback.html, show the comment count of
+each topic after its title, see `listed_count`.
+'''
+from collections import namedtuple
+import re
+from typing import Dict, List, Optional
+
+from .pipelines import DATETIME_PTTRN
+
+Row = namedtuple('Row', ['uname', 'mail', 'body', 'title', 'date', 'uid'])
+
+_DATETIME_PAT = re.compile(DATETIME_PTTRN)
+_UID_PAT = re.compile(r'([^: ]+)$')
+_CONTENT_RANGE_PAT = re.compile(rb'bytes (\d+)-(\d+)/(\d+|\*)')
+_LISTED_COUNT_PAT = re.compile(r'\((\d+)\+?\)\s*$')
+# Relative links to other comments and image URLs in comment bodies.
+REPLY_PAT = re.compile(r'(\.{2})?/test/read.cgi/\w+/\d+/\d+/?')
+IMAGE_PAT = re.compile(r'\bhttps?://[\w/\.]+\.(?:png|gif|jpg)\b')
+
+
+def decompose_row(row: str) -> Row:
+    '''Split a .dat row into its fields, the date and the user ID.
+
+    Example
+    -------
+    >>> row = ('名無しさん<>sage<>2020/08/12(水) 12:34:56.78 ID:AbCd<> '
+    ...        'ぬるぽ <>')
+    >>> row = decompose_row(row)
+    >>> row.body, row.date, row.uid
+    ('ぬるぽ', '2020/08/12(水) 12:34:56', 'AbCd')
+    '''
+    if not isinstance(row, str):
+        raise TypeError
+    data = row.split('<>')
+    date_uid = data.pop(2)
+    m = _DATETIME_PAT.match(date_uid)
+    date = m.group(0) if m is not None else None
+    m2 = _UID_PAT.search(date_uid)
+    uid = m2.group(0) if m2 is not None else None
+    data = [seg.strip() if isinstance(seg, str) else ''
+            for seg in data + [date, uid]]
+    try:
+        return Row(*data)
+    except Exception as e:
+        raise Exception(e, data + [date_uid])
+
+
+def parse_dat(text: str) -> List[Row]:
+    '''Decompose every row of a .dat file once, skipping empty rows and the
+    notice of archived topics.'''
+    return [decompose_row(row) for row in text.split('\n')
+            if row and not row.startswith('過去ログ')]
+
+
+def find_replies(body: str) -> List[str]:
+    return REPLY_PAT.findall(body)
+
+
+def find_images(body: str) -> List[str]:
+    return IMAGE_PAT.findall(body)
+
+
+def listed_count(text: str) -> Optional[int]:
+    '''Return the comment count of a topic from its row of subject.txt or its
+    link text in subback.html, None if it has none. A count past the limit
+    of a topic, like '1000+', is returned as the limit.
+
+    Example
+    -------
+    >>> listed_count('1597213268.dat<>【芸能】スレタイ (123)')
+    123
+    >>> listed_count('1: 【芸能】スレタイ (123)')
+    123
+    '''
+    if not isinstance(text, str):
+        return None
+    m = _LISTED_COUNT_PAT.search(text)
+    return None if m is None else int(m.group(1))
+
+
+def range_headers(offset: int) -> Dict[str, str]:
+    '''Headers requesting a .dat file from the last byte of a previous
+    fetch of `offset` bytes, a newline if the file was only appended to.'''
+    return {'Range': f'bytes={offset - 1}-',
+            # The offset counts the bytes of the file, not of gzip.
+            'Accept-Encoding': 'identity'}
+
+
+def dat_delta(status: int, headers, body: bytes,
+              offset: int) -> Optional[bytes]:
+    '''Return the rows appended to a .dat file of `offset` bytes, from the
+    response to a request with `range_headers(offset)`, or None if they
+    can't be told and the file must be fetched in full.
+
+    Example
+    -------
+    >>> dat_delta(206, {'Content-Range': b'bytes 99-120/121'},
+    ...           b'\\n' + b'x' * 21, 100)
+    b'xxxxxxxxxxxxxxxxxxxxx'
+    '''
+    if status != 206:
+        # 416 when the file shrank, 200 when the Range was ignored
+        return None
+
+    m = _CONTENT_RANGE_PAT.match(headers.get('Content-Range') or b'')
+    if m is None:
+        return None
+    start, end = int(m.group(1)), int(m.group(2))
+    if start != offset - 1 or end - start + 1 != len(body) \
+            or not body.startswith(b'\n'):
+        # Not where the last fetch ended, or the file was rewritten.
+        return None
+    return body[1:]
+
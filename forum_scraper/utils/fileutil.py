@@ -4,7 +4,7 @@ from typing import Any, Dict, Union
 
 from itemadapter import ItemAdapter
 
-from corvid.utils.fileutil import make_dirs
+from corvid.utils.fileutil import compile_template, make_dirs
 
 
 def get_parent_id(item_id: Union[str, None]) -> str:
@@ -39,5 +39,5 @@ def prepare_path(base_dir: str, dirname_template: str, filename_template: str,
 
     template_kwags = get_template_kwargs(item)
     dir_path = make_dirs(base_dir, dirname_template, template_kwags)
-    file_name = filename_template.format(**template_kwags)
-    return Path(dir_path) / file_name
+    file_name = compile_template(filename_template)(template_kwags)
+    return dir_path / file_name
@@ -4,9 +4,8 @@ import re
 from typing import List, Union
 from urllib.parse import urlparse, urlunparse
 
-from w3lib import html
-
 from .pipelines import DATETIME_PTTRN
+from .text import remove_span_img
 
 _SPACE_CHARACTERS = '\t\n\x0b\x0c\r '
 
@@ -67,7 +66,7 @@ def remove_span_img_tags(text: str) -> str:
     if not isinstance(text, str):
         return None
 
-    return html.remove_tags(text, which_ones=('span', 'img'))
+    return remove_span_img(text)
 
 
 def strip_space_characters(text: str) -> str:
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+'''Pool of worker processes to run spider callbacks off the reactor thread.
+
+A callback is run by a spider of the same class built in a worker, on a
+response rebuilt from the URL, body and encoding of the original. Its
+output is sent back as one pickled list, so the items of a topic are
+emitted together and in order.
+'''
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from typing import Any, Dict, List
+
+from scrapy import signals
+from scrapy.settings import Settings
+from scrapy.utils.defer import maybe_deferred_to_future
+from twisted.internet import defer
+
+from .site_params import site_params
+
+# Spiders built in a worker process, by class and settings.
+_spiders = {}
+
+
+def _run_callback(spider_cls, settings: Dict[str, Any], callback: str,
+                  response_cls, url: str, body: bytes, encoding: str,
+                  kwargs: Dict[str, Any]) -> List[Any]:
+    '''Run `callback` of a `spider_cls` spider in a worker process.'''
+    key = (spider_cls, tuple(sorted(settings.items())))
+    spider = _spiders.get(key)
+    if spider is None:
+        site_params.configure(settings.get('SITE_PARAMS_PATH'))
+        spider = _spiders[key] = spider_cls()
+        spider.settings = Settings(settings)
+
+    response = response_cls(url, body=body, encoding=encoding)
+    return list(getattr(spider, callback)(response, **kwargs))
+
+
+class ParsePool:
+    '''Run spider callbacks in `workers` processes.
+
+    At most `max_in_flight` responses are sent to the workers at once, the
+    others wait on the reactor thread. `settings` are the settings the
+    callbacks read, set on the spiders of the workers.
+
+    Example
+    -------
+    >>> async def parse_topic(self, response, **kwargs):
+    ...     return await self.parse_pool.run(self, 'parse_topic', response,
+    ...                                      kwargs)
+    '''
+    # Settings copied to the spiders of the workers.
+    settings_keys = ('SITE_PARAMS_PATH', 'COMMENT_ITEM_BUILDER',
+                     'COMMENT_BATCHES')
+
+    def __init__(self, workers: int, max_in_flight: int,
+                 settings: Dict[str, Any] = None, reactor=None):
+        # Importing the reactor installs the default one, leave it to the
+        # crawler process until a pool is built.
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        # Forking the reactor's process is not safe, spawn the workers.
+        self.executor = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn')
+        )
+        self.semaphore = defer.DeferredSemaphore(max_in_flight)
+        self.settings = {} if settings is None else settings
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        '''Return a pool from the settings of `crawler`, closed with the
+        spider, or None if `PARSE_POOL_WORKERS` is 0.'''
+        settings = crawler.settings
+        workers = settings.getint('PARSE_POOL_WORKERS', 0)
+        if workers <= 0:
+            return None
+
+        pool = cls(workers,
+                   settings.getint('PARSE_POOL_MAX_IN_FLIGHT', 2 * workers),
+                   {key: settings.get(key) for key in cls.settings_keys})
+        crawler.signals.connect(pool.close, signal=signals.spider_closed)
+        return pool
+
+    async def run(self, spider, callback: str, response,
+                  kwargs: Dict[str, Any]) -> List[Any]:
+        '''Return the output of `spider.callback(response, **kwargs)` run in
+        a worker.'''
+        d = self.semaphore.run(self._submit, spider, callback, response,
+                               kwargs)
+        return await maybe_deferred_to_future(d)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def _submit(self, spider, callback, response, kwargs) -> defer.Deferred:
+        future = self.executor.submit(
+            _run_callback, type(spider), self.settings, callback,
+            type(response), response.url, response.body, response.encoding,
+            kwargs
+        )
+
+        d = defer.Deferred()
+
+        def fire(future):
+            try:
+                result = future.result()
+            except Exception as e:
+                d.errback(e)
+            else:
+                d.callback(result)
+
+        # Called from a thread of the executor.
+        future.add_done_callback(
+            lambda future: self.reactor.callFromThread(fire, future)
+        )
+        return d
@@ -2,11 +2,14 @@
 
 from collections.abc import Hashable
 from datetime import datetime
+from functools import lru_cache
 import re
 from typing import Any, List, Tuple, Union
 
 from itemadapter import ItemAdapter
 
+from .text import collapse_spaces
+
 # Type hints
 LIST_OF_TUPLES = List[Tuple[Hashable, Any]]
 FIELDS = Union[Hashable, List[Union[Hashable, Tuple[Hashable, Any]]]]
@@ -14,6 +17,7 @@ FIELDS = Union[Hashable, List[Union[Hashable, Tuple[Hashable, Any]]]]
 # Regex pattern to extract datetime from comments
 DATETIME_PTTRN = \
     r'(?P<date>\d{2,4}/\d{2}/\d{2})\D+(?P<time>\d{2}:\d{2}(:\d{2})?)'
+_DATETIME_PAT = re.compile(DATETIME_PTTRN)
 
 
 def _fields_list(fields: FIELDS, is_child=False) -> List[Tuple[Hashable, Any]]:
@@ -69,38 +73,84 @@ def to_iso8601(item: Any, fields: FIELDS) -> Any:
     for src, dest in fields:
         text = adapter.get(src)
         if isinstance(text, str):
-            m = re.search(DATETIME_PTTRN, text)
-            if m is not None:
-                date = m.group('date')
-                time = m.group('time')
-
-                frmt = '%Y/%m/%d%H:%M:%S'
-                if len(date) == 8:
-                    frmt = frmt.replace('%Y', '%y')
-                if len(time) == 5:
-                    frmt = frmt.replace(':%S', '')
-
-                dt = datetime.strptime(date+time, frmt)
-                adapter[dest] = dt.strftime('%Y-%m-%dT%H:%M:%S+09:00')
-            else:
-                adapter[dest] = None
+            adapter[dest] = iso8601_str(text)
 
     return item
 
 
+def iso8601_str(text: str) -> Union[str, None]:
+    '''Format the date in a string into ISO format, or return None if there
+    is none. See `to_iso8601`.
+
+    The '2019/04/12(金) 19:12:51.87' layout of 2ch and 5ch is sliced without
+    the regex, and the date part of each distinct date is only parsed once.
+    Raise ValueError on an invalid date or time, like `datetime.strptime`.
+    '''
+    if (
+        len(text) >= 19 and text[4] == '/' and text[7] == '/'
+        and text[10] == '(' and text[12:14] == ') ' and text[16] == ':'
+        and (text[:4] + text[5:7] + text[8:10] + text[14:16]
+             + text[17:19]).isdecimal()
+        and not text[11].isdecimal()
+    ):
+        date = text[:10]
+        if text[19:20] == ':' and text[20:22].isdecimal() \
+                and len(text) >= 22:
+            time = text[14:22]
+        else:
+            time = text[14:19]
+    else:
+        m = _DATETIME_PAT.search(text)
+        if m is None:
+            return None
+        date = m.group('date')
+        time = m.group('time')
+
+    if not time.isascii():
+        # Other decimal digits than 0-9, written back as 0-9
+        time = ':'.join([f'{int(part):02}' for part in time.split(':')])
+    # Compared as strings of 2 digits each
+    if time[:2] > '23' or time[3:5] > '59' or time[6:] > '59':
+        raise ValueError(f'invalid time: {time}')
+    if len(time) == 5:
+        time += ':00'
+    return _iso8601_date(date) + 'T' + time + '+09:00'
+
+
+def iso8601_strs(texts: List[Any]) -> List[Union[str, None]]:
+    '''Return `iso8601_str` of each string of `texts`, None for the other
+    values.'''
+    return [iso8601_str(text) if isinstance(text, str) else None
+            for text in texts]
+
+
+@lru_cache(maxsize=4096)
+def _iso8601_date(date: str) -> str:
+    '''Return the ISO format of a date matched by `DATETIME_PTTRN`.'''
+    year, month, day = date.split('/')
+    if len(year) == 2:
+        # As `%y` does
+        year = int(year) + (1900 if int(year) >= 69 else 2000)
+    elif len(year) == 4:
+        year = int(year)
+    else:
+        raise ValueError(f'invalid year: {date}')
+    return datetime(year, int(month), int(day)).strftime('%Y-%m-%d')
+
+
 def remove_excess_spaces(item: Any, fields: FIELDS) -> Any:
 
     adapter = item if isinstance(item, ItemAdapter) else ItemAdapter(item)
     fields = _fields_list(fields)
-    ESCAPE_CHARACTERS = r'\t\n\x0b\x0c\r '
 
     for src, dest in fields:
         text = adapter.get(src)
         if isinstance(text, str):
-            text = text.strip(ESCAPE_CHARACTERS)
-            text = re.sub(r'['+ESCAPE_CHARACTERS+r']+', ' ', text)
-            text = text.replace(' <br>', '<br>').replace('<br> ', '<br>')
-            text = text.replace(' >', '>')
-            adapter[dest] = text
+            adapter[dest] = remove_excess_spaces_str(text)
 
     return item
+
+
+def remove_excess_spaces_str(text: str) -> str:
+    '''Collapse the spaces in a string. See `remove_excess_spaces`.'''
+    return collapse_spaces(text)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+'''Per-forum segment files, the 'segments' export layout.
+
+Instead of two files per topic in a directory of its own, the records of a
+forum are appended to rolling segments under `{base_dir}/{forum_id}/`:
+
+``{forum_id}.{n:05}.jsonl`` (``.jsonl.gz`` or ``.jsonl.zst`` if compressed)
+    A JSON object per line, or a gzip member or zstd frame per line if
+    compressed, so that each record can be read on its own. A new segment is
+    started once one reaches `max_bytes`.
+``{forum_id}.{n:05}.idx``
+    A line ``key<TAB>kind<TAB>offset<TAB>length`` per record of the segment,
+    to read the records of one topic without scanning the segments. Records
+    are flushed before they are indexed, and the entries past the end of a
+    segment, or cut short, are skipped by `read_records` after a crash.
+
+The files of at most `max_open` forums are kept open, those of the least
+recently written forum are closed past it and appended to again when it
+comes back.
+
+Records are ``{"kind": kind, "key": key, "data": data}`` where `kind` is
+'forum' (keyed by forum ID, `data` the item), 'topic' (keyed by topic ID,
+`data` the item) or 'comments' (keyed by topic ID, `data` CSV rows). The
+comments of a topic may come in several records, the first one with the
+header and ``"first": true``.
+'''
+from collections import OrderedDict
+import json
+from pathlib import Path
+import threading
+from typing import Any, Dict, Iterator, List, Union
+from weakref import WeakKeyDictionary
+
+from scrapy import signals
+
+from corvid.utils.compression import (
+    SUFFIXES,
+    check_codec,
+    compress,
+    compression_settings,
+    decompress
+)
+
+# Stores shared by the pipelines of each crawler
+_stores = WeakKeyDictionary()
+
+
+class SegmentWriter:
+    '''Append records to the segments of one forum.'''
+
+    def __init__(self, forum_dir: Path, forum_id: str, max_bytes: int,
+                 compression: str = None, level: int = None):
+        self.forum_dir = forum_dir
+        self.forum_id = forum_id
+        self.max_bytes = max_bytes
+        self.compression = check_codec(compression)
+        self.level = level
+        self.suffix = '.jsonl' + SUFFIXES.get(self.compression, '')
+        if not forum_dir.exists():
+            forum_dir.mkdir(parents=True)
+        # Never append to the segments of a previous run.
+        self.seq = len(list(forum_dir.glob(f'{forum_id}.*.idx')))
+        self._stem = None  # Of the segment written, kept once closed
+        self._fh = self._idx = None
+
+    def append(self, record: Dict[str, Any]):
+        line = json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n'
+        if self.compression is not None:
+            line = compress(line, self.compression, self.level)
+
+        if self._fh is None and self._stem is not None:
+            # Closed while idle
+            self._open('a')
+        if self._fh is None or (self._fh.tell() + len(line) > self.max_bytes
+                                and self._fh.tell()):
+            self._roll()
+        offset = self._fh.tell()
+        self._fh.write(line)
+        # Never index a record that isn't written, whenever the buffered index
+        # reaches the file.
+        self._fh.flush()
+        self._idx.write(f'{record["key"]}\t{record["kind"]}\t{offset}\t'
+                        f'{len(line)}\n')
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._idx.close()
+            self._fh = self._idx = None
+
+    def _roll(self):
+        self.close()
+        self._stem = f'{self.forum_id}.{self.seq:05}'
+        self._open('w')
+        self.seq += 1
+
+    def _open(self, mode):
+        self._fh = (self.forum_dir / f'{self._stem}{self.suffix}') \
+            .open(f'{mode}b')
+        self._idx = (self.forum_dir / f'{self._stem}.idx').open(mode)
+
+
+class SegmentStore:
+    '''Segment writers of all the forums under `base_dir`.
+
+    Appends are serialized by a lock, as they may come from the writer
+    thread of `corvid.utils.writer.WriteQueue`. The writers of at most
+    `max_open` forums keep their files open.
+    '''
+
+    def __init__(self, base_dir: Union[str, Path], max_bytes: int,
+                 compression: str = None, level: int = None,
+                 max_open: int = 64):
+        self.base_dir = Path(base_dir)
+        self.max_bytes = max_bytes
+        self.compression = check_codec(compression)
+        self.level = level
+        self.max_open = max_open
+        self._writers = {}
+        # Writers with open files, the least recently used first
+        self._open = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        '''Return the store of `crawler`, closed with its engine, or None
+        unless `EXPORT_LAYOUT` is 'segments'.'''
+        if crawler in _stores:
+            return _stores[crawler]
+
+        settings = crawler.settings
+        layout = settings.get('EXPORT_LAYOUT', 'directories')
+        if layout not in ('directories', 'segments'):
+            raise ValueError(f'invalid EXPORT_LAYOUT: {layout}')
+
+        store = None
+        if layout == 'segments':
+            compression = compression_settings(settings)
+            store = cls(settings.get('DATA_DIR'),
+                        settings.getint('SEGMENT_MAX_BYTES', 64 << 20),
+                        compression['compression'],
+                        compression['compression_level'],
+                        settings.getint('SEGMENT_MAX_OPEN', 64))
+            crawler.signals.connect(store.close,
+                                    signal=signals.engine_stopped)
+        _stores[crawler] = store
+        return store
+
+    def append(self, forum_id: str, kind: str, key: str, data: Any,
+               **extra):
+        record = {'kind': kind, 'key': key, 'data': data, **extra}
+        with self._lock:
+            writer = self._writers.get(forum_id)
+            if writer is None:
+                writer = self._writers[forum_id] = SegmentWriter(
+                    self.base_dir / forum_id, forum_id, self.max_bytes,
+                    self.compression, self.level
+                )
+            writer.append(record)
+            self._open[forum_id] = writer
+            self._open.move_to_end(forum_id)
+            if len(self._open) > self.max_open:
+                _, idle = self._open.popitem(last=False)
+                idle.close()
+
+    def close(self):
+        with self._lock:
+            for writer in self._writers.values():
+                writer.close()
+            self._writers.clear()
+            self._open.clear()
+
+
+def read_records(forum_dir: Union[str, Path],
+                 key: str = None) -> Iterator[Dict[str, Any]]:
+    '''Yield the records of a forum in the order they were written, only
+    those of `key` if given, read at the offsets of the index.'''
+    forum_dir = Path(forum_dir)
+    for idx_path in sorted(forum_dir.glob('*.idx')):
+        stem = idx_path.name[:-len('.idx')]
+        path = next(forum_dir.glob(f'{stem}.jsonl*'))
+
+        size = path.stat().st_size
+        with idx_path.open() as rh:
+            entries = [line[:-1].split('\t') for line in rh
+                       if line.endswith('\n')]
+        entries = [entry for entry in entries
+                   if len(entry) == 4 and (key is None or entry[0] == key)
+                   and int(entry[2]) + int(entry[3]) <= size]
+        if not entries:
+            continue
+
+        with path.open('rb') as rh:
+            for _, _, offset, length in entries:
+                rh.seek(int(offset))
+                yield json.loads(decompress(rh.read(int(length))))
+
+
+def read_topic(forum_dir: Union[str, Path], topic_id: str) -> Dict[str, Any]:
+    '''Return the last metadata and comment rows exported for a topic, as
+    'topic' and 'comments' (header first), like the files of the
+    'directories' layout.
+
+    Example
+    -------
+    >>> topic = read_topic('data/mnewsplus', 'mnewsplus_1597213268')
+    >>> topic['comments'][0][:2]  # doctest: +SKIP
+    ['site', 'comment_id']
+    '''
+    topic = None
+    comments: List[list] = []
+    for record in read_records(forum_dir, topic_id):
+        if record['kind'] == 'topic':
+            topic = record['data']
+        elif record['kind'] == 'comments':
+            if record.get('first'):
+                comments = []
+            comments.extend(record['data'])
+    return {'topic': topic, 'comments': comments}
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import re
+from typing import List
+
+from scrapy import signals
+
+# Prepare logger
+logger = logging.getLogger(__file__)
+
+REQUIRED_KEYS = ('name', 'domain', 'bbs_table', 'target_forums',
+                 'forum_pat', 'topic_pat', 'comment_pat')
+PATTERN_KEYS = ('forum_pat', 'topic_pat', 'comment_pat')
+
+
+class SiteParams:
+    '''Site params read from a JSON file, a list of one dict per site.
+
+    The file is read on first access, from `path` or else from the
+    `SITE_PARAMS_PATH` environment variable. It is validated and a
+    `URLClassifier` is built from it once, then both are rebuilt in place by
+    `reload_if_changed` whenever the file's mtime changes. Lookups never
+    check the file: `watch` checks it when a spider opens, then every
+    `check_interval` seconds.
+
+    Example
+    -------
+    >>> site_params = SiteParams('site_params.json')
+    >>> [site['bbs_table'] for site in site_params.sites_named('5ch')]
+    ['https://menu.5ch.net/bbstable.html']
+    '''
+
+    def __init__(self, path: str = None, check_interval: float = 1.0):
+        self._path = path
+        self.check_interval = check_interval
+        self.version = 0
+        self._sites = None
+        self._classifier = None
+        self._mtime = None
+
+    @property
+    def path(self) -> str:
+        if self._path is not None:
+            return self._path
+        try:
+            return os.environ['SITE_PARAMS_PATH']
+        except KeyError:
+            raise RuntimeError(
+                'no site params: set `SITE_PARAMS_PATH` or call configure()'
+            ) from None
+
+    @property
+    def sites(self) -> List[dict]:
+        if self._sites is None:
+            self.reload_if_changed()
+        return self._sites
+
+    @property
+    def classifier(self):
+        if self._classifier is None:
+            self.reload_if_changed()
+        return self._classifier
+
+    def configure(self, path: str):
+        '''Read the site params from `path` from now on.'''
+        if path is not None and path != self._path:
+            self._path = path
+            self._mtime = None
+            if self._sites is not None:
+                self.reload_if_changed()
+
+    def sites_named(self, name: str) -> List[dict]:
+        return [site for site in self.sites if site['name'] == name]
+
+    def watch(self, crawler):
+        '''Reload the site params if the file changed when a spider of
+        `crawler` opens, then every `SITE_PARAMS_CHECK_INTERVAL` seconds
+        (`check_interval` by default, 0 to only check on opening) until it
+        closes.'''
+        from twisted.internet import task
+
+        self.configure(crawler.settings.get('SITE_PARAMS_PATH'))
+        interval = crawler.settings.getfloat('SITE_PARAMS_CHECK_INTERVAL',
+                                             self.check_interval)
+        check = task.LoopingCall(self._check)
+
+        def spider_opened(spider):
+            self._check()
+            if interval > 0:
+                check.start(interval, now=False)
+
+        def spider_closed(spider):
+            if check.running:
+                check.stop()
+
+        # Not weak, nothing else refers to these closures
+        crawler.signals.connect(spider_opened, signal=signals.spider_opened,
+                                weak=False)
+        crawler.signals.connect(spider_closed, signal=signals.spider_closed,
+                                weak=False)
+
+    def _check(self):
+        # Not loaded yet, the first lookup will
+        if self._sites is not None:
+            self.reload_if_changed()
+
+    def reload_if_changed(self):
+        '''Reload the site params if the file's mtime changed. Keep those
+        loaded before if it can't be read or is invalid, raise if none
+        were.'''
+        path = self.path
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            if mtime != self._mtime:
+                self._mtime = mtime
+                self._load(path)
+        except (OSError, ValueError) as e:
+            if self._sites is None:
+                raise
+            # Keep crawling with the params loaded before.
+            logger.warning(f'Failed to reload site params from {path}: {e!r}')
+
+    def _load(self, path: str):
+        # Imported here as `urlutil` reads the site params from this module.
+        from .urlutil import URLClassifier
+
+        with open(path) as rh:
+            sites = json.load(rh)
+        validate(sites)
+
+        self._sites = sites
+        self._classifier = URLClassifier(sites)
+        self.version += 1
+        if self.version > 1:
+            logger.info(f'Reloaded site params from {path}')
+
+
+def validate(sites: List[dict]):
+    '''Raise ValueError unless `sites` is a list of site params with all the
+    keys in `REQUIRED_KEYS` and valid patterns.'''
+    if not isinstance(sites, list):
+        raise ValueError('site params must be a list of dicts')
+
+    for i, site in enumerate(sites):
+        if not isinstance(site, dict):
+            raise ValueError(f'site params #{i} is not a dict')
+        missing = [key for key in REQUIRED_KEYS if key not in site]
+        if missing:
+            raise ValueError(f'site params #{i} misses {", ".join(missing)}')
+        for key in PATTERN_KEYS:
+            try:
+                re.compile(site[key])
+            except re.error as e:
+                raise ValueError(
+                    f'invalid {key} in site params #{i}: {e}'
+                ) from None
+
+
+# Shared by the URL helpers and the spiders.
+site_params = SiteParams()
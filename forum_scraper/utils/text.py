@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+'''Normalizers of comment text, built once from a spec of steps per field.
+
+Steps (see `STEPS`) give the same results as the loader processors and
+pipeline helpers they replace:
+
+'strip'
+    Strip space characters, as `strip_space_characters`.
+'remove_span_img'
+    Remove <span> and <img> tags, as `remove_span_img_tags`.
+'collapse_spaces'
+    Collapse space characters and tidy them around tags, as
+    `remove_excess_spaces_str`.
+
+Bodies are normalized twice, as the chain did: `COMMENT_TEXT` when loaded,
+keeping the spaces of ASCII art, and `EXPORTED_COMMENT_TEXT` when exported,
+on the bodies the export pipeline selects. Within a step, runs of spaces are
+not collapsed in one regex pass: the choice between '' and ' ' per run needs
+a replacement function, measured 12x slower on the bodies of
+benchmarks/bench_normalizer.py than the C-level replaces. Steps skip the
+bodies they would not change instead.
+'''
+import re
+from typing import Any, Callable, Dict, Optional, Sequence
+
+from itemadapter import ItemAdapter
+from w3lib.html import remove_tags
+
+SPACE_CHARACTERS = '\t\n\x0b\x0c\r '
+# What `remove_excess_spaces_str` has always stripped: a raw string, so the
+# characters of the escapes rather than the space characters.
+_EXCESS_CHARACTERS = r'\t\n\x0b\x0c\r '
+
+# The tags `remove_tags` may remove start like this, most bodies have none.
+_SPAN_IMG_PAT = re.compile(r'</?(?:span|img)', re.IGNORECASE)
+_SPACES_PAT = re.compile(rf'[{SPACE_CHARACTERS}]+')
+_NOT_SPACES = SPACE_CHARACTERS[:-1]
+
+
+def strip(text: str) -> str:
+    return text.strip(SPACE_CHARACTERS)
+
+
+def remove_span_img(text: str) -> str:
+    if _SPAN_IMG_PAT.search(text) is None:
+        return text
+    return remove_tags(text, which_ones=('span', 'img'))
+
+
+def collapse_spaces(text: str) -> str:
+    '''Replace the runs of space characters with a space, and drop it next
+    to a <br> or before a '>'.
+
+    Example
+    -------
+    >>> collapse_spaces(' foo  \\n bar <br>  baz >')
+    'foo bar<br>baz>'
+    '''
+    text = text.strip(_EXCESS_CHARACTERS)
+    # Most bodies only have spaces, collapsed faster without the pattern.
+    if any(c in text for c in _NOT_SPACES):
+        text = _SPACES_PAT.sub(' ', text)
+    else:
+        while '  ' in text:
+            text = text.replace('  ', ' ')
+    return text.replace(' <br>', '<br>').replace('<br> ', '<br>') \
+        .replace(' >', '>')
+
+
+STEPS = {
+    'strip': strip,
+    'remove_span_img': remove_span_img,
+    'collapse_spaces': collapse_spaces,
+}
+
+
+def compile_steps(steps: Sequence[str]) -> Callable[[Any], Optional[str]]:
+    '''Return a function applying `steps` to a str, and returning None for
+    other values.'''
+    funcs = [STEPS[step] for step in steps]
+    if len(funcs) == 1:
+        func, = funcs
+
+        def normalize(text):
+            return func(text) if isinstance(text, str) else None
+
+        return normalize
+
+    def normalize(text):
+        if not isinstance(text, str):
+            return None
+        for func in funcs:
+            text = func(text)
+        return text
+
+    return normalize
+
+
+class TextNormalizer:
+    '''Normalize text fields of items following `spec`, a dict of field
+    names to the steps to apply in order.
+
+    Example
+    -------
+    >>> normalizer = TextNormalizer({'body': ('strip', 'remove_span_img')})
+    >>> normalizer['body'](' <span>ぬるぽ</span> ')
+    'ぬるぽ'
+    '''
+
+    def __init__(self, spec: Dict[str, Sequence[str]]):
+        unknown = {step for steps in spec.values() for step in steps
+                   if step not in STEPS}
+        if unknown:
+            raise ValueError(f'unknown steps: {", ".join(sorted(unknown))}')
+        self.spec = dict(spec)
+        self.fields = {field: compile_steps(steps)
+                       for field, steps in spec.items()}
+
+    def __getitem__(self, field: str) -> Callable[[Any], Optional[str]]:
+        return self.fields[field]
+
+    def __call__(self, item: Any) -> Any:
+        '''Normalize the str values of the fields of `item` in place.'''
+        adapter = item if isinstance(item, ItemAdapter) else ItemAdapter(item)
+        for field, normalize in self.fields.items():
+            text = adapter.get(field)
+            if isinstance(text, str):
+                adapter[field] = normalize(text)
+        return item
+
+
+# Comment text, once loaded and once exported
+COMMENT_TEXT = TextNormalizer({'body': ('strip', 'remove_span_img')})
+EXPORTED_COMMENT_TEXT = TextNormalizer({'body': ('collapse_spaces',)})
@@ -1,103 +1,188 @@
 # -*- coding: utf-8 -*-
-import json
 import logging
-import os
 import re
+from functools import lru_cache
+from types import MappingProxyType
+from typing import List, Mapping, NamedTuple, Optional, Tuple
 from urllib.parse import urlparse
 
 from corvid.utils.urlutil import get_sld_from_url
+from .site_params import site_params
 
 # Prepare logger
 logger = logging.getLogger(__file__)
 
-# Prepare domain dict with regex.
-with open(os.environ['SITE_PARAMS_PATH']) as rh:
-    SITE_PARAMS = json.load(rh)
+# A read.cgi URL, up to the topic number
+_READ_CGI_PAT = re.compile(r'^(https?://[^/]+/test/read\.cgi/\w+/\d+)(?:/|$)')
 
 
-def is_forum_url(url: str) -> bool:
-    if not isinstance(url, str):
-        raise TypeError()
+class ParsedURL(NamedTuple):
+    '''Groups matched in a URL by `URLClassifier`. `forum`, `topic` and
+    `comment` hold the groups of the first forum, topic and comment patterns
+    matched, as read-only mappings shared through the cache, or None.'''
+    sld: Optional[str]
+    forum: Optional[Mapping[str, str]]
+    topic: Optional[Mapping[str, str]]
+    comment: Optional[Mapping[str, str]]
 
-    return parse_url(url, 'forum_pat')
 
+class URLClassifier:
+    '''Match a URL against the forum, topic and comment patterns of all the
+    sites in `site_params` at once.
 
-def is_topic_url(url: str) -> bool:
-    if not isinstance(url, str):
-        raise TypeError()
+    Patterns are compiled once and only the sites whose domain is in the
+    host of a URL are tried. The last `cache_size` URLs are cached, as the
+    same URLs are seen by the middleware, the loaders and the pipelines.
 
-    return parse_url(url, 'topic_pat')
+    Example
+    -------
+    >>> classify = URLClassifier(site_params.sites)
+    >>> parsed = classify('https://mao.5ch.net/test/read.cgi/bass/1579960729/')
+    >>> parsed.sld, dict(parsed.topic)
+    ('5ch', {'forum_id': 'bass', 'topic_num': '1579960729'})
+    '''
 
+    def __init__(self, site_params: List[dict], cache_size: int = 4096):
+        self.sites = [(site['domain'],
+                       re.compile(site['forum_pat']),
+                       re.compile(site['topic_pat']))
+                      for site in site_params]
+        self.comment_pats = [re.compile(site['comment_pat'])
+                             for site in site_params]
+        self._sites_for = lru_cache(maxsize=256)(self._sites_for)
+        self._classify = lru_cache(maxsize=cache_size)(self._classify)
 
-def is_comment_url(url: str) -> bool:
-    if not isinstance(url, str):
-        raise TypeError
+    def __call__(self, url: str) -> ParsedURL:
+        if not isinstance(url, str):
+            raise TypeError()
 
-    # Is always a relative URL
-    for site_info in SITE_PARAMS:
-        m = re.match(site_info['comment_pat'], url)
-        if m:
-            return m
+        return self._classify(url)
 
-    return False
+    def cache_info(self):
+        return self._classify.cache_info()
 
+    def _sites_for(self, netloc: str):
+        return [site for site in self.sites if site[0] in netloc]
 
-def parse_url(url: str, key: str):
-    parsed = urlparse(url)
+    def _classify(self, url: str) -> ParsedURL:
+        parsed = urlparse(url)
+        forum = topic = comment = None
+        for _, forum_pat, topic_pat in self._sites_for(parsed.netloc):
+            if forum is None:
+                m = forum_pat.match(parsed.path)
+                forum = m and MappingProxyType(m.groupdict())
+            if topic is None:
+                m = topic_pat.match(parsed.path)
+                topic = m and MappingProxyType(m.groupdict())
 
-    for site_info in SITE_PARAMS:
-        m = re.match(site_info[key], parsed.path)
-        if site_info['domain'] in parsed.netloc and m:
-            return m
+        # Is always a relative URL
+        for comment_pat in self.comment_pats:
+            m = comment_pat.match(url)
+            if m:
+                comment = MappingProxyType(m.groupdict())
+                break
 
-    return None
+        labels = parsed.netloc.split('.')
+        sld = labels[-2] if len(labels) > 1 else None
+        return ParsedURL(sld, forum, topic, comment)
 
 
-def forum_id_from_url(url: str) -> str:
+def classify_url(url: str) -> ParsedURL:
+    '''Classify `url` with the current site params.'''
+    return site_params.classifier(url)
 
-    m_frm = is_forum_url(url)
-    m_tpc = is_topic_url(url)
-    m_cmt = is_comment_url(url)
 
-    if m_frm:
-        m = m_frm
-    elif m_tpc:
-        m = m_tpc
-    elif m_cmt:
-        m = m_cmt
-    else:
+def _sld(parsed: ParsedURL, url: str) -> str:
+    # URLs without a host raise as they always have.
+    return parsed.sld if parsed.sld is not None else get_sld_from_url(url)
+
+
+def is_forum_url(url: str) -> bool:
+    return classify_url(url).forum is not None
+
+
+def is_topic_url(url: str) -> bool:
+    return classify_url(url).topic is not None
+
+
+def is_comment_url(url: str) -> bool:
+    return classify_url(url).comment is not None
+
+
+def forum_id_from_url(url: str) -> str:
+    parsed = classify_url(url)
+    groups = parsed.forum or parsed.topic or parsed.comment
+    if groups is None:
         return None
 
-    sld = get_sld_from_url(url)
-    return '_'.join([sld, m.group('forum_id')])
+    return '_'.join([_sld(parsed, url), groups['forum_id']])
 
 
 def topic_id_from_url(url: str) -> str:
+    parsed = classify_url(url)
+    groups = parsed.topic or parsed.comment
+    if groups is None:
+        return None
 
-    m_tpc = is_topic_url(url)
-    m_cmt = is_comment_url(url)
+    return '_'.join([_sld(parsed, url), groups['forum_id'],
+                     groups['topic_num']])
 
-    if m_tpc:
-        m = m_tpc
-    elif m_cmt:
-        m = m_cmt
-    else:
+
+def topic_key_from_url(url: str) -> Tuple[str, int]:
+    '''Return the forum ID and the topic number (int) of a topic URL.
+
+    Example
+    -------
+    >>> url = 'http://hayabusa5.2ch.sc/mnewsplus/dat/1597213268.dat'
+    >>> topic_key_from_url(url)
+    ('2ch_mnewsplus', 1597213268)
+    '''
+    parsed = classify_url(url)
+    groups = parsed.topic
+    if groups is None:
         return None
 
-    sld = get_sld_from_url(url)
-    return '_'.join([sld, m.group('forum_id'), m.group('topic_num')])
+    return ('_'.join([_sld(parsed, url), groups['forum_id']]),
+            int(groups['topic_num']))
 
 
-def comment_id_from_url(url: str) -> str:
+def topic_base_url(url: str) -> Optional[str]:
+    '''Return the read.cgi URL of a topic without the range of posts of
+    `url`, or None if it isn't one.
 
-    m = is_comment_url(url)
+    Example
+    -------
+    >>> topic_base_url('https://hayabusa9.5ch.net/test/read.cgi/mnewsplus/'
+    ...                '1596250713/l50')
+    'https://hayabusa9.5ch.net/test/read.cgi/mnewsplus/1596250713/'
+    '''
+    m = _READ_CGI_PAT.match(url)
+    return None if m is None else m.group(1) + '/'
 
-    if not m:
+
+def topic_range_url(url: str, start: int) -> Optional[str]:
+    '''Return the read.cgi URL of the posts of a topic from number `start`
+    on, without the first one, or None if `url` isn't a read.cgi URL.
+
+    Example
+    -------
+    >>> topic_range_url('https://hayabusa9.5ch.net/test/read.cgi/mnewsplus/'
+    ...                 '1596250713/l50', 13)
+    'https://hayabusa9.5ch.net/test/read.cgi/mnewsplus/1596250713/13-n'
+    '''
+    base = topic_base_url(url)
+    return None if base is None else f'{base}{start}-n'
+
+
+def comment_id_from_url(url: str) -> str:
+    parsed = classify_url(url)
+    groups = parsed.comment
+    if groups is None:
         return None
 
-    sld = get_sld_from_url(url)
-    return '_'.join([sld, m.group('forum_id'), m.group('topic_num'),
-                     f'{int(m.group("comment_num")):0>4}'])
+    return '_'.join([_sld(parsed, url), groups['forum_id'],
+                     groups['topic_num'],
+                     f'{int(groups["comment_num"]):0>4}'])
 
 
 def extract_hostname(url: str) -> str:
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+'''Bloom filter persisted in a memory-mapped file.
+
+The file starts with a header (see `_HEADER`) followed by the bit array. Like
+the history index (see `corvid.utils.history`), the header carries a dirty
+flag which is raised before the first unflushed insert and cleared by
+`flush`, so a filter left behind by a crashed process is never trusted.
+'''
+from hashlib import blake2b
+import math
+import mmap
+import os
+from pathlib import Path
+import struct
+from typing import Iterable, Union
+
+_MAGIC = b'CVDB'
+_VERSION = 1
+# magic, version, dirty flag, number of bits, number of hashes, capacity,
+# number of entries added, target false-positive rate
+_HEADER = struct.Struct('<4sHH4Qd')
+_MASK64 = (1 << 64) - 1
+
+
+def optimal_params(capacity: int, error_rate: float):
+    '''Return the number of bits and of hash functions for a Bloom filter of
+    `capacity` entries with a false-positive rate of `error_rate`.
+
+    Example
+    -------
+    >>> optimal_params(1000000, 0.01)
+    (9585059, 7)
+    '''
+    if capacity <= 0:
+        raise ValueError(f'capacity must be positive: {capacity}')
+    if not 0 < error_rate < 1:
+        raise ValueError(f'error_rate must be in (0, 1): {error_rate}')
+
+    nbits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    nhashes = max(1, round(nbits / capacity * math.log(2)))
+    return nbits, nhashes
+
+
+class BloomFilter:
+    '''Set membership filter without false negatives.
+
+    `entry in bloom` is False only for entries never added, and True for
+    added ones or, with a probability close to `error_rate` while no more
+    than `capacity` entries are added, for others. `hits` and `misses` count
+    the lookups answered True and False.
+
+    `self.is_new` tells whether the file was (re)created empty, in which case
+    the caller has to add the entries it already holds.
+    '''
+
+    def __init__(self, path: Union[str, os.PathLike], capacity: int,
+                 error_rate: float = 0.01):
+        self.path = Path(path)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.nbits, self.nhashes = optimal_params(capacity, error_rate)
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+
+        header = self._read_header()
+        self.is_new = (
+            header is None
+            or header['dirty']
+            or header['capacity'] != capacity
+            or header['error_rate'] != error_rate
+        )
+        if self.is_new:
+            self._create()
+            self.count = 0
+        else:
+            self.count = header['count']
+        self._fh = self.path.open('r+b')
+        self._mm = mmap.mmap(self._fh.fileno(), 0)
+
+    def __contains__(self, entry: str) -> bool:
+        mm = self._mm
+        offset = _HEADER.size
+        for pos in self._positions(entry):
+            if not mm[offset + (pos >> 3)] & (1 << (pos & 7)):
+                self.misses += 1
+                return False
+        self.hits += 1
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def add(self, entry: str):
+        if not self._dirty:
+            self._write_header(dirty=True)
+            self._dirty = True
+
+        mm = self._mm
+        offset = _HEADER.size
+        added = False
+        for pos in self._positions(entry):
+            byte = offset + (pos >> 3)
+            bit = 1 << (pos & 7)
+            if not mm[byte] & bit:
+                mm[byte] |= bit
+                added = True
+        self.count += added
+
+    def update(self, entries: Iterable[str]):
+        for entry in entries:
+            self.add(entry)
+
+    def flush(self, fsync: bool = False):
+        self._write_header(dirty=False)
+        if fsync:
+            self._mm.flush()
+        self._dirty = False
+
+    def close(self):
+        if self._mm is None:
+            return
+        self.flush()
+        self._mm.close()
+        self._fh.close()
+        self._mm = self._fh = None
+
+    def _positions(self, entry: str):
+        '''Bit positions of `entry` by double hashing a 128-bit digest.'''
+        digest = blake2b(entry.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        nbits = self.nbits
+        for i in range(self.nhashes):
+            yield ((h1 + i * h2) & _MASK64) % nbits
+
+    def _read_header(self):
+        if not self.path.exists():
+            return None
+        with self.path.open('rb') as rh:
+            raw = rh.read(_HEADER.size)
+            if len(raw) < _HEADER.size:
+                return None
+            magic, version, dirty, nbits, nhashes, capacity, count, \
+                error_rate = _HEADER.unpack(raw)
+            if (
+                magic != _MAGIC
+                or version != _VERSION
+                or nbits != self.nbits
+                or nhashes != self.nhashes
+                or rh.seek(0, os.SEEK_END) != _HEADER.size + (nbits + 7) // 8
+            ):
+                return None
+        return {'dirty': dirty, 'capacity': capacity, 'count': count,
+                'error_rate': error_rate}
+
+    def _create(self):
+        parent = self.path.parents[0]
+        if not parent.exists():
+            parent.mkdir(parents=True)
+        with self.path.open('wb') as wh:
+            wh.write(_HEADER.pack(_MAGIC, _VERSION, 1, self.nbits,
+                                  self.nhashes, self.capacity, 0,
+                                  self.error_rate))
+            wh.truncate(_HEADER.size + (self.nbits + 7) // 8)
+
+    def _write_header(self, dirty: bool):
+        self._mm[:_HEADER.size] = _HEADER.pack(
+            _MAGIC, _VERSION, int(dirty), self.nbits, self.nhashes,
+            self.capacity, self.count, self.error_rate
+        )
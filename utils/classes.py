@@ -1,87 +1,179 @@
 # -*- coding: utf-8 -*-
-from collections.abc import MutableSet
+from collections.abc import Mapping, MutableSet
+from itertools import islice
 
 from itemadapter import ItemAdapter
 
 
 class ItemBuffer:
+    '''Rows of items with the fields of the first one, header first, to be
+    written with `csv.writer`.
+
+    Values are kept per field in `columns`. List values are joined with
+    `delimiter` when stored, and the values of `interned_fields`, repeated on
+    most rows, are kept once per buffer. Rows are only built as lists while
+    iterating.
+
+    `len` and iteration count the header as a row until `clear` or `detach`
+    hands it out with the first rows.
+    '''
+    __slots__ = ('header', 'columns', 'delimiter', '_num_rows',
+                 '_header_pending', '_interned', '_interned_flags')
+    interned_fields = frozenset({'site', 'forum_id', 'topic_id', 'user_name',
+                                 'blog', 'src_site'})
+
     def __init__(self):
-        self._headers_not_written = True
-        self.buffer = []
         self.header = []
+        self.columns = []
         self.delimiter = ';'  # Used to join a list when a field contains one
+        self._num_rows = 0
+        self._header_pending = False
+        self._interned = {}
+        self._interned_flags = []
 
     def __iter__(self):
-        for row in self.buffer:
-            yield row
+        if self._header_pending:
+            yield list(self.header)
+        for row in zip(*self.columns):
+            yield list(row)
 
     def __len__(self):
-        return len(self.buffer)
+        return self._num_rows + self._header_pending
 
     def store(self, item):
-        adapter = ItemAdapter(item)
+        if not self.header:
+            self._set_header(ItemAdapter(item).field_names())
+
+        get = item.get if isinstance(item, Mapping) else \
+            ItemAdapter(item).get
+        for field, column, interned in zip(self.header, self.columns,
+                                           self._interned_flags):
+            column.append(self._value(get(field), interned))
+        self._num_rows += 1
 
-        if self._headers_not_written:
-            # Store field_names in a list to make sure the order stays the same
-            self.header = adapter.field_names()
-            self.buffer.append(adapter.field_names())
-            self._headers_not_written = False
+    def store_columns(self, columns):
+        '''Store rows from `columns`, a dict of field names to lists of
+        values, as `store` does for items with these fields.'''
+        if not self.header:
+            self._set_header(columns)
 
-        temp = []
-        for field in self.header:
-            val = adapter.get(field)
-            if isinstance(val, list):
-                val = self.delimiter.join([str(v) for v in val])
-            temp.append(val)
+        values = [columns[field] for field in self.header]
+        num_rows = min(map(len, values)) if values else 0
+        for column, vals, interned in zip(self.columns, values,
+                                          self._interned_flags):
+            column.extend([self._value(val, interned)
+                           for val in vals[:num_rows]])
+        self._num_rows += num_rows
 
-        self.buffer.append(temp)
+    def clear(self):
+        '''Drop the stored rows, keeping the header off the next ones as it
+        was stored already.'''
+        self.columns = [[] for _ in self.header]
+        self._num_rows = 0
+        self._header_pending = False
+
+    def detach(self, header: bool = True) -> 'ItemBuffer':
+        '''Return a buffer with the stored rows, header included if pending
+        unless `header` is False, and `clear` this one.'''
+        rows = ItemBuffer()
+        rows.header = self.header
+        rows.columns = self.columns
+        rows.delimiter = self.delimiter
+        rows._num_rows = self._num_rows
+        rows._header_pending = self._header_pending and header
+        self.clear()
+        return rows
+
+    def _set_header(self, field_names):
+        # Store field_names in a list to make sure the order stays the same
+        self.header = list(field_names)
+        self.columns = [[] for _ in self.header]
+        self._header_pending = True
+        self._interned_flags = [field in self.interned_fields
+                                for field in self.header]
+
+    def _value(self, val, interned):
+        if isinstance(val, list):
+            try:
+                return self.delimiter.join(val)
+            except TypeError:
+                return self.delimiter.join([str(v) for v in val])
+        if interned and isinstance(val, str):
+            return self._interned.setdefault(val, val)
+        return val
 
 
 class OrderedSet(MutableSet):
+    '''Set that remembers insertion order and supports positional access.
+
+    Keys are kept in a gap buffer: `_front` holds the keys before the gap in
+    order from `_head` on, `_back` holds the keys after the gap in reverse
+    order, and `_tail` the keys added at the end while `_back` is not empty,
+    in order. Inserting at the gap and adding or removing at either end are
+    amortized O(1). `_keys` indexes the keys for membership tests.
+
+    Indexing is O(1). Inserting next to a key at either end or around the gap
+    is O(1), elsewhere the gap moves with a bulk copy. Keys are looked up at
+    these positions first, then searched in linear time. Per key, the
+    container costs one pointer in a list plus one set entry: 8 + 16 / load
+    (0.3-0.6) bytes, i.e. about 35-60 bytes on 64-bit CPython, not counting
+    the keys themselves.
+
+    Pickles hold the keys as one flat list (see `__getstate__`), so saving and
+    loading take linear time and constant stack depth. Pickles of the former
+    linked-list implementation are converted by `__setstate__`.
+    '''
+    __slots__ = ('_front', '_head', '_back', '_tail', '_keys')
+    _state_version = 2
 
     def __init__(self, iterable=None):
-        self.end = end = []
-        end += [None, end, end]
-        self.map = {}
+        self._front = []
+        self._head = 0
+        self._back = []
+        self._tail = []
+        self._keys = set()
         if iterable is not None:
             self |= iterable
 
     def __len__(self):
-        return len(self.map)
+        return len(self._keys)
 
     def __contains__(self, key):
-        return key in self.map
+        return key in self._keys
 
     def __getitem__(self, key):
         if isinstance(key, slice):
             start, end, step = key.indices(len(self))
-            return OrderedSet([self[i] for i in range(start, end, step)])
+            return self.__class__([self[i] for i in range(start, end, step)])
 
         if isinstance(key, int):
-            if key >= len(self):
-                raise KeyError()
+            length = len(self)
             if key < 0:
-                it = reversed(self)
-                key = abs(key) - 1
-            else:
-                it = iter(self)
+                key += length
+            if not 0 <= key < length:
+                raise KeyError(key)
+
+            front, back = self._front, self._back
+            key += self._head
+            if key < len(front):
+                return front[key]
+            key -= len(front)
+            if key < len(back):
+                return back[len(back) - 1 - key]
+            return self._tail[key - len(back)]
 
-            [next(it) for _ in range(key)]
-            return next(it)
+        raise TypeError(f'indices must be int or slice (provided {type(key)})')
 
     def __iter__(self):
-        end = self.end
-        curr = end[2]
-        while curr is not end:
-            yield curr[0]
-            curr = curr[2]
+        yield from islice(self._front, self._head, None)
+        yield from reversed(self._back)
+        yield from self._tail
 
     def __reversed__(self):
-        end = self.end
-        curr = end[1]
-        while curr is not end:
-            yield curr[0]
-            curr = curr[1]
+        front = self._front
+        yield from reversed(self._tail)
+        yield from self._back
+        yield from islice(reversed(front), len(front) - self._head)
 
     def __repr__(self):
         if not self:
@@ -94,49 +186,186 @@ class OrderedSet(MutableSet):
             return len(self) == len(other) and list(self) == list(other)
         return set(self) == set(other)
 
+    def __getstate__(self):
+        return {'version': self._state_version, 'keys': list(self)}
+
+    def __setstate__(self, state):
+        if 'end' in state:
+            # Linked list of [key, prev, next] nodes from version 1.
+            keys = []
+            end = state['end']
+            curr = end[2]
+            while curr is not end:
+                keys.append(curr[0])
+                curr = curr[2]
+        elif state.get('version') == self._state_version:
+            keys = state['keys']
+        else:
+            raise ValueError(f'unknown {self.__class__.__name__} state: '
+                             f'version {state.get("version")}')
+
+        self._front = list(keys)
+        self._head = 0
+        self._back = []
+        self._tail = []
+        self._keys = set(self._front)
+
+    def __sizeof__(self):
+        return (object.__sizeof__(self) + self._front.__sizeof__()
+                + self._back.__sizeof__() + self._tail.__sizeof__()
+                + self._keys.__sizeof__())
+
     def add(self, key):
-        if key not in self.map:
-            end = self.end
-            curr = end[1]
-            curr[2] = end[1] = self.map[key] = [key, curr, end]
+        if key not in self._keys:
+            if self._back:
+                self._tail.append(key)
+            else:
+                self._front.append(key)
+            self._keys.add(key)
 
     def add_before(self, target_key, new_key):
-        if target_key not in self.map:
-            raise KeyError()
-        if new_key not in self.map:
-            target = self.map[target_key]
-            prev = target[1]
-            prev[2] = target[1] = self.map[new_key] = [new_key, prev, target]
+        if target_key not in self._keys:
+            raise KeyError(target_key)
+        if new_key not in self._keys:
+            self._move_gap(self._index(target_key))
+            self._front.append(new_key)
+            self._keys.add(new_key)
 
     def add_after(self, target_key, new_key):
-        if target_key not in self.map:
-            raise KeyError()
-        if new_key not in self.map:
-            target = self.map[target_key]
-            next_val = target[2]
-            next_val[1] = target[2] = self.map[new_key] = \
-                [new_key, target, next_val]
+        if target_key not in self._keys:
+            raise KeyError(target_key)
+        if new_key not in self._keys:
+            self._move_gap(self._index(target_key) + 1)
+            self._front.append(new_key)
+            self._keys.add(new_key)
 
     def discard(self, key):
-        if key in self.map:
-            key, prev, next_val = self.map[key]
-            prev[2] = next_val
-            next_val[1] = prev
-            del self.map[key]
+        if key in self._keys:
+            self._remove_at(self._index(key))
 
     def pop(self, last=True):
         if not self:
             raise KeyError('set is empty')
-        key = self.end[1][0] if last else self.end[2][0]
-        self.discard(key)
+        index = len(self) - 1 if last else 0
+        key = self[index]
+        self._remove_at(index)
         return key
 
+    def truncate(self, length):
+        '''Remove the keys after the first `length` ones in bulk.'''
+        front, back, tail = self._front, self._back, self._tail
+        excess = len(self) - max(length, 0)
+        if excess <= 0:
+            return
+
+        # The last keys are in `_tail`, then at the start of `_back`, then at
+        # the end of `_front`.
+        n_tail = min(excess, len(tail))
+        removed = tail[len(tail) - n_tail:]
+        del tail[len(tail) - n_tail:]
+        n_back = min(excess - n_tail, len(back))
+        removed += back[:n_back]
+        del back[:n_back]
+        n_front = excess - n_tail - n_back
+        if n_front:
+            removed += front[len(front) - n_front:]
+            del front[len(front) - n_front:]
+        self._keys.difference_update(removed)
+        self._settle()
+
+    def _index(self, key):
+        '''Return the position of `key`, checking both ends and the gap
+        boundary first.'''
+        front, head, back, tail = \
+            self._front, self._head, self._back, self._tail
+        n_front = len(front) - head
+        if back and back[-1] == key:
+            return n_front
+        if n_front and front[-1] == key:
+            return n_front - 1
+        if n_front and front[head] == key:
+            return 0
+        if tail and tail[-1] == key:
+            return len(self) - 1
+        if not tail and back and back[0] == key:
+            return len(self) - 1
+        try:
+            return front.index(key, head) - head
+        except ValueError:
+            pass
+        try:
+            return n_front + len(back) - 1 - back.index(key)
+        except ValueError:
+            return n_front + len(back) + tail.index(key)
+
+    def _remove_at(self, index):
+        '''Remove the key at position `index`.'''
+        front, head, back, tail = \
+            self._front, self._head, self._back, self._tail
+        n_front = len(front) - head
+        if index == 0 and n_front:
+            # Leave the slot for a bulk delete once half of `_front` is free
+            self._keys.remove(front[head])
+            front[head] = None
+            self._head = head = head + 1
+            if head * 2 >= len(front):
+                del front[:head]
+                self._head = 0
+            return
+
+        if index == len(self) - 1 and back and not tail:
+            # The last key is at the start of `_back`, pop it from `_front`
+            self._move_gap(index + 1)
+            n_front = index + 1
+        if index < n_front:
+            key = front.pop(head + index)
+        elif index < n_front + len(back):
+            key = back.pop(n_front + len(back) - 1 - index)
+        else:
+            key = tail.pop(index - n_front - len(back))
+        self._keys.remove(key)
+        self._settle()
+
+    def _settle(self):
+        '''Keep `_tail` empty while `_back` is, for `add` to append to
+        `_front`.'''
+        if not self._back and self._tail:
+            self._front += self._tail
+            self._tail.clear()
+
+    def _move_gap(self, index):
+        '''Move the gap so that `len(self._front) - self._head == index`.'''
+        front, back, tail = self._front, self._back, self._tail
+        index += self._head
+        if index < len(front):
+            back.extend(reversed(front[index:]))
+            del front[index:]
+        elif index > len(front):
+            n = index - len(front)
+            if n >= len(back) and tail:
+                # Up to the keys added at the end, kept after the gap
+                back[:0] = reversed(tail)
+                tail.clear()
+            front.extend(reversed(back[len(back) - n:]))
+            del back[len(back) - n:]
+
 
 class URLOrderedSet(OrderedSet):
+    __slots__ = ('pivot_url',)
+
     def __init__(self, iterable=None, pivot_url=None):
         super().__init__(iterable)
         self.pivot_url = pivot_url
 
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['pivot_url'] = self.pivot_url
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.pivot_url = state.get('pivot_url')
+
     def add_url(self, new_url):
         if self.pivot_url is None:
             self.add(new_url)
@@ -148,12 +377,10 @@ class URLOrderedSet(OrderedSet):
             raise KeyError('set is empty')
         if pivot_url is None:
             self.pivot_url = self[0]
-        elif pivot_url in self.map:
+        elif pivot_url in self._keys:
             self.pivot_url = pivot_url
         else:
-            raise KeyError()
+            raise KeyError(pivot_url)
 
     def trim(self, max_length=1000):
-        if len(self) > max_length:
-            for _ in range(len(self) - max_length):
-                self.pop()
+        self.truncate(max_length)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+'''Streaming compression of exported files.
+
+Files are compressed with gzip, or with zstd if the `zstandard` package is
+installed, and get the suffix of their codec (see `SUFFIXES`). Appending to a
+compressed file adds a gzip member or a zstd frame, which readers decompress
+as part of the same stream.
+
+Example
+-------
+>>> with open_text('topic.csv', 'w', 'gzip') as wh:  # Writes topic.csv.gz
+...     _ = wh.write('text')
+>>> with open_export('topic.csv') as rh:
+...     rh.read()
+'text'
+'''
+import gzip
+import io
+import os
+from pathlib import Path
+from typing import IO, Union
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+# Levels used when none is set, about as fast as writing plain text
+DEFAULT_LEVELS = {'gzip': 6, 'zstd': 3}
+_MAGIC = {b'\x1f\x8b': 'gzip', b'\x28\xb5\x2f\xfd': 'zstd'}
+
+
+def check_codec(compression: Union[str, None]) -> Union[str, None]:
+    '''Return `compression`, None for no compression, or raise ValueError
+    unless it's a codec available here.'''
+    if not compression:
+        return None
+    if compression not in SUFFIXES:
+        raise ValueError(f'unknown compression: {compression}')
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError('zstd compression needs the `zstandard` package')
+    return compression
+
+
+def compression_settings(settings) -> dict:
+    '''Return the `compression` and `compression_level` of the exports set
+    by `EXPORT_COMPRESSION` and `EXPORT_COMPRESSION_LEVEL`.'''
+    level = settings.get('EXPORT_COMPRESSION_LEVEL')
+    return {
+        'compression': check_codec(settings.get('EXPORT_COMPRESSION')),
+        'compression_level': None if level is None else int(level)
+    }
+
+
+def compressed_path(path: Union[str, os.PathLike],
+                    compression: Union[str, None]) -> Path:
+    '''Return `path` with the suffix of `compression` added.'''
+    path = Path(path)
+    if compression is None:
+        return path
+    return path.with_name(path.name + SUFFIXES[compression])
+
+
+def open_text(path: Union[str, os.PathLike], mode: str = 'r',
+              compression: str = None, level: int = None,
+              encoding: str = None, newline: str = None) -> IO[str]:
+    '''Open `path`, with the suffix of `compression` added, in text `mode`
+    ('r', 'w' or 'a'), compressing what is written.'''
+    compression = check_codec(compression)
+    path = compressed_path(path, compression)
+    if level is None and compression is not None:
+        level = DEFAULT_LEVELS[compression]
+    mode = mode.rstrip('t')
+
+    if compression == 'gzip':
+        return gzip.open(path, mode + 't', compresslevel=level,
+                         encoding=encoding, newline=newline)
+    elif compression == 'zstd':
+        if mode == 'r':
+            return _read_zstd(path, encoding, newline)
+        cctx = zstandard.ZstdCompressor(level=level)
+        return zstandard.open(path, mode + 't', cctx=cctx,
+                              encoding=encoding, newline=newline)
+    return Path(path).open(mode, encoding=encoding, newline=newline)
+
+
+def compress(data: bytes, compression: str, level: int = None) -> bytes:
+    '''Compress `data` into one gzip member or zstd frame.'''
+    compression = check_codec(compression)
+    if level is None:
+        level = DEFAULT_LEVELS[compression]
+    if compression == 'gzip':
+        return gzip.compress(data, compresslevel=level)
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def decompress(data: bytes) -> bytes:
+    '''Decompress `data`, compressed or not, telling the codec from its
+    magic number.'''
+    codec = _MAGIC.get(data[:2]) or _MAGIC.get(data[:4])
+    if codec == 'gzip':
+        return gzip.decompress(data)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd data needs the `zstandard` package')
+        # All the frames, as gzip.decompress reads all the members
+        with zstandard.ZstdDecompressor().stream_reader(
+                data, read_across_frames=True) as reader:
+            return reader.read()
+    return data
+
+
+def open_export(path: Union[str, os.PathLike], encoding: str = None,
+                newline: str = None) -> IO[str]:
+    '''Open an exported file for reading, whether it was written compressed
+    or not, given its name without the suffix of a codec.'''
+    path = Path(path)
+    for compression in (None, *SUFFIXES):
+        candidate = compressed_path(path, compression)
+        if candidate.exists():
+            break
+    else:
+        raise FileNotFoundError(path)
+
+    with candidate.open('rb') as rh:
+        magic = rh.read(4)
+    codec = _MAGIC.get(magic[:2]) or _MAGIC.get(magic)
+    if codec == 'gzip':
+        return gzip.open(candidate, 'rt', encoding=encoding, newline=newline)
+    if codec == 'zstd':
+        check_codec('zstd')
+        return _read_zstd(candidate, encoding, newline)
+    return io.open(candidate, 'r', encoding=encoding, newline=newline)
+
+
+def _read_zstd(path, encoding, newline):
+    # Read all the frames, one per append.
+    reader = zstandard.ZstdDecompressor().stream_reader(
+        Path(path).open('rb'), read_across_frames=True, closefd=True
+    )
+    return io.TextIOWrapper(reader, encoding=encoding, newline=newline)
@@ -0,0 +1,689 @@
+# -*- coding: utf-8 -*-
+'''Append-only crawl history stores.
+
+`TopicHistory` and `ShardedURLHistory` split history into one shard per forum
+(or blog), loaded on demand. Topic shards are `TopicShard`s, see its docstring.
+`TopicStates` keeps what was last fetched of active topics the same way, in
+`TopicStateShard`s.
+A `URLHistory` is a pair of files in a history directory:
+
+``{name}.log``
+    One UTF-8 entry per line, appended in the order entries are recorded.
+    It is the source of truth and is never rewritten.
+``{name}.idx``
+    An open-addressing hash table of 64-bit entry fingerprints, memory-mapped
+    for lookups. It can always be rebuilt from the log.
+
+The index header carries a dirty flag which is raised before the first
+unflushed insert and cleared by `flush`, so an index left behind by a crashed
+process is detected and rebuilt from the log on the next start.
+'''
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from hashlib import blake2b
+import json
+import mmap
+import os
+from pathlib import Path
+import struct
+import sys
+from typing import Any, Dict, Iterable, Iterator, Optional, Union
+from urllib.parse import quote, unquote
+from weakref import WeakKeyDictionary
+
+from scrapy import signals
+
+_MAGIC = b'CVDH'
+_VERSION = 1
+# magic, version, dirty flag, capacity, number of entries, indexed log size
+_HEADER = struct.Struct('<4sHH3Q')
+_SLOT = struct.Struct('<Q')
+_MIN_CAPACITY = 1 << 12  # Must be a power of 2
+_MAX_LOAD = 0.5
+_TOPIC_TYPECODE = 'I'  # Topic numbers are epoch seconds, 4 bytes until 2106
+
+
+def fingerprint(entry: str) -> int:
+    '''Return a stable, non-zero 64-bit fingerprint of `entry`.'''
+    digest = blake2b(entry.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+
+def _truncate_partial_tail(path: Path) -> int:
+    '''Cut an incomplete last record (no trailing newline) off the log and
+    return the size of the valid part.'''
+    with path.open('r+b') as fh:
+        size = end = fh.seek(0, os.SEEK_END)
+        valid = 0
+        while end > 0:
+            start = max(0, end - 4096)
+            fh.seek(start)
+            nl = fh.read(end - start).rfind(b'\n')
+            if nl >= 0:
+                valid = start + nl + 1
+                break
+            end = start
+
+        if valid != size:
+            fh.truncate(valid)
+
+    return valid
+
+
+class URLHistory:
+    '''Append-only set of URLs with memory-mapped membership lookups.
+
+    Example
+    -------
+    >>> history = URLHistory('/tmp/history', 'scraped_urls')
+    >>> history.add('https://mao.5ch.net/test/read.cgi/bass/1579966729/')
+    True
+    >>> 'https://mao.5ch.net/test/read.cgi/bass/1579966729/' in history
+    True
+    '''
+
+    def __init__(self, dir_path: Union[str, os.PathLike], name: str):
+        self.dir_path = Path(dir_path)
+        self.name = name
+        self.log_path = self.dir_path / f'{name}.log'
+        self.idx_path = self.dir_path / f'{name}.idx'
+
+        if not self.dir_path.exists():
+            self.dir_path.mkdir(parents=True)
+        self.log_path.touch()
+
+        log_size = _truncate_partial_tail(self.log_path)
+        self._log = self.log_path.open('ab')
+        self._idx_fh = None
+        self._mm = None
+        self._dirty = False
+        self._open_index(log_size)
+
+    def __contains__(self, entry):
+        if not isinstance(entry, str):
+            return False
+        return self._lookup(fingerprint(entry))
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self) -> Iterator[str]:
+        self._log.flush()
+        with self.log_path.open('rb') as rh:
+            for line in rh:
+                yield line[:-1].decode('utf-8')
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({str(self.log_path)!r})'
+
+    @property
+    def dirty(self) -> bool:
+        return self._dirty
+
+    @property
+    def nbytes(self) -> int:
+        return _HEADER.size + self._capacity * _SLOT.size
+
+    @staticmethod
+    def count(path: Path) -> int:
+        '''Number of entries in the log at `path`, without indexing it.'''
+        count = 0
+        with Path(path).open('rb') as rh:
+            for chunk in iter(lambda: rh.read(1 << 20), b''):
+                count += chunk.count(b'\n')
+        return count
+
+    def add(self, entry: str) -> bool:
+        '''Record `entry`. Return False when it was already recorded.'''
+        if not isinstance(entry, str):
+            raise TypeError(f'expected a str (provided {type(entry)})')
+        if '\n' in entry:
+            raise ValueError(f'entry contains a newline: {entry!r}')
+
+        fp = fingerprint(entry)
+        if self._lookup(fp):
+            return False
+
+        self._mark_dirty()
+        self._log.write(entry.encode('utf-8') + b'\n')
+        self._insert(fp)
+        return True
+
+    def update(self, entries: Iterable[str]) -> int:
+        '''Record all of `entries` and return the number of new ones.'''
+        return sum(self.add(entry) for entry in entries)
+
+    def flush(self, fsync: bool = False):
+        '''Write buffered entries out and mark the index consistent.'''
+        self._log.flush()
+        if fsync:
+            os.fsync(self._log.fileno())
+        self._write_header(dirty=False)
+        if fsync:
+            self._mm.flush()
+        self._dirty = False
+
+    def close(self):
+        if self._mm is None:
+            return
+        self.flush()
+        self._mm.close()
+        self._idx_fh.close()
+        self._log.close()
+        self._mm = self._idx_fh = None
+
+    # -----------------
+    # Index maintenance
+    # -----------------
+    def _open_index(self, log_size: int):
+        header = self._read_header()
+        if (
+            header is None
+            or header['dirty']
+            or header['log_size'] > log_size
+        ):
+            # Missing, foreign, stale or left dirty by a crash -> rebuild.
+            self._create_index(_MIN_CAPACITY)
+            self._replay(0)
+        else:
+            self._map_index(header['capacity'], header['count'])
+            if header['log_size'] < log_size:
+                # Entries flushed to the log after the last index update.
+                self._replay(header['log_size'])
+        self.flush()
+
+    def _read_header(self):
+        if not self.idx_path.exists():
+            return None
+        with self.idx_path.open('rb') as rh:
+            raw = rh.read(_HEADER.size)
+            if len(raw) < _HEADER.size:
+                return None
+            magic, version, dirty, capacity, count, log_size = \
+                _HEADER.unpack(raw)
+            expected = _HEADER.size + capacity * _SLOT.size
+            if (
+                magic != _MAGIC
+                or version != _VERSION
+                or rh.seek(0, os.SEEK_END) != expected
+            ):
+                return None
+        return {'dirty': dirty, 'capacity': capacity, 'count': count,
+                'log_size': log_size}
+
+    def _write_header(self, dirty: bool):
+        self._mm[:_HEADER.size] = _HEADER.pack(
+            _MAGIC, _VERSION, int(dirty), self._capacity, self._count,
+            self._log.tell()
+        )
+
+    def _mark_dirty(self):
+        if not self._dirty:
+            self._write_header(dirty=True)
+            self._dirty = True
+
+    def _map_index(self, capacity: int, count: int):
+        self._idx_fh = self.idx_path.open('r+b')
+        self._mm = mmap.mmap(self._idx_fh.fileno(), 0)
+        self._capacity = capacity
+        self._mask = capacity - 1
+        self._count = count
+
+    def _create_index(self, capacity: int, path: Path = None):
+        path = self.idx_path if path is None else path
+        with path.open('wb') as wh:
+            wh.write(_HEADER.pack(_MAGIC, _VERSION, 1, capacity, 0, 0))
+            wh.truncate(_HEADER.size + capacity * _SLOT.size)
+        if path == self.idx_path:
+            self._close_index()
+            self._map_index(capacity, 0)
+
+    def _close_index(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._idx_fh.close()
+            self._mm = self._idx_fh = None
+
+    def _replay(self, offset: int):
+        '''Index the log entries stored from `offset` onwards.'''
+        self._log.flush()
+        with self.log_path.open('rb') as rh:
+            rh.seek(offset)
+            for line in rh:
+                self._insert(fingerprint(line[:-1].decode('utf-8')))
+
+    def _lookup(self, fp: int) -> bool:
+        mm, mask, unpack = self._mm, self._mask, _SLOT.unpack_from
+        pos = fp & mask
+        while True:
+            slot = unpack(mm, _HEADER.size + pos * _SLOT.size)[0]
+            if slot == fp:
+                return True
+            if slot == 0:
+                return False
+            pos = (pos + 1) & mask
+
+    def _insert(self, fp: int):
+        if (self._count + 1) > self._capacity * _MAX_LOAD:
+            self._grow()
+
+        mm, mask, unpack = self._mm, self._mask, _SLOT.unpack_from
+        pos = fp & mask
+        while True:
+            offset = _HEADER.size + pos * _SLOT.size
+            slot = unpack(mm, offset)[0]
+            if slot == fp:
+                return
+            if slot == 0:
+                _SLOT.pack_into(mm, offset, fp)
+                self._count += 1
+                return
+            pos = (pos + 1) & mask
+
+    def _grow(self):
+        '''Rehash the fingerprints into an index twice as large.'''
+        old_mm, old_capacity = self._mm, self._capacity
+        tmp_path = self.idx_path.with_suffix('.idx.tmp')
+        self._create_index(old_capacity * 2, tmp_path)
+
+        with tmp_path.open('r+b') as fh:
+            new_mm = mmap.mmap(fh.fileno(), 0)
+            mask = old_capacity * 2 - 1
+            for i in range(old_capacity):
+                fp = _SLOT.unpack_from(old_mm, _HEADER.size + i * _SLOT.size)[0]
+                if fp == 0:
+                    continue
+                pos = fp & mask
+                while _SLOT.unpack_from(new_mm,
+                                        _HEADER.size + pos * _SLOT.size)[0]:
+                    pos = (pos + 1) & mask
+                _SLOT.pack_into(new_mm, _HEADER.size + pos * _SLOT.size, fp)
+            new_mm.close()
+
+        count = self._count
+        self._close_index()
+        os.replace(tmp_path, self.idx_path)
+        self._map_index(old_capacity * 2, count)
+        self._write_header(dirty=True)
+        self._dirty = True
+
+
+class TopicShard:
+    '''Sorted array of the topic numbers of one forum.
+
+    Topic numbers on 2ch/5ch are epoch seconds, so each topic costs 4 bytes
+    in memory and on disk, whatever the form of the URL it was recorded from.
+    The file holds little-endian uint32 appended in the order topics are
+    recorded.
+    '''
+
+    def __init__(self, path: Union[str, os.PathLike]):
+        self.path = Path(path)
+        self._nums = self._load(self.path) if self.path.exists() \
+            else array(_TOPIC_TYPECODE)
+        self._pending = array(_TOPIC_TYPECODE)  # Unflushed topic numbers
+
+    def __contains__(self, num):
+        nums = self._nums
+        i = bisect_left(nums, num)
+        return i < len(nums) and nums[i] == num
+
+    def __len__(self):
+        return len(self._nums)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._nums)
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._pending)
+
+    @property
+    def nbytes(self) -> int:
+        return (self._nums.buffer_info()[1] + len(self._pending)) \
+            * self._nums.itemsize
+
+    def add(self, num: int) -> bool:
+        if num in self:
+            return False
+
+        nums = self._nums
+        # Raises OverflowError for numbers that don't fit in the array.
+        self._pending.append(num)
+        if not nums or nums[-1] < num:
+            nums.append(num)  # New topics mostly have the largest number
+        else:
+            nums.insert(bisect_left(nums, num), num)
+        return True
+
+    def flush(self, fsync: bool = False):
+        '''Append the topics recorded since the last flush to the file.'''
+        if not self._pending:
+            return
+        with self.path.open('ab') as wh:
+            wh.write(self._to_bytes(self._pending))
+            if fsync:
+                wh.flush()
+                os.fsync(wh.fileno())
+        self._pending = array(_TOPIC_TYPECODE)
+
+    def close(self):
+        self.flush()
+
+    @staticmethod
+    def count(path: Path) -> int:
+        '''Number of topics in the file at `path`, without loading it.'''
+        return path.stat().st_size // array(_TOPIC_TYPECODE).itemsize
+
+    @staticmethod
+    def _to_bytes(nums: array) -> bytes:
+        if sys.byteorder != 'little':
+            nums = array(nums.typecode, nums)
+            nums.byteswap()
+        return nums.tobytes()
+
+    @staticmethod
+    def _load(path: Path) -> array:
+        data = path.read_bytes()
+        itemsize = array(_TOPIC_TYPECODE).itemsize
+        valid = len(data) - len(data) % itemsize
+        if valid != len(data):
+            # A torn write from a crash, drop the incomplete number.
+            with path.open('r+b') as fh:
+                fh.truncate(valid)
+
+        nums = array(_TOPIC_TYPECODE)
+        nums.frombytes(data[:valid])
+        if sys.byteorder != 'little':
+            nums.byteswap()
+        return array(_TOPIC_TYPECODE, sorted(set(nums)))
+
+
+class TopicStateShard:
+    '''States of the topics of one forum, dicts by topic number.
+
+    The file holds a JSON line ``[num, state]`` per state recorded, the last
+    one of a topic winning. It is rewritten with the last states only once
+    it holds twice as many lines as topics.
+    '''
+
+    def __init__(self, path: Union[str, os.PathLike]):
+        self.path = Path(path)
+        self._states = {}
+        self._lines = 0
+        self._nbytes = 0
+        self._pending = []  # Unflushed lines
+        if self.path.exists():
+            _truncate_partial_tail(self.path)
+            with self.path.open('rb') as rh:
+                for line in rh:
+                    num, state = json.loads(line)
+                    self._states[num] = state
+                    self._lines += 1
+                    self._nbytes += len(line)
+
+    def __contains__(self, num):
+        return num in self._states
+
+    def __len__(self):
+        return len(self._states)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._states)
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._pending)
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def get(self, num: int) -> Optional[Dict[str, Any]]:
+        return self._states.get(num)
+
+    def add(self, entry: tuple) -> bool:
+        '''Record `entry`, a (topic number, state) tuple. Return False when
+        the state was already recorded.'''
+        num, state = entry
+        if self._states.get(num) == state:
+            return False
+
+        line = json.dumps([num, state], ensure_ascii=False) + '\n'
+        self._states[num] = state
+        self._pending.append(line)
+        self._lines += 1
+        self._nbytes += len(line)
+        return True
+
+    def flush(self, fsync: bool = False):
+        '''Append the states recorded since the last flush to the file.'''
+        if not self._pending:
+            return
+        with self.path.open('a', encoding='utf-8') as wh:
+            wh.writelines(self._pending)
+            if fsync:
+                wh.flush()
+                os.fsync(wh.fileno())
+        self._pending = []
+
+    def close(self):
+        if self._lines > 2 * len(self._states):
+            self._compact()
+        self.flush()
+
+    @classmethod
+    def count(cls, path: Path) -> int:
+        '''Number of topics in the file at `path`.'''
+        return len(cls(path))
+
+    def _compact(self):
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with tmp_path.open('w', encoding='utf-8') as wh:
+            for num, state in self._states.items():
+                wh.write(json.dumps([num, state], ensure_ascii=False) + '\n')
+            wh.flush()
+            os.fsync(wh.fileno())
+        os.replace(tmp_path, self.path)
+        self._pending = []
+        self._lines = len(self._states)
+        self._nbytes = self.path.stat().st_size
+
+
+class ShardedHistory:
+    '''History split into one shard per key (a forum ID or a blog key).
+
+    Entries are (key, value) tuples. A shard is loaded on the first access to
+    its key. When a shard is loaded and the loaded shards take more than
+    `memory_budget` bytes, or more than `max_open` are loaded, the least
+    recently used ones are written back and evicted, closing their files.
+    Only the shards with unflushed entries are written by `flush`.
+    '''
+    shard_cls = None
+    suffix = None
+
+    def __init__(self, dir_path: Union[str, os.PathLike],
+                 memory_budget: int = 128 << 20, max_open: int = 64):
+        self.dir_path = Path(dir_path)
+        self.memory_budget = memory_budget
+        self.max_open = max_open
+        if not self.dir_path.exists():
+            self.dir_path.mkdir(parents=True)
+
+        self._shards = OrderedDict()  # key -> shard, in LRU order
+        # Keys with a shard on disk, listed without loading them.
+        self._keys = {unquote(path.name[:-len(self.suffix)])
+                      for path in self.dir_path.glob(f'*{self.suffix}')}
+
+    def __contains__(self, entry):
+        try:
+            key, value = entry
+        except (TypeError, ValueError):
+            return False
+
+        shard = self.shard(key, create=False)
+        return shard is not None and value in shard
+
+    def __len__(self):
+        return sum(len(self._shards[key]) if key in self._shards
+                   else self.shard_cls.count(self._path(key))
+                   for key in self._keys)
+
+    def is_empty(self) -> bool:
+        '''Return whether no entry is recorded, stopping at the first shard
+        with any. Shards not loaded are only checked for data on disk.'''
+        for key in self._keys:
+            shard = self._shards.get(key)
+            if shard is not None:
+                if len(shard):
+                    return False
+            elif self._path(key).stat().st_size:
+                return False
+        return True
+
+    def __iter__(self) -> Iterator[tuple]:
+        for key in sorted(self._keys):
+            for value in self.shard(key):
+                yield key, value
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({str(self.dir_path)!r})'
+
+    def keys(self):
+        return set(self._keys)
+
+    def add(self, entry: tuple) -> bool:
+        '''Record `entry`, a (key, value) tuple. Return False when it was
+        already recorded.'''
+        key, value = entry
+        if not isinstance(key, str) or not key:
+            raise TypeError(f'key must be a non-empty str: {key!r}')
+        return self.shard(key).add(value)
+
+    def update(self, entries: Iterable[tuple]) -> int:
+        '''Record all of `entries` and return the number of new ones.'''
+        return sum(self.add(entry) for entry in entries)
+
+    def shard(self, key: str, create: bool = True):
+        '''Return the shard of `key`, loading it if needed. Return None if it
+        doesn't exist and `create` is False.'''
+        shard = self._shards.get(key)
+        if shard is not None:
+            self._shards.move_to_end(key)
+            return shard
+        if key not in self._keys and not create:
+            return None
+
+        shard = self._shards[key] = self._open_shard(key)
+        self._keys.add(key)
+        self._evict()
+        return shard
+
+    @property
+    def nbytes(self) -> int:
+        '''Memory taken by the loaded shards.'''
+        return sum(shard.nbytes for shard in self._shards.values())
+
+    def flush(self, fsync: bool = False):
+        for shard in self._shards.values():
+            if shard.dirty:
+                shard.flush(fsync)
+
+    def close(self):
+        for shard in self._shards.values():
+            shard.close()
+        self._shards.clear()
+
+    def _open_shard(self, key: str):
+        return self.shard_cls(self._path(key))
+
+    def _evict(self):
+        nbytes = self.nbytes
+        while len(self._shards) > 1 and (nbytes > self.memory_budget
+                                         or len(self._shards) > self.max_open):
+            _, shard = self._shards.popitem(last=False)
+            nbytes -= shard.nbytes
+            shard.close()
+
+    def _path(self, key: str) -> Path:
+        return self.dir_path / f'{quote(key, safe="")}{self.suffix}'
+
+
+class TopicHistory(ShardedHistory):
+    '''Topics, as (forum key, topic number) tuples, in one `TopicShard` per
+    forum.
+
+    Example
+    -------
+    >>> history = TopicHistory('/tmp/history/scraped_topics')
+    >>> history.add(('5ch_bass', 1579966729))
+    True
+    >>> ('5ch_bass', 1579966729) in history
+    True
+    '''
+    shard_cls = TopicShard
+    suffix = '.topics'
+
+
+class ShardedURLHistory(ShardedHistory):
+    '''URLs, as (key, URL) tuples, in one `URLHistory` per key.'''
+    shard_cls = URLHistory
+    suffix = '.log'
+
+    def _open_shard(self, key: str):
+        return URLHistory(self.dir_path, quote(key, safe=''))
+
+
+# TopicStates of each crawler, by name
+_crawler_states = WeakKeyDictionary()
+
+
+class TopicStates(ShardedHistory):
+    '''States of topics, as dicts by (forum key, topic number), in one
+    `TopicStateShard` per forum.
+
+    Example
+    -------
+    >>> states = TopicStates('/tmp/history/topic_states')
+    >>> states.set('2ch_mnewsplus', 1597213268, {'num_comments': 10})
+    True
+    >>> states.get('2ch_mnewsplus', 1597213268)
+    {'num_comments': 10}
+    '''
+    shard_cls = TopicStateShard
+    suffix = '.states'
+
+    @classmethod
+    def from_crawler(cls, crawler, name: str = 'topic_states'):
+        '''Return the states kept in the history dir of `crawler`, closed
+        with the spider, or None if neither `HISTORY_DIR` nor `DAILY_DIR` is
+        set. The spider, pipelines and middlewares of a crawler share them.'''
+        shared = _crawler_states.setdefault(crawler, {})
+        if name in shared:
+            return shared[name]
+
+        settings = crawler.settings
+        history_dir = settings.get('HISTORY_DIR')
+        if history_dir is None and settings.get('DAILY_DIR') is not None:
+            # As `BaseDownloaderMiddleware`
+            history_dir = Path(settings.get('DAILY_DIR')).parent / 'HISTORY'
+        if history_dir is None:
+            return None
+
+        states = cls(Path(history_dir) / name,
+                     settings.getint('HISTORY_MEMORY_BUDGET', 256 << 20) // 4,
+                     max(settings.getint('HISTORY_MAX_OPEN_SHARDS', 256) // 4,
+                         1))
+        crawler.signals.connect(states.close, signal=signals.spider_closed)
+        shared[name] = states
+        return states
+
+    def get(self, key: str, num: int) -> Optional[Dict[str, Any]]:
+        shard = self.shard(key, create=False)
+        return None if shard is None else shard.get(num)
+
+    def set(self, key: str, num: int, state: Dict[str, Any]) -> bool:
+        '''Record `state` for a topic. Return False when it was already
+        recorded.'''
+        return self.add((key, (num, state)))
@@ -1,13 +1,21 @@
 # -*- coding: utf-8 -*-
 
-from collections import defaultdict
 import logging
 from pathlib import Path
 
 from scrapy import signals
+from twisted.internet import task
 
-from .fileutil import read_pickle, to_pickle
-from .classes import URLOrderedSet
+from .bloom import BloomFilter
+from .fileutil import read_pickle
+from .history import (
+    ShardedHistory,
+    ShardedURLHistory,
+    TopicHistory,
+    TopicStates,
+    URLHistory
+)
+from .writer import WriteQueue
 from .exceptions import (
     BlacklistedURLException,
     ExpiredURLException,
@@ -17,47 +25,102 @@ from .exceptions import (
 
 class BaseDownloaderMiddleware:
 
-    def __init__(self, latest_dir_pointer, daily_dir):
+    def __init__(self, latest_dir_pointer, daily_dir, history_dir=None,
+                 checkpoint_interval=300, checkpoint_items=1000,
+                 memory_budget=256 << 20, bloom_error_rate=0,
+                 bloom_capacity=10_000_000, max_open_shards=256):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.latest_dir_pointer = Path(latest_dir_pointer)
         self.daily_dir = Path(daily_dir)
 
-        # Read `latest_dir_pointer`.
-        # the pointer contains the path to latest.txt in the latest daily dir,
-        # which contains the paths to expired_urls, scraped_urls and blacklist.
-        try:
-            with latest_dir_pointer.open() as rh:
-                latest_dir = Path(next(rh))
-            bl_path = latest_dir / 'blacklist.pickle'
-            su_path = latest_dir / 'scraped_urls.pickle'
-            eu_path = latest_dir / 'expired_urls.pickle'
-        except Exception:
-            # If there is a problem opening/reading the path, ignore history,
-            # scrape all and regenerate expired_urls, scraped_urls, blacklist.
-            bl_path = su_path = eu_path = None
+        # History is checkpointed (flushed to disk with `latest_dir_pointer`)
+        # every `checkpoint_interval` seconds and every `checkpoint_items`
+        # records, so that a killed crawl keeps what it has learned.
+        # 0 disables either trigger.
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_items = checkpoint_items
+        self._checkpoint_task = None
+        self._uncheckpointed = 0
+
+        # History is kept in append-only stores shared by all runs. They sit
+        # next to the daily dirs unless `history_dir` is provided.
+        self.history_dir = (self.daily_dir.parent / 'HISTORY'
+                            if history_dir is None else Path(history_dir))
 
         # blacklist of URLs to skip.
-        self.blacklist = read_pickle(bl_path, set())
+        self.blacklist = URLHistory(self.history_dir, 'blacklist')
 
-        # The following two attributes are dicts of sets of URLs to skip.
-        # Their key must be retrievable from URLs with `self.get_key` method.
+        # The following are pairs of stores of URLs and of topics to skip.
+        # A URL goes to the topic store when `self.get_topic` returns a topic
+        # for it, to the URL store otherwise. Both are sharded by the key
+        # from `self.get_key`, a shard is loaded when its key is first seen
+        # and `memory_budget` and `max_open_shards` are shared evenly by the 4
+        # stores.
+        budget = memory_budget // 4
+        max_open = max(max_open_shards // 4, 1)
 
-        # URLs already scraped before. Updated whenever an instance of
+        # Already scraped before. Updated whenever an instance of
         # `self.trgt_item_cls` is scraped.
-        self.scraped_urls = read_pickle(su_path, defaultdict(URLOrderedSet))
+        self.scraped_urls = ShardedURLHistory(
+            self.history_dir/'scraped_urls', budget, max_open
+        )
+        self.scraped_topics = TopicHistory(
+            self.history_dir/'scraped_topics', budget, max_open
+        )
 
-        # URLs that are expired (returned status greater than 400).
-        self.expired_urls = read_pickle(eu_path, defaultdict(URLOrderedSet))
+        # Expired (returned status greater than 400).
+        self.expired_urls = ShardedURLHistory(
+            self.history_dir/'expired_urls', budget, max_open
+        )
+        self.expired_topics = TopicHistory(
+            self.history_dir/'expired_topics', budget, max_open
+        )
 
-        # A function to get keys of `self.expired_urls` and `self.scraped_urls`
-        # Assign on the actual middleware
+        # Optional Bloom filter of all the history above, so that a URL it
+        # has never seen skips the exact lookups. It is persisted with the
+        # stores and rebuilt from them when missing or left dirty by a crash.
+        # Remove `history.bloom` after editing the stores by other means.
+        # A `bloom_error_rate` of 0 disables it.
+        self.bloom = None
+        self.bloom_false_positives = 0
+        if bloom_error_rate > 0:
+            self.bloom = BloomFilter(self.history_dir/'history.bloom',
+                                     bloom_capacity, bloom_error_rate)
+
+        # Crawler stats, to which the Bloom filter counters are written.
+        self.stats = None
+
+        # States of the topics fetched by the spider, if it keeps any, only
+        # flushed with the history.
+        self.topic_states = None
+
+        # A function to get keys from URLs. A URL is recorded only when it
+        # has a key. Assign on the actual middleware
         self.get_key = None
 
+        # A function to get a (key, topic number) tuple from topic URLs, or
+        # None to keep all the history as URLs. The key must be the one from
+        # `self.get_key`.
+        # Assign on the actual middleware
+        self.get_topic = None
+
         # Item class(es) for which to update `self.scraped_urls` whenever an
         # instance of them is scraped.
         # Assign on the actual middleware
         self.trgt_item_cls = None
 
+        # Item class(es) scraped from the same response once what goes with
+        # an instance of `self.trgt_item_cls` is exported, or None. The URL
+        # is then only recorded once they are scraped, and once the writes
+        # of `self.write_queue` queued until then are done, so that a crawl
+        # killed in between scrapes it again.
+        # Assign on the actual middleware
+        self.exported_item_cls = None
+        self.write_queue = None
+        # URLs waiting for `self.exported_item_cls`, then for their writes
+        self._exporting = set()
+        self._unwritten = []
+
     @classmethod
     def from_crawler(cls, crawler):
         '''Read relevant configurations from settings, hook signals to methods
@@ -67,35 +130,70 @@ class BaseDownloaderMiddleware:
         settings = crawler.settings
         latest_dir_pointer = settings.get('LATEST_DIR_POINTER')
         daily_dir = settings.get('DAILY_DIR')
-        s = cls(latest_dir_pointer, daily_dir)
+        history_dir = settings.get('HISTORY_DIR')
+        s = cls(latest_dir_pointer, daily_dir, history_dir,
+                settings.getfloat('HISTORY_CHECKPOINT_INTERVAL', 300),
+                settings.getint('HISTORY_CHECKPOINT_ITEMS', 1000),
+                settings.getint('HISTORY_MEMORY_BUDGET', 256 << 20),
+                settings.getfloat('HISTORY_BLOOM_ERROR_RATE', 0),
+                settings.getint('HISTORY_BLOOM_CAPACITY', 10_000_000),
+                settings.getint('HISTORY_MAX_OPEN_SHARDS', 256))
+        s.stats = crawler.stats
+        s.write_queue = WriteQueue.from_crawler(crawler)
+        s.topic_states = TopicStates.from_crawler(crawler)
 
         # Connect signals to methods.
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
         crawler.signals.connect(s.item_scraped, signal=signals.item_scraped)
         crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
 
         return s
 
     def process_request(self, request, spider):
-        if request.url in self.blacklist:
+        # The blacklist is small and kept out of the Bloom filter, so that
+        # each request probes it once, for the entry below.
+        if self.blacklist and request.url in self.blacklist:
             self.logger.debug(f'Request ignored: blacklisted: {request.url}')
             raise BlacklistedURLException()
 
+        bloom = self.bloom
+
         key = self.get_key(request.url)
-        if request.url in self.expired_urls.get(key, []):
+        if key is None:
+            return None
+
+        topic = self._get_topic(request.url)
+        if topic is None:
+            entry, expired, scraped = \
+                (key, request.url), self.expired_urls, self.scraped_urls
+        else:
+            entry, expired, scraped = \
+                topic, self.expired_topics, self.scraped_topics
+
+        if bloom is not None and self._bloom_entry(entry) not in bloom:
+            return None
+
+        if entry in expired:
             self.logger.debug(f'Request ignored: has expired: {request.url}')
             raise ExpiredURLException()
 
-        if request.url in self.scraped_urls.get(key, []):
+        if entry in scraped:
             self.logger.debug(
                 f'Request ignored: already scraped: {request.url}'
             )
             raise AlreadyScrapedURLsException()
 
+        if bloom is not None:
+            self.bloom_false_positives += 1
+
     def process_response(self, request, response, spider):
-        if 400 <= response.status:
+        # Statuses the callback handles (like 416 for Range requests) don't
+        # mean that the URL expired.
+        if 400 <= response.status and response.status not in \
+                request.meta.get('handle_httpstatus_list', ()):
             key = self.get_key(request.url)
             if key is not None:
-                self.expired_urls[key].add_url(request.url)
+                self._record('expired', request.url)
                 self.logger.warning(
                     f'Response ignored: status {response.status} '
                     f'({request.url}), added to expired_urls list.'
@@ -106,27 +204,216 @@ class BaseDownloaderMiddleware:
 
     def item_scraped(self, item, response, spider):
         if isinstance(item, self.trgt_item_cls):
-            key = self.get_key(response.url)
-            if key is not None:
-                self.scraped_urls[key].add_url(response.url)
+            if self.get_key(response.url) is not None:
+                if self.exported_item_cls is None:
+                    self._record('scraped', response.url)
+                else:
+                    self._exporting.add(response.url)
+        elif self.exported_item_cls is not None \
+                and isinstance(item, self.exported_item_cls) \
+                and response.url in self._exporting:
+            self._exporting.discard(response.url)
+            if self.write_queue is None:
+                # Written by the pipelines already
+                self._record('scraped', response.url)
+            else:
+                # Tagged with the topic ID by the export pipelines
+                self._unwritten.append((item.get('topic_id'), response.url))
+                self._count_record()
         return None
 
+    def spider_opened(self, spider):
+        # Import history kept in older formats.
+        self._migrate_pickles()
+        self._migrate_flat_urls()
+
+        if self.bloom is not None and self.bloom.is_new:
+            self._rebuild_bloom()
+
+        if self.checkpoint_interval > 0:
+            self._checkpoint_task = task.LoopingCall(self.checkpoint)
+            self._checkpoint_task.start(self.checkpoint_interval, now=False)
+
     def spider_closed(self, spider, reason):
-        # TODO: minimize recursion with URLOrderedSet
-        import sys
-        sys.setrecursionlimit(10000)
+        if self._checkpoint_task is not None and self._checkpoint_task.running:
+            self._checkpoint_task.stop()
+
+        if self.bloom is not None and self.stats is not None:
+            self.stats.set_value('history/bloom/hits', self.bloom.hits)
+            self.stats.set_value('history/bloom/misses', self.bloom.misses)
+            self.stats.set_value('history/bloom/false_positives',
+                                 self.bloom_false_positives)
+        return self.checkpoint()
+
+    def checkpoint(self):
+        '''Flush all history stores to disk, then point `latest_dir_pointer`
+        to the daily dir. The stores recover to their last flushed state when
+        a crawl is killed, so the next run resumes from here.
+
+        URLs waiting for their writes are recorded first, once the writes
+        queued so far are done, in which case a Deferred is returned. Those
+        of the topics whose writes failed are left to the next run.'''
+        unwritten, self._unwritten = self._unwritten, []
+        records, self._uncheckpointed = self._uncheckpointed, 0
+        if self.write_queue is None or not unwritten:
+            return self._checkpoint([url for _, url in unwritten], records)
 
-        for uos in self.scraped_urls.values():  # uos = URL Ordered Set
-            uos.trim()
-            uos.set_pivot_url()
+        # Failures are left to drain() in the export pipelines.
+        d = self.write_queue.wait()
+        d.addCallback(self._checkpoint_written, unwritten, records)
+        return d
 
-        for uos in self.expired_urls.values():
-            uos.trim()
-            uos.set_pivot_url()
+    def _checkpoint_written(self, _, unwritten, records):
+        failed = self.write_queue.failed
+        written = [url for tag, url in unwritten if not failed(tag)]
+        if len(written) < len(unwritten):
+            # Scraped again by the next run.
+            self.logger.error(f'{len(unwritten) - len(written)} URLs not '
+                              'recorded as scraped, their export failed')
+        self._checkpoint(written, records - (len(unwritten) - len(written)))
 
-        to_pickle(self.blacklist, self.daily_dir/'blacklist.pickle')
-        to_pickle(self.scraped_urls, self.daily_dir/'scraped_urls.pickle')
-        to_pickle(self.expired_urls, self.daily_dir/'expired_urls.pickle')
+    def _checkpoint(self, unwritten, records):
+        for url in unwritten:
+            store, entry = self._history_entry('scraped', url)
+            if store is not None:
+                self._add(store, entry)
+
+        for store in self._stores():
+            store.flush(fsync=True)
+        if self.bloom is not None:
+            self.bloom.flush(fsync=True)
+        if self.topic_states is not None:
+            self.topic_states.flush(fsync=True)
 
         with self.latest_dir_pointer.open('w') as wh:
             wh.write(str(self.daily_dir.resolve()))  # Write abs path
+
+        self.logger.debug(f'Checkpointed history ({records} new records)')
+
+    def _stores(self):
+        return (self.blacklist, *self._history_stores())
+
+    def _history_stores(self):
+        '''Stores of the entries put in the Bloom filter.'''
+        return (self.scraped_urls, self.scraped_topics, self.expired_urls,
+                self.expired_topics)
+
+    def _get_topic(self, url):
+        return None if self.get_topic is None else self.get_topic(url)
+
+    def _history_entry(self, kind, url):
+        '''Return the `kind` ('scraped' or 'expired') store for `url` and the
+        entry to record in it, or (None, None) if `url` has no key.'''
+        key = self.get_key(url)
+        if key is None:
+            return None, None
+
+        topic = self._get_topic(url)
+        if topic is None:
+            return getattr(self, f'{kind}_urls'), (key, url)
+        return getattr(self, f'{kind}_topics'), topic
+
+    def _record(self, kind, url):
+        '''Add `url` to the `kind` ('scraped' or 'expired') history. Return
+        False if it was already there.'''
+        store, entry = self._history_entry(kind, url)
+        is_new = store is not None and self._add(store, entry)
+        if is_new:
+            self._count_record()
+        return is_new
+
+    def _count_record(self):
+        self._uncheckpointed += 1
+        if 0 < self.checkpoint_items <= self._uncheckpointed:
+            self.checkpoint()
+
+    def _add(self, store, entry):
+        '''Add `entry` to `store` and to the Bloom filter.'''
+        if self.bloom is not None:
+            self.bloom.add(self._bloom_entry(entry))
+        return store.add(entry)
+
+    @staticmethod
+    def _bloom_entry(entry):
+        '''Bloom filter entry for a (key, URL or topic number) entry.'''
+        return f'{entry[0]}\x1f{entry[1]}'
+
+    def _rebuild_bloom(self):
+        self.logger.info('Building the history Bloom filter')
+        for store in self._history_stores():
+            self.bloom.update(self._bloom_entry(entry) for entry in store)
+        self.bloom.flush(fsync=True)
+        if len(self.bloom) > self.bloom.capacity:
+            self.logger.warning(
+                f'History Bloom filter holds {len(self.bloom)} entries for a '
+                f'capacity of {self.bloom.capacity}, raise '
+                f'HISTORY_BLOOM_CAPACITY to keep its false-positive rate.'
+            )
+
+    def _migrate_pickles(self):
+        '''Import `blacklist`, `scraped_urls` and `expired_urls` pickled by a
+        previous run into the history stores that are still empty.'''
+        stores = {'blacklist': [self.blacklist],
+                  'scraped_urls': [self.scraped_urls, self.scraped_topics],
+                  'expired_urls': [self.expired_urls, self.expired_topics]}
+        names = [name for name, s in stores.items()
+                 if all(store.is_empty() if isinstance(store, ShardedHistory)
+                        else not store for store in s)]
+        if not names:
+            return
+
+        # Read `latest_dir_pointer`.
+        # the pointer contains the path to the latest daily dir, which
+        # contains the pickles written by the runs before the history stores.
+        try:
+            with self.latest_dir_pointer.open() as rh:
+                latest_dir = Path(next(rh).strip())
+        except Exception:
+            # No previous run, nothing to migrate.
+            return
+
+        for name in names:
+            try:
+                obj = read_pickle(latest_dir / f'{name}.pickle', None)
+            except Exception as e:
+                self.logger.warning(f'Failed to read {name}.pickle: {e!r}')
+                continue
+            if obj is None:
+                continue
+
+            # `blacklist` is a set, the others are dicts of URLOrderedSets.
+            urls_sets = obj.values() if isinstance(obj, dict) else [obj]
+            if name == 'blacklist':
+                count = sum(self.blacklist.add(url)
+                            for urls in urls_sets for url in urls)
+            else:
+                kind = name.split('_')[0]
+                count = 0
+                for url in (url for urls in urls_sets for url in urls):
+                    store, entry = self._history_entry(kind, url)
+                    count += store is not None and self._add(store, entry)
+
+            for store in stores[name]:
+                store.flush(fsync=True)
+            self.logger.info(f'Migrated {count} URLs from {name}.pickle')
+
+    def _migrate_flat_urls(self):
+        '''Shard the scraped and expired URLs kept in single stores.'''
+        for kind in ('scraped', 'expired'):
+            name = f'{kind}_urls'
+            if not (self.history_dir / f'{name}.log').exists():
+                continue
+
+            flat = URLHistory(self.history_dir, name)
+            count = 0
+            for url in flat:
+                store, entry = self._history_entry(kind, url)
+                count += store is not None and self._add(store, entry)
+            flat.close()
+            getattr(self, f'{kind}_urls').flush(fsync=True)
+            getattr(self, f'{kind}_topics').flush(fsync=True)
+
+            # Keep the log in case, the index can be rebuilt from it.
+            flat.log_path.rename(flat.log_path.with_suffix('.log.migrated'))
+            flat.idx_path.unlink()
+            self.logger.info(f'Migrated {count} URLs from {name}.log')
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+'''Queue of file writes run by a background thread, off the reactor thread.
+
+The export pipelines of a crawler share one `WriteQueue`. Submitting a write
+returns a Deferred fired once the write is queued, so that Scrapy stops
+feeding items to a pipeline while `maxsize` writes are pending. Writes run in
+the order they were submitted. A write that fails is logged, fails the next
+`drain` and has its `tag` recorded, to tell which exports failed.
+'''
+import logging
+import queue
+import threading
+from typing import Any, Callable
+from weakref import WeakKeyDictionary
+
+from scrapy import signals
+from twisted.internet import defer
+
+logger = logging.getLogger(__name__)
+
+# Queues shared by the pipelines of each crawler
+_queues = WeakKeyDictionary()
+
+
+class WriteQueue:
+    '''Run write functions in a thread, with at most `maxsize` of them
+    pending.
+
+    Example
+    -------
+    >>> d = write_queue.submit(path.write_text, 'text')  # doctest: +SKIP
+    >>> d = write_queue.drain()  # Fired once `path` is written
+    '''
+
+    def __init__(self, maxsize: int = 100, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.semaphore = defer.DeferredSemaphore(maxsize)
+        self.errors = 0
+        self.stats = None  # Crawler stats to count the errors in
+        # Exceptions raised since the last `drain`, and tags of failed writes,
+        # both updated by the thread.
+        self._failures = []
+        self._failed_tags = set()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='WriteQueue')
+        self._thread.start()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        '''Return the queue of `crawler`, stopped with its engine, or None
+        if `EXPORT_QUEUE_SIZE` is 0.'''
+        if crawler in _queues:
+            return _queues[crawler]
+
+        maxsize = crawler.settings.getint('EXPORT_QUEUE_SIZE', 100)
+        write_queue = cls(maxsize) if maxsize > 0 else None
+        if write_queue is not None:
+            write_queue.stats = crawler.stats
+            crawler.signals.connect(write_queue.stop,
+                                    signal=signals.engine_stopped)
+        _queues[crawler] = write_queue
+        return write_queue
+
+    def submit(self, func: Callable, *args, tag: Any = None,
+               **kwargs) -> defer.Deferred:
+        '''Queue `func(*args, **kwargs)` and return a Deferred fired once it
+        is queued. `tag`, like the topic written, is recorded if it fails.'''
+        d = self.semaphore.acquire()
+        d.addCallback(lambda _: self._queue.put((func, args, kwargs, tag)))
+        return d
+
+    def drain(self) -> defer.Deferred:
+        '''Return a Deferred fired once the writes submitted so far are
+        done, or failed with the first exception raised by those that weren't
+        reported by an earlier `drain`.'''
+        return self._barrier(report=True)
+
+    def wait(self) -> defer.Deferred:
+        '''Return a Deferred fired once the writes submitted so far are
+        done, failed or not, leaving their failures to `drain`.'''
+        return self._barrier(report=False)
+
+    def failed(self, tag: Any) -> bool:
+        '''Return whether a write tagged `tag` failed. Only up to date for
+        the writes submitted before a `drain` or `wait` that fired.'''
+        return tag in self._failed_tags
+
+    def _barrier(self, report):
+        done = defer.Deferred()
+        # Queued behind the writes waiting for the semaphore, if any.
+        d = self.semaphore.acquire()
+        d.addCallback(lambda _: self._queue.put(
+            (self._reached, (done, report), {}, None)
+        ))
+        return done
+
+    def _reached(self, done, report):
+        # Run by the thread, after the writes queued before.
+        failures = []
+        if report:
+            failures, self._failures = self._failures, []
+        self.reactor.callFromThread(self._drained, done, failures)
+
+    def _drained(self, done, failures):
+        if self.stats is not None:
+            self.stats.set_value('export/write_errors', self.errors)
+        if failures:
+            done.errback(failures[0])
+        else:
+            done.callback(None)
+
+    def stop(self):
+        '''Let the thread finish the queued writes and exit.'''
+        self._queue.put(None)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+
+            func, args, kwargs, tag = job
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                self.errors += 1
+                self._failures.append(e)
+                if tag is not None:
+                    self._failed_tags.add(tag)
+                logger.error(f'Failed to write with {func!r}', exc_info=True)
+            self.reactor.callFromThread(self.semaphore.release)
+
+
+def write(write_queue: WriteQueue, item: Any, func: Callable, *args,
+          tag: Any = None, **kwargs):
+    '''Run `func(*args, **kwargs)` in `write_queue`, tagged `tag`, or right
+    away if it is None, and return `item` or a Deferred fired with it once
+    queued.'''
+    if write_queue is None:
+        func(*args, **kwargs)
+        return item
+
+    d = write_queue.submit(func, *args, tag=tag, **kwargs)
+    d.addCallback(lambda _: item)
+    return d